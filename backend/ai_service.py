@@ -1,8 +1,6 @@
 
-import os
 import json
 import re
-import requests
 import uuid
 import time
 from typing import Dict, List, Any, Optional
@@ -12,19 +10,30 @@ from esmo_links import get_esmo_link
 from scoring import scorer
 from knowledge_base_loader import kb_loader
 from treatment_extractor import TreatmentLineExtractor
+from deepseek_client import deepseek_client, DeepSeekError, DeepSeekUnavailable, DeepSeekDeadlineExceeded
+from drug_recognizer import drug_recognizer
+from deadline import note_degraded
+from cancer_classifier import cancer_classifier
+from cancer_vocabulary import cancer_vocabulary
+
+# типы рака, которые AI может вернуть при определении типа: все типы базы рекомендаций + 'general'
+VALID_CANCER_TYPES = cancer_vocabulary.labels
+
 
 class AIService:
     def __init__(self):
         print("🟢 ИНИЦИАЛИЗАЦИЯ AI SERVICE")
         
-        self.deepseek_api_key = os.getenv('DEEPSEEK_API_KEY')
-        self.deepseek_url = "https://api.deepseek.com/v1/chat/completions"
+        self.client = deepseek_client
+        self.classifier = cancer_classifier
+        self.vocabulary = cancer_vocabulary
         
         self.guidelines_data = {}
         
-        self.line_extractor = TreatmentLineExtractor(self.deepseek_api_key)
+        self.line_extractor = TreatmentLineExtractor(client=self.client)
 
         self.knowledge_base = kb_loader
+        self.corpus = kb_loader.corpus
         if self.knowledge_base and hasattr(self.knowledge_base, 'guidelines'):
             print(f"✅ База знаний загружена: {len(self.knowledge_base.guidelines)} рекомендаций")
         else:
@@ -37,75 +46,48 @@ class AIService:
         Использует AI для определения типа рака из текста
         """
         print("\n🔍 AI ОПРЕДЕЛЯЕТ ТИП РАКА")
+
+        # уверенный локальный классификатор избавляет от вызова LLM
+        prediction = self.classifier.decide(text[:2000], allowed=VALID_CANCER_TYPES)
+        if prediction:
+            print(f"✅ Тип рака определен локально: {prediction.label} "
+                  f"({prediction.source}, уверенность {prediction.confidence:.2f})")
+            return prediction.label
         
         try:
             prompt = f"""Проанализируй историю болезни и определи ОСНОВНОЙ тип рака.
-    Верни ТОЛЬКО одно слово из списка допустимых значений.
+    Верни ТОЛЬКО одно значение из списка допустимых значений.
 
     История болезни:
     {text[:2000]}
 
-    Допустимые значения:
-    - 'cancer_unknown_primary' - если это CUP (неизвестный первичный очаг)
-    - 'lung' - рак легкого
-    - 'breast' - рак молочной железы
-    - 'prostate' - рак предстательной железы
-    - 'colon' - рак толстой кишки
-    - 'rectal' - рак прямой кишки
-    - 'stomach' - рак желудка
-    - 'pancreatic' - рак поджелудочной железы
-    - 'esophageal' - рак пищевода
-    - 'liver' - рак печени
-    - 'kidney' - рак почки
-    - 'bladder' - рак мочевого пузыря
-    - 'ovarian' - рак яичников
-    - 'cervical' - рак шейки матки
-    - 'uterine' - рак матки
-    - 'melanoma' - меланома
-    - 'thyroid' - рак щитовидной железы
-    - 'general' - если не удалось определить или другое
+    Допустимые значения (по клиническим рекомендациям в базе):
+{self.vocabulary.prompt_choices()}
 
-    Верни ТОЛЬКО одно слово из списка выше, без пояснений.
+    Если это CUP (первичный очаг не выявлен) - 'cancer_unknown_primary'.
+    Верни ТОЛЬКО одно значение из списка выше (латиницей, как в списке), без пояснений.
     """
 
-            headers = {
-                "Authorization": f"Bearer {self.deepseek_api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            payload = {
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "system", "content": "Ты - онколог. Определяешь тип рака по истории болезни. Отвечаешь только одним словом."},
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.1,
-                "max_tokens": 10
-            }
-            
-            response = requests.post(
-                self.deepseek_url,
-                headers=headers,
-                json=payload,
-                timeout=120
+            content = self.client.chat(
+                system="Ты - онколог. Определяешь тип рака по истории болезни. Отвечаешь только одним значением из списка.",
+                user=prompt,
+                max_tokens=16,
+                timeout=30,
+                use_cache=True
             )
             
-            if response.status_code == 200:
-                result = response.json()
-                cancer_type = result['choices'][0]['message']['content'].strip().lower()
+            if content:
+                cancer_type = self.vocabulary.resolve(content)
                 
-                valid_types = ['cancer_unknown_primary', 'lung', 'breast', 'prostate', 'colon', 
-                            'rectal', 'stomach', 'pancreatic', 'esophageal', 'liver', 'kidney', 
-                            'bladder', 'ovarian', 'cervical', 'uterine', 'melanoma', 'thyroid', 'general']
-                
-                if cancer_type in valid_types:
+                if cancer_type:
                     print(f"✅ AI определил тип рака: {cancer_type}")
                     return cancer_type
                 else:
-                    print(f"⚠️ AI вернул недопустимое значение: {cancer_type}, используем fallback")
+                    print(f"⚠️ AI вернул недопустимое значение: {content.strip()}, используем fallback")
         
         except Exception as e:
             print(f"❌ Ошибка при вызове AI для определения типа рака: {e}")
+            note_degraded('cancer_type', e)
         
         return self._fallback_detect_cancer_type(text)
 
@@ -113,29 +95,21 @@ class AIService:
         """
         Запасной метод определения типа рака через ключевые слова
         """
-        text_lower = text.lower()
-        
-        cup_keywords = ['невыявленного первичного', 'cup', 'неизвестного первичного', 'онпл', 'primary unknown']
-        for keyword in cup_keywords:
-            if keyword in text_lower:
-                return 'cancer_unknown_primary'
-        
-        cancer_keywords = {
-            'lung': ['рак легкого', 'рак легких', 'аденокарцинома легкого'],
-            'breast': ['рак молочной железы', 'рак груди', 'рмж'],
-            'prostate': ['рак предстательной железы', 'рак простаты'],
-            'colon': ['рак ободочной кишки', 'рак толстой кишки'],
-            'rectal': ['рак прямой кишки'],
-            'stomach': ['рак желудка'],
-            'pancreatic': ['рак поджелудочной железы'],
-            'melanoma': ['меланома'],
-            'thyroid': ['рак щитовидной железы']
-        }
-        
-        for cancer_type, keywords in cancer_keywords.items():
-            for keyword in keywords:
-                if keyword in text_lower:
-                    return cancer_type
+        # ручные формулировки, коды МКБ-10 и синонимы из словаря базы рекомендаций:
+        # сначала в строке диагноза, затем во всем тексте (без родственников, анамнеза и отрицаний)
+        matches = {}
+        for part in (self.classifier.diagnosis_text(text), self.classifier.without_excluded(text)):
+            matches = {label: hit for label, hit in self.classifier.rule_matches(part).items()
+                       if label in VALID_CANCER_TYPES}
+            if matches:
+                break
+
+        if 'cancer_unknown_primary' in matches:
+            return 'cancer_unknown_primary'
+
+        cancer_type = self.classifier.first_match(matches)
+        if cancer_type:
+            return cancer_type
         
         return 'general'
     
@@ -146,7 +120,7 @@ class AIService:
         """
 
         if not hasattr(self, 'line_extractor'):
-            self.line_extractor = TreatmentLineExtractor(self.deepseek_api_key)
+            self.line_extractor = TreatmentLineExtractor(client=self.client)
 
         result = self.line_extractor.extract_lines(history)
 
@@ -198,33 +172,17 @@ class AIService:
     }}
 """
 
-            headers = {
-                "Authorization": f"Bearer {self.deepseek_api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            payload = {
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "system", "content": "Ты - онколог. Отвечаешь только JSON."},
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.1,
-                "max_tokens": 500,
-                "response_format": {"type": "json_object"}
-            }
-            
-            response = requests.post(
-                self.deepseek_url,
-                headers=headers,
-                json=payload,
-                timeout=120
+            completion = self.client.complete(
+                system="Ты - онколог. Отвечаешь только JSON.",
+                user=prompt,
+                max_tokens=500,
+                json_mode=True,
+                timeout=120,
+                use_cache=True
             )
+            content = completion.content
             
-            if response.status_code == 200:
-                result = response.json()
-                content = result['choices'][0]['message']['content']
-                
+            if content:
                 content = content.strip()
                 if content.startswith('```json'):
                     content = content[7:]
@@ -235,7 +193,11 @@ class AIService:
                 content = content.strip()
                 
                 try:
-                    return json.loads(content)
+                    opinion = json.loads(content)
+                    if isinstance(opinion, dict):
+                        opinion['from_cache'] = completion.from_cache
+                        opinion['cache_expires_at'] = completion.expires_at
+                    return opinion
                 except:
                     return {
                         "is_appropriate": True,
@@ -245,7 +207,13 @@ class AIService:
                     }
         except Exception as e:
             print(f"❌ Ошибка в ask_about_treatment: {e}")
+            note_degraded('ai_opinions', e)
         
+        return self.default_treatment_opinion()
+    
+    @staticmethod
+    def default_treatment_opinion() -> Dict:
+        """Нейтральное мнение, когда AI не смог оценить препарат"""
         return {
             "is_appropriate": True,
             "is_contraindicated": False,
@@ -253,6 +221,140 @@ class AIService:
             "confidence": 0.5
         }
     
+    def ask_about_treatments_batch(self, cancer_type: str, items: List[Dict[str, Any]], biomarkers: Dict[str, bool]) -> Optional[List[Dict]]:
+        """
+        Пакетная версия ask_about_treatment: оценивает все препараты (всех линий) одним запросом.
+        items - список {'treatment': ..., 'combination': [...]}.
+        Возвращает мнения в том же порядке и формате, что ask_about_treatment,
+        или None, если ответ AI не прошел валидацию. DeepSeekUnavailable и
+        DeepSeekDeadlineExceeded пробрасываются: повторять по каждому препарату бессмысленно
+        """
+        if not items:
+            return []
+        
+        drugs_list = "\n".join(
+            f"{i}. {item['treatment']} (в комбинации: {' + '.join(item.get('combination') or [item['treatment']])})"
+            for i, item in enumerate(items)
+        )
+        
+        try:
+            prompt = f"""Ты - строгий онколог, следующий клиническим рекомендациям. Оцени КАЖДЫЙ препарат из списка.
+
+    Тип рака: {cancer_type}
+    Биомаркеры: {json.dumps(biomarkers, ensure_ascii=False, indent=2)}
+
+    Препараты (номер. препарат (схема, в которой он назначен)):
+{drugs_list}
+
+    КРИТЕРИИ ОЦЕНКИ (будь строг!):
+    1. Соответствует ли препарат стандартам лечения для этого типа рака?
+    2. Учитывает ли он биомаркеры? (HER2, EGFR, PD-L1 и т.д.)
+    3. Есть ли противопоказания или неэффективность?
+
+    ПРИМЕРЫ НЕДОПУСТИМЫХ НАЗНАЧЕНИЙ:
+    - Трастузумаб при HER2-негативном раке желудка → противопоказан (0 баллов)
+    - Тамоксифен при раке желудка → не применяется (0 баллов)
+    - Гемцитабин в 1 линии рака желудка → нестандартно (низкий балл)
+
+    Ответь строго в формате JSON, по одному элементу на КАЖДЫЙ номер из списка:
+    {{
+        "judgments": [
+            {{
+                "id": 0,
+                "treatment": "препарат",
+                "is_appropriate": true/false,
+                "is_contraindicated": true/false,
+                "explanation": "краткое объяснение",
+                "confidence": 0.0-1.0,
+                "score_recommendation": 0-25
+            }}
+        ]
+    }}
+"""
+
+            completion = self.client.complete(
+                system="Ты - онколог. Отвечаешь только JSON.",
+                user=prompt,
+                max_tokens=min(4000, 200 + 150 * len(items)),
+                json_mode=True,
+                timeout=120,
+                use_cache=True
+            )
+            
+            content = completion.content.strip()
+            if content.startswith('```json'):
+                content = content[7:]
+            elif content.startswith('```'):
+                content = content[3:]
+            if content.endswith('```'):
+                content = content[:-3]
+            content = content.strip()
+            
+            try:
+                opinions = self._validate_batch_judgments(json.loads(content), len(items))
+            except json.JSONDecodeError:
+                opinions = None
+            
+            if opinions is None:
+                self.client.invalidate(completion)
+            else:
+                for opinion in opinions:
+                    opinion['from_cache'] = completion.from_cache
+                    opinion['cache_expires_at'] = completion.expires_at
+                print(f"✅ AI оценил {len(items)} препаратов одним запросом")
+            return opinions
+        
+        except (DeepSeekUnavailable, DeepSeekDeadlineExceeded) as e:
+            print(f"❌ Ошибка в ask_about_treatments_batch: {e}")
+            note_degraded('ai_opinions', e)
+            raise
+        except Exception as e:
+            print(f"❌ Ошибка в ask_about_treatments_batch: {e}")
+            return None
+    
+    def _validate_batch_judgments(self, data: Any, expected: int) -> Optional[List[Dict]]:
+        """Проверяет пакетный ответ: по одному корректному мнению на каждый id"""
+        if not isinstance(data, dict) or not isinstance(data.get('judgments'), list):
+            return None
+        
+        by_id = {}
+        for judgment in data['judgments']:
+            if not isinstance(judgment, dict):
+                return None
+            
+            judgment_id = judgment.get('id')
+            if isinstance(judgment_id, str) and judgment_id.isdigit():
+                judgment_id = int(judgment_id)
+            if not isinstance(judgment_id, int) or not 0 <= judgment_id < expected or judgment_id in by_id:
+                return None
+            
+            if not isinstance(judgment.get('is_appropriate'), bool) or not isinstance(judgment.get('is_contraindicated'), bool):
+                return None
+            
+            confidence = judgment.get('confidence', 0.5)
+            if not isinstance(confidence, (int, float)) or not 0 <= confidence <= 1:
+                return None
+            
+            opinion = {
+                "is_appropriate": judgment['is_appropriate'],
+                "is_contraindicated": judgment['is_contraindicated'],
+                "explanation": str(judgment.get('explanation', '')),
+                "confidence": confidence
+            }
+            
+            score_recommendation = judgment.get('score_recommendation')
+            if score_recommendation is not None:
+                if not isinstance(score_recommendation, (int, float)) or not 0 <= score_recommendation <= 25:
+                    return None
+                opinion['score_recommendation'] = score_recommendation
+            
+            by_id[judgment_id] = opinion
+        
+        if len(by_id) != expected:
+            return None
+        
+        return [by_id[i] for i in range(expected)]
+    
     def get_protocol_info(self, cancer_type: str, prescribed_regimen: str, biomarkers: Dict = None) -> Optional[Dict]:
         """
         Сравнивает назначенный режим с рекомендованными из базы знаний.
@@ -326,32 +428,15 @@ class AIService:
 []
 """
 
-            headers = {
-                "Authorization": f"Bearer {self.deepseek_api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            payload = {
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "system", "content": "Ты - медицинский эксперт. Извлекаешь лекарственные препараты из текста. Отвечаешь только JSON-массивом."},
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.1,
-                "max_tokens": 500,
-                "response_format": {"type": "json_object"}
-            }
-            
-            response = requests.post(
-                self.deepseek_url,
-                headers=headers,
-                json=payload,
+            content = self.client.chat(
+                system="Ты - медицинский эксперт. Извлекаешь лекарственные препараты из текста. Отвечаешь только JSON-массивом.",
+                user=prompt,
+                max_tokens=500,
+                json_mode=True,
                 timeout=120
             )
             
-            if response.status_code == 200:
-                result = response.json()
-                content = result['choices'][0]['message']['content']
+            if content:
                 print(f"📥 AI ответ (извлечение): {content[:200]}...")
                 
                 content = content.strip()
@@ -391,63 +476,31 @@ class AIService:
                             
         except Exception as e:
             print(f"❌ Ошибка при AI-извлечении препаратов: {e}")
+            note_degraded('prescribed', e)
         
         print("⚠️ Использую fallback-метод извлечения")
         return self._extract_treatments_fallback(history)
     
     def _extract_treatments_fallback(self, history: str) -> List[str]:
-        """Улучшенный fallback с поддержкой контекста"""
-        treatments = set()
-        text = history.lower()
-        
-        regimens = {
-            'tc': ['паклитаксел', 'карбоплатин'],
-            'тс': ['паклитаксел', 'карбоплатин'],
-            'xelox': ['оксалиплатин', 'капецитабин'],
-            'capox': ['оксалиплатин', 'капецитабин'],
-            'folfox': ['оксалиплатин', 'фторурацил', 'лейковорин'],
-            'folfiri': ['иринотекан', 'фторурацил', 'лейковорин'],
-            'folfirinox': ['оксалиплатин', 'иринотекан', 'фторурацил', 'лейковорин'],
-            'ac': ['доксорубицин', 'циклофосфамид'],
-            'ec': ['эпирубицин', 'циклофосфамид'],
-            'edp-m': ['этопозид', 'доксорубицин', 'цисплатин', 'митотан'],
-            'gp': ['гемцитабин', 'цисплатин'],
-            'gc': ['гемцитабин', 'цисплатин'],
-            'gemcarbo': ['гемцитабин', 'карбоплатин'],
-        }
+        """Fallback: препараты и схемы ищутся общим распознавателем за один проход"""
+        treatments = []
         
-        for abbr, drugs in regimens.items():
-            if abbr in text:
-                print(f"  → Найдена аббревиатура '{abbr}': {drugs}")
-                for drug in drugs:
-                    treatments.add(drug)
-        
-        known_drugs = [
-            'капецитабин', 'рамуцирумаб', 'паклитаксел', 'иринотекан',
-            'оксалиплатин', 'фторурацил', 'лейковорин', 'гемцитабин',
-            'цисплатин', 'карбоплатин', 'доцетаксел',
-            'трастузумаб', 'трастузумаб дерукстекан', 'энхерту', 'пертузумаб', 'тукатиниб',
-            'трастузумаб-эмтанзин', 'т-дм1',
-            'осимертиниб', 'гефитиниб', 'эрлотиниб', 'алектиниб', 'кризотиниб',
-            'церитиниб', 'дабрафениб', 'траметиниб', 'вемурафениб',
-            'пембролизумаб', 'ниволумаб', 'атезолизумаб', 'ипилимумаб',
-            'доксорубицин', 'эпирубицин',
-            'циклофосфамид', 'ифосфамид', 'митомицин', 'митотан',
-            'пеметрексед', 'винорельбин', 'эрибулин', 'этопозид',
-            'винбластин', 'винкристин', 'блеомицин', 'метотрексат'
-        ]
-        
-        for drug in known_drugs:
-            if drug in text:
-                treatments.add(drug)
+        for mention in drug_recognizer.find(history):
+            if mention.kind == 'regimen':
+                print(f"  → Найдена аббревиатура '{mention.text}': {list(mention.drugs)}")
+                treatments.extend(mention.drugs)
+            elif mention.kind == 'drug':
+                treatments.append(mention.canonical)
         
-        result = list(treatments)
+        result = list(dict.fromkeys(treatments))
         print(f"📊 Fallback извлек {len(result)} препаратов: {result}")
         return result
     
-    def enhance_response_with_guidelines(self, patient_history: str, ai_response: dict, cancer_type: str = None, is_update: bool = False, precomputed_score: dict = None, treatment_lines: dict = None) -> dict:
+    def enhance_response_with_guidelines(self, patient_history: str, ai_response: dict, cancer_type: str = None, is_update: bool = False, precomputed_score: dict = None, treatment_lines: dict = None, precomputed_missing_info: dict = None) -> dict:
         """
         Обогащает ответ данными из рекомендаций с правильным расчетом compliance_score
+        precomputed_missing_info - результат _check_missing_info_with_ai, посчитанный заранее
+        (пустой словарь означает, что информации достаточно)
         """
         
         print("\n🔴🔴🔴 [AI_SERVICE] ОБОГАЩЕНИЕ ОТВЕТА 🔴🔴🔴")
@@ -527,7 +580,8 @@ class AIService:
             'source': score_result.get('source', 'unknown'),
             'message': score_result.get('message', ''),
             'analyzed_lines': score_result.get('analyzed_lines', 0),
-            'protocols_available': score_result.get('protocols_available', 0)
+            'protocols_available': score_result.get('protocols_available', 0),
+            'corpus_version': score_result.get('corpus_version')
         }
         
         if score_result.get('source') == 'ai_fallback':
@@ -599,17 +653,21 @@ class AIService:
 
         if not is_update:
 
-            prescribed_for_missing = self.extract_treatments_with_ai(patient_history)
-            biomarkers_for_missing = self.extract_biomarkers(patient_history)
-            
-            missing_info = self._check_missing_info_with_ai(
-                patient_history,
-                detected_cancer_types[0] if detected_cancer_types else 'general',
-                ai_response,
-                is_update=False,
-                prescribed_treatments=prescribed_for_missing,
-                biomarkers=biomarkers_for_missing
-            )
+            if precomputed_missing_info is not None:
+                print("📋 Использую заранее рассчитанный missing_info")
+                missing_info = precomputed_missing_info or None
+            else:
+                prescribed_for_missing = self.extract_treatments_with_ai(patient_history)
+                biomarkers_for_missing = self.extract_biomarkers(patient_history)
+                
+                missing_info = self._check_missing_info_with_ai(
+                    patient_history,
+                    detected_cancer_types[0] if detected_cancer_types else 'general',
+                    ai_response,
+                    is_update=False,
+                    prescribed_treatments=prescribed_for_missing,
+                    biomarkers=biomarkers_for_missing
+                )
             
             if missing_info:
                 doctor['missing_info'] = missing_info
@@ -766,7 +824,7 @@ class AIService:
             'cancer_unknown_primary': 'CUP (неизвестный первичный очаг)',
             'general': 'злокачественное новообразование'
         }
-        return types.get(cancer_type, cancer_type)
+        return types.get(cancer_type) or cancer_vocabulary.names.get(cancer_type, cancer_type)
     
     def extract_biomarkers(self, text: str) -> Dict[str, any]:
         """
@@ -910,36 +968,15 @@ class AIService:
 Если информации достаточно - has_missing_info: false и fields: []
 """
 
-                headers = {
-                    "Authorization": f"Bearer {self.deepseek_api_key}",
-                    "Content-Type": "application/json"
-                }
-                
-                payload = {
-                    "model": "deepseek-chat",
-                    "messages": [
-                        {"role": "system", "content": "Ты - медицинский эксперт. Отвечаешь ТОЛЬКО валидным JSON, без пояснений и markdown."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    "temperature": 0.1,
-                    "max_tokens": 2000,
-                    "response_format": {"type": "json_object"}
-                }
-                
-                response = requests.post(
-                    self.deepseek_url,
-                    headers=headers,
-                    json=payload,
-                    timeout=timeout
+                content = self.client.chat(
+                    system="Ты - медицинский эксперт. Отвечаешь ТОЛЬКО валидным JSON, без пояснений и markdown.",
+                    user=prompt,
+                    max_tokens=2000,
+                    json_mode=True,
+                    timeout=timeout,
+                    use_cache=True
                 )
                 
-                if response.status_code != 200:
-                    print(f"❌ Статус ошибки: {response.status_code}")
-                    continue
-                
-                result = response.json()
-                content = result['choices'][0]['message']['content']
-                
                 content = content.strip()
                 if content.startswith('```json'):
                     content = content[7:]
@@ -962,42 +999,19 @@ class AIService:
                         print("❌ Ответ не является объектом JSON")
                         continue
                     
-                    if missing_info.get('has_missing_info'):
-                        fields = missing_info.get('fields', [])
-                        if not isinstance(fields, list):
-                            fields = []
-                        
-                        valid_fields = []
-                        for field in fields:
-                            if isinstance(field, dict) and field.get('id') and field.get('question'):
-                                field.setdefault('impacts_score', False)
-                                field.setdefault('impacts_recommendations', True)
-                                field.setdefault('required', True)
-                                field.setdefault('type', 'select')
-                                field.setdefault('options', ['Да', 'Нет', 'Неизвестно'])
-                                field.setdefault('category', 'general')
-                                valid_fields.append(field)
-                        
-                        valid_fields = valid_fields[:5]
-                        
-                        print(f"🔍 Найдено {len(valid_fields)} полей для уточнения")
-                        print(f"   Из них влияют на score: {sum(1 for f in valid_fields if f.get('impacts_score'))}")
-                        
-                        return {
-                            "required": True,
-                            "message": missing_info.get('message', 'Для точного анализа необходима дополнительная информация'),
-                            "fields": valid_fields,
-                            "total_fields": len(valid_fields),
-                            "has_score_impacting": any(f.get('impacts_score') for f in valid_fields)
-                        }
-                    else:
-                        print("✅ AI считает, что информации достаточно")
-                        return None
+                    return self.normalize_missing_info(missing_info)
                         
                 except json.JSONDecodeError as e:
                     print(f"❌ Ошибка парсинга JSON: {e}")
                     continue
                     
+            except DeepSeekError as e:
+                # временные сбои уже повторены клиентом (или DeepSeek отключен
+                # предохранителем, или исчерпан дедлайн запроса) - повторяем
+                # здесь только невалидный JSON
+                print(f"❌ Ошибка API: {e}")
+                note_degraded('missing_info', e)
+                break
             except Exception as e:
                 print(f"❌ Ошибка: {e}")
                 continue
@@ -1005,6 +1019,43 @@ class AIService:
         print("⚠️ Не удалось получить корректный JSON от AI после всех попыток")
         return self._fallback_missing_info(cancer_type, prescribed_treatments, biomarkers)
     
+    def normalize_missing_info(self, missing_info: Dict[str, Any]) -> Optional[Dict]:
+        """
+        Приводит ответ AI о недостающей информации к формату фронтенда
+        (не больше 5 полей со значениями по умолчанию); None - информации достаточно
+        """
+        if missing_info.get('has_missing_info'):
+            fields = missing_info.get('fields', [])
+            if not isinstance(fields, list):
+                fields = []
+            
+            valid_fields = []
+            for field in fields:
+                if isinstance(field, dict) and field.get('id') and field.get('question'):
+                    field.setdefault('impacts_score', False)
+                    field.setdefault('impacts_recommendations', True)
+                    field.setdefault('required', True)
+                    field.setdefault('type', 'select')
+                    field.setdefault('options', ['Да', 'Нет', 'Неизвестно'])
+                    field.setdefault('category', 'general')
+                    valid_fields.append(field)
+            
+            valid_fields = valid_fields[:5]
+            
+            print(f"🔍 Найдено {len(valid_fields)} полей для уточнения")
+            print(f"   Из них влияют на score: {sum(1 for f in valid_fields if f.get('impacts_score'))}")
+            
+            return {
+                "required": True,
+                "message": missing_info.get('message', 'Для точного анализа необходима дополнительная информация'),
+                "fields": valid_fields,
+                "total_fields": len(valid_fields),
+                "has_score_impacting": any(f.get('impacts_score') for f in valid_fields)
+            }
+        
+        print("✅ AI считает, что информации достаточно")
+        return None
+    
     def _fallback_missing_info(self, cancer_type: str, treatments: List[str], biomarkers: Dict) -> Dict:
         """
         Запасной вариант вопросов, если AI не сработал
@@ -0,0 +1,255 @@
+
+import os
+import copy
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+class JobQueueFull(Exception):
+    """В очереди и в работе уже max_pending задач - новая не принимается"""
+    pass
+
+
+class AnalysisJob:
+    """Состояние одной фоновой задачи анализа и журнал ее событий"""
+
+    def __init__(self, job_id: str, kind: str):
+        self.id = job_id
+        self.kind = kind
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.finished_at = None
+        self.step = 0
+        self.partial = {}
+        self.events = []
+        self.result = None
+        self.error = None
+        self.http_status = None
+        self.condition = threading.Condition()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'error')
+
+    def emit(self, event_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Добавляет событие в журнал и будит всех подписчиков"""
+        with self.condition:
+            event = {
+                'seq': len(self.events) + 1,
+                'type': event_type,
+                'time': round(time.time() - self.created_at, 2),
+                'data': data
+            }
+            self.events.append(event)
+            self.updated_at = time.time()
+            self.condition.notify_all()
+            return event
+
+    def apply_delta(self, path: Sequence[Any], value: Any):
+        """
+        Кладет value в partial по пути path: ключ словаря или индекс списка
+        (индекс, равный длине списка, дописывает элемент). Промежуточные
+        контейнеры создаются по типу следующего ключа
+        """
+        with self.condition:
+            container = self.partial
+            for key, next_key in zip(path, path[1:]):
+                empty = [] if isinstance(next_key, int) else {}
+                if isinstance(container, list):
+                    if key >= len(container):
+                        container.append(empty)
+                    container = container[key]
+                else:
+                    container = container.setdefault(key, empty)
+            key = path[-1]
+            if isinstance(container, list) and key >= len(container):
+                container.append(value)
+            else:
+                container[key] = value
+
+    def wait_for_events(self, seq: int, timeout: float) -> List[Dict[str, Any]]:
+        """Ждет событий с номером больше seq не дольше timeout секунд"""
+        with self.condition:
+            if len(self.events) <= seq and not self.finished:
+                self.condition.wait(timeout)
+            return self.events[seq:]
+
+    def to_dict(self, include_events: bool = False, after: int = 0) -> Dict[str, Any]:
+        with self.condition:
+            data = {
+                'job_id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'step': self.step,
+                'partial': copy.deepcopy(self.partial),
+                'created_at': self.created_at,
+                'updated_at': self.updated_at,
+                'last_event': len(self.events)
+            }
+            if self.status == 'done':
+                data['result'] = self.result
+            if self.status == 'error':
+                data['error'] = self.error
+                data['http_status'] = self.http_status
+            if include_events:
+                data['events'] = self.events[after:]
+            return data
+
+
+class JobManager:
+    """
+    Очередь фоновых задач анализа. Запрос только ставит задачу и сразу
+    возвращает job_id, а пайплайн выполняется в ограниченном пуле потоков.
+    Клиент либо опрашивает состояние, либо подписывается на SSE-поток событий.
+    Завершенные задачи хранятся ttl секунд. Незавершенных задач (в очереди и
+    в работе) не больше max_pending, сверх этого submit бросает JobQueueFull.
+
+    Состояние и события задач живут в памяти процесса: сервер с несколькими
+    процессами (gunicorn -w N) должен направлять все запросы одного клиента
+    к одному процессу (sticky-сессии), иначе /api/jobs/<id> вернет 404.
+    """
+
+    def __init__(self, max_workers: int = None, ttl: int = None, max_pending: int = None):
+        if max_workers is None:
+            max_workers = int(os.getenv('ANALYSIS_JOB_WORKERS', '4'))
+        self.max_workers = max_workers
+        self.ttl = ttl if ttl is not None else int(os.getenv('ANALYSIS_JOB_TTL', '3600'))
+        if max_pending is None:
+            max_pending = int(os.getenv('ANALYSIS_JOB_MAX_PENDING', str(max_workers * 4)))
+        self.max_pending = max_pending
+
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='analysis-job')
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, kind: str, func: Callable[..., Dict[str, Any]],
+               error_handler: Callable[[Exception], Tuple[Dict[str, Any], int]] = None) -> AnalysisJob:
+        """
+        Ставит задачу в очередь. func вызывается с именованным аргументом progress -
+        функцией progress(step, message=None, delta=None, **partial), которой пайплайн
+        сообщает о начале шага (message) и о готовых промежуточных результатах (partial).
+        delta = (путь, значение) - один новый элемент накапливаемого результата
+        (находка, поле ответа): он добавляется в job.partial, а в событие partial
+        уходит только сам элемент, без уже отправленных.
+        error_handler превращает исключение в (тело ответа, HTTP статус).
+        Если незавершенных задач уже max_pending, бросает JobQueueFull.
+        """
+        self._cleanup()
+
+        job = AnalysisJob(uuid.uuid4().hex, kind)
+        with self.lock:
+            pending = sum(1 for j in self.jobs.values() if not j.finished)
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"Очередь анализа заполнена: {pending} задач из {self.max_pending}")
+            self.jobs[job.id] = job
+
+        job.emit('queued', {'message': 'Задача поставлена в очередь'})
+        self.pool.submit(self._run, job, func, error_handler)
+        return job
+
+    def get(self, job_id: str) -> Optional[AnalysisJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            jobs = list(self.jobs.values())
+
+        by_status = {}
+        for job in jobs:
+            by_status[job.status] = by_status.get(job.status, 0) + 1
+
+        return {
+            'workers': self.max_workers,
+            'max_pending': self.max_pending,
+            'total': len(jobs),
+            'by_status': by_status
+        }
+
+    def stream(self, job: AnalysisJob, last_event_id: int = 0, keepalive: float = 15) -> Iterator[str]:
+        """Генератор SSE: отдает события задачи, пока она не завершится"""
+        seq = last_event_id
+        yield "retry: 3000\n\n"
+
+        while True:
+            events = job.wait_for_events(seq, keepalive)
+
+            if not events:
+                if job.finished and seq >= len(job.events):
+                    return
+                # комментарий не дает прокси закрыть простаивающее соединение
+                yield ": keep-alive\n\n"
+                continue
+
+            for event in events:
+                seq = event['seq']
+                yield format_sse(event)
+
+            if job.finished and seq >= len(job.events):
+                return
+
+    def _run(self, job: AnalysisJob, func: Callable[..., Dict[str, Any]], error_handler):
+        with job.condition:
+            job.status = 'running'
+        job.emit('started', {'message': 'Анализ запущен'})
+
+        def progress(step: int, message: str = None, delta: Tuple[Sequence[Any], Any] = None, **partial):
+            with job.condition:
+                job.step = max(job.step, step)
+                job.partial.update(partial)
+            if message is not None:
+                job.emit('step', {'step': step, 'message': message})
+            if partial:
+                job.emit('partial', dict(partial, step=step))
+            if delta is not None:
+                path, value = delta
+                job.apply_delta(path, value)
+                job.emit('partial', {'step': step, 'path': list(path), 'value': value})
+
+        try:
+            result = func(progress=progress)
+        except Exception as e:
+            if error_handler is not None:
+                payload, status = error_handler(e)
+            else:
+                payload, status = {'error': str(e)}, 500
+
+            # статус и финальное событие меняются под одной блокировкой,
+            # чтобы подписчик не увидел завершенную задачу без события error
+            with job.condition:
+                job.status = 'error'
+                job.error = payload
+                job.http_status = status
+                job.finished_at = time.time()
+                job.emit('error', {'error': payload, 'http_status': status})
+            return
+
+        with job.condition:
+            job.status = 'done'
+            job.result = result
+            job.finished_at = time.time()
+            job.emit('done', {'result': result})
+
+    def _cleanup(self):
+        """Удаляет завершенные задачи старше ttl"""
+        now = time.time()
+        with self.lock:
+            expired = [
+                job_id for job_id, job in self.jobs.items()
+                if job.finished and job.finished_at and now - job.finished_at > self.ttl
+            ]
+            for job_id in expired:
+                del self.jobs[job_id]
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    payload = json.dumps(event, ensure_ascii=False, default=str)
+    return f"id: {event['seq']}\nevent: {event['type']}\ndata: {payload}\n\n"
+
+
+job_manager = JobManager()
@@ -1,14 +1,14 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-import requests
 import os
+import copy
 import json
 import time
 import re
 from datetime import datetime
 from dotenv import load_dotenv
 from ai_service import ai_service  
-from patient_manager import patient_manager
+from patient_manager import patient_manager, VersionConflict
 import PyPDF2
 from docx import Document
 import io
@@ -16,6 +16,19 @@ from scoring import scorer
 from metrics_collector import metrics_collector
 from mammogram_model import get_mammogram_model
 from knowledge_base_loader import kb_loader
+from guideline_corpus import guideline_corpus
+from stage_executor import StageExecutor, stage_pool
+from deepseek_client import (
+    deepseek_client, DeepSeekError, DeepSeekTimeout, DeepSeekConnectionError,
+    DeepSeekUnavailable, DeepSeekDeadlineExceeded
+)
+from deadline import Deadline, REQUEST_DEADLINE, JOB_DEADLINE, current_deadline, use_deadline, run_with_deadline, note_degraded
+from completion_cache import completion_cache
+from analysis_jobs import JobQueueFull, job_manager
+from unified_extraction import unified_extractor
+from cancer_classifier import cancer_classifier
+from stream_json import IncrementalJSONParser
+import batch_scoring
 from typing import Dict, List, Any, Optional
 
 
@@ -30,7 +43,6 @@ app = Flask(__name__)
 CORS(app, origins=["http://localhost:5173", "http://127.0.0.1:5173"])
 
 DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
-DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 
 print("🟢 Инициализация модели маммограмм...")
 try:
@@ -100,6 +112,13 @@ SYSTEM_PROMPTS = {
 4. Для пациента - простой язык, без сложных терминов"""
 }
 
+# Потоковый ответ основного анализа для фоновых задач (DEEPSEEK_STREAM=0 - ждать ответ целиком)
+STREAM_ANALYSIS = os.getenv('DEEPSEEK_STREAM', '1') == '1'
+STREAMED_ANALYSIS_PATHS = [('doctor_version', 'findings', '*'), ('patient_version', '*')]
+
+# Через сколько секунд клиенту повторить постановку задачи, если очередь заполнена
+JOB_RETRY_AFTER = int(os.getenv('ANALYSIS_JOB_RETRY_AFTER', '10'))
+
 def anonymize_text(text):
     """
     Заменяет потенциальные персональные данные на заглушки
@@ -253,28 +272,542 @@ def create_fallback_response(error_message="Ошибка обработки"):
     }
 
 
+TREATMENT_ANSWERS = {
+    'Трастузумаб-эмтансин (T-DM1)': ['трастузумаб-эмтансин', 'трастузумаб', 'т-дм1'],
+    'Трастузумаб дерукстекан': ['трастузумаб дерукстекан', 'энхерту'],
+    'Комбинация трастузумаба с химиотерапией': ['трастузумаб', 'паклитаксел', 'доцетаксел'],
+    'Иммунотерапия (ингибиторы PD-1/PD-L1)': ['пембролизумаб', 'ниволумаб', 'атезолизумаб'],
+    'Другая таргетная терапия': ['тукатиниб', 'лапатиниб', 'нератиниб'],
+    'Химиотерапия без таргетных препаратов': ['паклитаксел', 'доцетаксел', 'гемцитабин'],
+    'Наблюдение (без лечения)': []
+}
+
+# ответы на эти вопросы влияют на score; первые два задают планируемое лечение
+SCORE_IMPACTING_KEYS = ['planned_treatment', 'her2_therapy_type', 't790m_status', 'ihc_markers', 'pd_l1_cps']
+PLANNED_TREATMENT_KEYS = ('planned_treatment', 'her2_therapy_type')
+
+
 def extract_treatments_from_answer(answer: str) -> List[str]:
     """
     Извлекает препараты из ответа пользователя на вопрос о планируемом лечении
     """
-    treatments = []
-    
-    treatment_mapping = {
-        'Трастузумаб-эмтансин (T-DM1)': ['трастузумаб-эмтансин', 'трастузумаб', 'т-дм1'],
-        'Трастузумаб дерукстекан': ['трастузумаб дерукстекан', 'энхерту'],
-        'Комбинация трастузумаба с химиотерапией': ['трастузумаб', 'паклитаксел', 'доцетаксел'],
-        'Иммунотерапия (ингибиторы PD-1/PD-L1)': ['пембролизумаб', 'ниволумаб', 'атезолизумаб'],
-        'Другая таргетная терапия': ['тукатиниб', 'лапатиниб', 'нератиниб'],
-        'Химиотерапия без таргетных препаратов': ['паклитаксел', 'доцетаксел', 'гемцитабин'],
-        'Наблюдение (без лечения)': []
-    }
-    
-    if answer in treatment_mapping:
-        treatments = treatment_mapping[answer]
-    
+    return list(TREATMENT_ANSWERS.get(answer, []))
+
+
+def treatments_from_answer(answer: Any) -> List[str]:
+    """
+    Препараты планируемого лечения из ответа: сначала варианты вопроса, затем
+    словарь препаратов, и только если в ответе ничего не нашлось - LLM
+    """
+    if answer in TREATMENT_ANSWERS:
+        return extract_treatments_from_answer(answer)
+
+    treatments = ai_service._extract_treatments_fallback(str(answer))
+    if not treatments:
+        treatments = ai_service.extract_treatments_with_ai(str(answer))
     return treatments
 
 
+def reuse_previous_analysis(old_analysis: Dict[str, Any], old_score_result: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Текст предыдущего анализа для обновления, в котором поменялись только лечение
+    и биомаркеры: повторный запрос анализа к DeepSeek не нужен. Сообщение о score,
+    дописанное к summary при обогащении, убирается - его допишет новое обогащение
+    """
+    ai_response = copy.deepcopy(old_analysis)
+    doctor = ai_response.get('doctor_version') or {}
+    message = (old_score_result or {}).get('message')
+    summary = doctor.get('summary')
+    if message and isinstance(summary, str) and summary.endswith(f" {message}"):
+        doctor['summary'] = summary[:-len(message) - 1]
+    return ai_response
+
+
+def rescore_after_answers(cancer_type: str, answers: Dict[str, Any], enhanced_history: str,
+                          old_analysis: Dict[str, Any], old_treatment_lines: Dict[str, Any],
+                          old_score_result: Dict[str, Any]):
+    """
+    Дельта-пересчет score по ответам: планируемое лечение заменяется в сохраненных
+    линиях, биомаркеры извлекаются заново из дополненной истории, а scorer.rescore
+    оценивает только затронутые линии.
+    Возвращает (score_result, treatment_lines, пересчитан ли score)
+    """
+    treatment_lines = {
+        'lines': old_treatment_lines.get('lines') or [],
+        'planned': old_treatment_lines.get('planned')
+    }
+    for key, value in answers.items():
+        if key in PLANNED_TREATMENT_KEYS:
+            treatments = treatments_from_answer(value)
+            print(f"💊 Планируемое лечение из ответа '{key}': {treatments}")
+            treatment_lines['planned'] = dict(treatment_lines['planned'] or {}, treatments=treatments) if treatments else None
+
+    old_biomarkers = ai_service.extract_biomarkers(old_analysis.get('original_history', ''))
+    biomarkers = ai_service.extract_biomarkers(enhanced_history)
+
+    if treatment_lines['planned'] == old_treatment_lines.get('planned') and biomarkers == old_biomarkers:
+        print("ℹ️ Ответы не меняют лечение и биомаркеры, сохраняем существующий расчет")
+        return old_score_result, old_treatment_lines, False
+
+    score_result = scorer.rescore(
+        cancer_type=cancer_type,
+        treatment_lines=treatment_lines,
+        biomarkers=biomarkers,
+        previous_lines=old_treatment_lines,
+        previous_result=old_score_result,
+        previous_biomarkers=old_biomarkers
+    )
+    return score_result, treatment_lines, True
+
+
+def partial_json_feeder(parser: IncrementalJSONParser, on_partial):
+    """on_delta для deepseek_client.complete: разбирает фрагменты ответа и передает готовые значения"""
+    def on_delta(text):
+        for path, value in parser.feed(text):
+            on_partial(path, value)
+
+    return on_delta
+
+
+def request_analysis(history: str, on_partial=None):
+    """
+    Основной запрос анализа к DeepSeek,
+    возвращает (ai_response, parse_success, from_cache).
+    on_partial(path, value) включает потоковый ответ: каждая находка
+    doctor_version.findings и каждое поле patient_version передаются,
+    как только модель их дописала
+    """
+    on_delta = (
+        partial_json_feeder(IncrementalJSONParser(STREAMED_ANALYSIS_PATHS), on_partial)
+        if on_partial is not None and STREAM_ANALYSIS else None
+    )
+
+    print(f"📤 Отправка запроса к DeepSeek{' (потоковый ответ)' if on_delta else ''}...")
+    try:
+        completion = deepseek_client.complete(
+            system=SYSTEM_PROMPTS['analysis'],
+            user=history,
+            max_tokens=2000,
+            json_mode=True,
+            timeout=60,
+            use_cache=True,
+            on_delta=on_delta
+        )
+    except (DeepSeekUnavailable, DeepSeekDeadlineExceeded) as e:
+        # Предохранитель разомкнут или исчерпан дедлайн запроса: score считается
+        # по базе Минздрава, вместо текста анализа - заглушка
+        print(f"⛔ {e}")
+        note_degraded('analysis', e)
+        reason = "сервис AI временно недоступен" if isinstance(e, DeepSeekUnavailable) else "истекло время ожидания ответа"
+        return create_fallback_response(reason), False, False
+    content = completion.content
+    print(f"📄 Получен ответ, длина: {len(content)} символов{' (из кэша)' if completion.from_cache else ''}")
+
+    ai_response, parse_success = safe_parse_ai_response(content)
+    if not parse_success:
+        deepseek_client.invalidate(completion)
+
+    return ai_response, parse_success, completion.from_cache
+
+
+def analysis_stream_reporter(progress):
+    """
+    on_partial для request_analysis в фоновой задаче: каждая новая находка и
+    каждое поле patient_version уходят подписчикам SSE отдельным событием
+    partial {path, value} до того, как DeepSeek закончит ответ; накопленные
+    ai_findings и patient_version собираются в partial самой задачи
+    """
+    def on_partial(path, value):
+        if path[0] == 'doctor_version':
+            report_delta(progress, 5, ('ai_findings', path[2]), value)
+        else:
+            report_delta(progress, 5, ('patient_version', path[1]), value)
+
+    return on_partial
+
+
+def simplify_for_patient(ai_response: dict, cancer_type: str, score_result: dict) -> dict:
+    """Переписывает patient_version простым языком (дополнительный запрос к DeepSeek)"""
+    try:
+
+        doctor_version = ai_response.get('doctor_version', {})
+        findings = doctor_version.get('findings', [])
+
+        simple_findings = []
+        for f in findings:
+            status = f.get('status', '')
+            treatment = f.get('prescribed', f.get('treatment', ''))
+            if status == 'correct':
+                simple_findings.append(f"✅ {treatment} - правильно")
+            elif status == 'warning':
+                simple_findings.append(f"⚠️ {treatment} - нужен контроль")
+            elif status == 'critical':
+                simple_findings.append(f"❌ {treatment} - ошибка")
+
+        current_patient = ai_response.get('patient_version', {})
+
+        simplify_prompt = f"""Ты - онколог, но объясняешь сложные вещи простым языком для пациента.
+
+Диагноз: {cancer_type}
+Общий результат: {score_result['score']}% соответствия стандартам
+
+Что важно знать:
+{chr(10).join(simple_findings[:5]) if simple_findings else 'Лечение в целом соответствует стандартам'}
+
+ПЕРЕПИШИ ЭТО ОЧЕНЬ ПРОСТО:
+
+1. summary: Напиши 1-2 предложения самым простым языком.
+2. key_points: Список из 3-5 самых важных моментов.
+3. questions_for_doctor: Список простых вопросов.
+
+Верни ТОЛЬКО JSON.
+"""
+
+        print("📤 Запрос на упрощение...")
+        simplify_content = deepseek_client.chat(
+            system="Ты - врач, который объясняет сложные вещи простым языком. Отвечаешь только JSON.",
+            user=simplify_prompt,
+            max_tokens=500,
+            json_mode=True,
+            timeout=30
+        )
+
+        if simplify_content:
+            simplified = json.loads(simplify_content)
+
+            if 'patient_version' not in ai_response:
+                ai_response['patient_version'] = {}
+
+            ai_response['patient_version']['summary'] = simplified.get('summary', current_patient.get('summary', 'Анализ завершен'))
+            ai_response['patient_version']['key_points'] = simplified.get('key_points', current_patient.get('key_points', []))
+            ai_response['patient_version']['questions_for_doctor'] = simplified.get('questions_for_doctor', current_patient.get('questions_for_doctor', []))
+            ai_response['patient_version']['status'] = '📋'
+
+            print("✅ Ответ упрощен для пациента")
+
+    except DeepSeekError as e:
+        print(f"⚠️ Ошибка упрощения: {e}")
+        note_degraded('simplify', e)
+
+    except Exception as e:
+        print(f"⚠️ Ошибка при упрощении: {e}")
+        import traceback
+        traceback.print_exc()
+        if 'patient_version' not in ai_response:
+            ai_response['patient_version'] = {
+                'summary': 'Анализ завершен',
+                'status': '📋',
+                'key_points': ['Лечение проверено'],
+                'questions_for_doctor': ['Задайте вопросы врачу']
+            }
+
+    return ai_response
+
+
+def add_unified_stages(stages: StageExecutor, history: str, on_analysis_partial=None):
+    """
+    Режим UNIFIED_EXTRACTION=1: анализ, тип рака, линии и препараты берутся из
+    одного запроса (этап 'unified'). Этап уходит в прежний специализированный
+    промпт, только если его раздела нет в ответе или он не прошел схему
+    """
+    stages.add('unified', lambda: unified_extractor.extract(history))
+
+    def analysis(unified):
+        if 'analysis' in unified:
+            return unified['analysis'], True, unified['_from_cache']
+        return request_analysis(history, on_analysis_partial)
+
+    def cancer_type(unified):
+        return unified.get('cancer_type') or ai_service.detect_cancer_type(history)
+
+    def treatment_lines(unified):
+        if 'treatment_lines' in unified:
+            return dict({'planned': None}, **unified['treatment_lines'])
+        return ai_service.extract_treatment_lines(history)
+
+    def prescribed(unified):
+        if 'prescribed' in unified:
+            treatments = [t.strip().lower() for t in unified['prescribed'] if t.strip()]
+            return treatments or ai_service._extract_treatments_fallback(history)
+        return ai_service.extract_treatments_with_ai(history)
+
+    stages.add('analysis', analysis, deps=('unified',))
+    stages.add('cancer_type', cancer_type, deps=('unified',))
+    stages.add('treatment_lines', treatment_lines, deps=('unified',))
+    stages.add('prescribed', prescribed, deps=('unified',))
+
+
+def missing_info_stage(history: str, cancer_type: str, prescribed: List[str], biomarkers: Dict[str, Any],
+                       unified: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """missing_info из единого запроса, если раздел есть, иначе отдельным промптом ({} - информации достаточно)"""
+    if unified and 'missing_info' in unified:
+        return ai_service.normalize_missing_info(unified['missing_info']) or {}
+
+    return ai_service._check_missing_info_with_ai(
+        history,
+        cancer_type,
+        {},
+        is_update=False,
+        prescribed_treatments=prescribed,
+        biomarkers=biomarkers
+    ) or {}
+
+
+def build_analysis_stages(history: str, simplify: bool = True, on_analysis_partial=None) -> StageExecutor:
+    """
+    Описывает граф этапов анализа. Независимые вызовы DeepSeek (анализ, тип рака,
+    линии терапии, препараты) стартуют сразу; скоринг и missing_info ждут только
+    те результаты, которые им нужны. on_analysis_partial - см. request_analysis.
+    """
+    stages = StageExecutor(stage_pool)
+
+    stages.add('biomarkers', lambda: ai_service.extract_biomarkers(history))
+
+    if unified_extractor.enabled:
+        add_unified_stages(stages, history, on_analysis_partial)
+    else:
+        stages.add('analysis', lambda: request_analysis(history, on_analysis_partial))
+        stages.add('cancer_type', lambda: ai_service.detect_cancer_type(history))
+        stages.add('treatment_lines', lambda: ai_service.extract_treatment_lines(history))
+        stages.add('prescribed', lambda: ai_service.extract_treatments_with_ai(history))
+
+    stages.add(
+        'score',
+        lambda cancer_type, treatment_lines, biomarkers: scorer.calculate_score_from_protocols(
+            cancer_type=cancer_type,
+            treatment_lines=treatment_lines,
+            biomarkers=biomarkers
+        ),
+        deps=('cancer_type', 'treatment_lines', 'biomarkers')
+    )
+
+    if unified_extractor.enabled:
+        stages.add(
+            'missing_info',
+            lambda cancer_type, prescribed, biomarkers, unified: missing_info_stage(
+                history, cancer_type, prescribed, biomarkers, unified
+            ),
+            deps=('cancer_type', 'prescribed', 'biomarkers', 'unified')
+        )
+    else:
+        stages.add(
+            'missing_info',
+            lambda cancer_type, prescribed, biomarkers: missing_info_stage(history, cancer_type, prescribed, biomarkers),
+            deps=('cancer_type', 'prescribed', 'biomarkers')
+        )
+
+    if simplify:
+        stages.add(
+            'simplify',
+            lambda analysis, cancer_type, score: simplify_for_patient(analysis[0], cancer_type, score),
+            deps=('analysis', 'cancer_type', 'score')
+        )
+
+    return stages
+
+
+def report_step(progress, step: int, message: str, **partial):
+    """Печатает границу шага и сообщает о ней подписчику (фоновой задаче)"""
+    print(message)
+    if progress is not None:
+        progress(step, message, **partial)
+
+
+def report_partial(progress, step: int, **partial):
+    """Сообщает промежуточный результат, как только он готов"""
+    if progress is not None:
+        progress(step, **partial)
+
+
+def report_delta(progress, step: int, path: tuple, value):
+    """Сообщает один новый элемент накапливаемого результата (см. JobManager.submit)"""
+    if progress is not None:
+        progress(step, delta=(path, value))
+
+
+def combine_history_with_files(history: str, files: List[tuple]) -> str:
+    """Добавляет к истории текст, извлеченный из файлов [(filename, bytes), ...]"""
+    extracted_text = history
+    if files:
+        extracted_text += "\n\n--- ИЗВЛЕЧЕННЫЙ ТЕКСТ ИЗ ФАЙЛОВ ---\n"
+
+    for filename, file_bytes in files:
+        text = extract_text_from_file(file_bytes, filename)
+        if text:
+            extracted_text += f"\n[{filename}]\n{text}\n"
+
+    return extracted_text
+
+
+def run_check_pipeline(history: str, patient_id: Optional[str] = None, progress=None,
+                       simplify: bool = True, start_time: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Полный пайплайн проверки лечения (шаги 1-14). Используется и синхронными
+    эндпоинтами, и фоновыми задачами; progress(step, message=None, **partial)
+    получает границы шагов и промежуточные результаты. Ошибки пробрасываются
+    наружу, превратить их в ответ помогает pipeline_error_response.
+    Дедлайн задает маршрут (use_deadline); этапы, ушедшие из-за него или
+    недоступности DeepSeek в локальные fallback, перечислены в degraded_stages.
+    """
+    if start_time is None:
+        start_time = time.time()
+    deadline = current_deadline()
+
+    report_step(progress, 1, "📥 ШАГ 1: Получение данных запроса")
+    print(f"📝 История получена, длина: {len(history)} символов")
+    print(f"🆔 Patient ID: {patient_id}")
+
+    report_step(progress, 2, "🔄 ШАГ 2: Анонимизация данных")
+    history = anonymize_text(history)
+
+    report_step(progress, 3, "👤 ШАГ 3: Работа с пациентом")
+    if not patient_id:
+        patient_id = patient_manager.create_patient()
+        print(f"✅ Создан новый пациент: {patient_id}")
+    else:
+        patient = patient_manager.get_patient(patient_id)
+        if not patient:
+            patient_id = patient_manager.create_patient_with_id(patient_id)
+            print(f"✅ Создан пациент с ID: {patient_id}")
+        else:
+            print(f"✅ Найден пациент: {patient_id}")
+    report_partial(progress, 3, patient_id=patient_id)
+
+    report_step(progress, 4, "🤖 ШАГ 4: Запрос к DeepSeek API (этапы анализа запускаются параллельно)")
+    on_analysis_partial = analysis_stream_reporter(progress) if progress is not None else None
+    stages = build_analysis_stages(history, simplify=simplify, on_analysis_partial=on_analysis_partial).start()
+
+    report_step(progress, 5, "🔧 ШАГ 5: Парсинг JSON ответа")
+    ai_response, parse_success, from_cache = stages.result('analysis')
+    print(f"✅ Парсинг успешен: {parse_success}")
+    report_partial(progress, 5, parse_success=parse_success, from_cache=from_cache)
+
+    report_step(progress, 6, "🔍 ШАГ 6: Определение типа рака")
+    cancer_type = stages.result('cancer_type')
+    print(f"📊 Тип рака: {cancer_type}")
+    report_partial(progress, 6, cancer_type=cancer_type)
+
+    report_step(progress, 7, "🧬 ШАГ 7: Извлечение биомаркеров")
+    biomarkers = stages.result('biomarkers')
+    print(f"📊 Биомаркеры: {biomarkers}")
+    report_partial(progress, 7, biomarkers=biomarkers)
+
+    report_step(progress, 8, "📋 ШАГ 8: Извлечение линий терапии")
+    treatment_lines = stages.result('treatment_lines')
+    print(f"✅ Найдено линий: {len(treatment_lines.get('lines', []))}")
+    report_partial(progress, 8, lines_found=len(treatment_lines.get('lines', [])))
+
+    report_step(progress, 9, "📊 ШАГ 9: Расчет compliance score")
+    score_result = stages.result('score')
+    print(f"✅ Score: {score_result['score']}%")
+    print(f"📌 Источник: {score_result.get('source', 'unknown')}")
+    report_partial(progress, 9, score=score_result['score'], source=score_result.get('source', 'unknown'))
+
+    if simplify:
+        report_step(progress, 10, "🔄 ШАГ 10: Упрощение ответа для пациента")
+        ai_response = stages.result('simplify')
+    else:
+        report_step(progress, 10, "⏭️ ШАГ 10: Упрощение ответа пропущено")
+    missing_info = stages.result('missing_info')
+
+    report_step(progress, 11, "📦 ШАГ 11: Обогащение ответа из базы знаний")
+    enhanced_response = ai_service.enhance_response_with_guidelines(
+        patient_history=history,
+        ai_response=ai_response,
+        cancer_type=cancer_type,
+        is_update=False,
+        precomputed_score=score_result,
+        treatment_lines=treatment_lines,
+        precomputed_missing_info=missing_info
+    )
+
+    report_step(progress, 12, "📊 ШАГ 12: Запись метрик")
+    try:
+        response_time = time.time() - start_time
+        metrics_collector.record_analysis(
+            cancer_type=cancer_type,
+            compliance_score=score_result['score'],
+            response_time=response_time,
+            from_cache=from_cache,
+            source=score_result.get('source', 'unknown')
+        )
+    except Exception as e:
+        print(f"⚠️ Ошибка записи метрик: {e}")
+
+    report_step(progress, 13, "💾 ШАГ 13: Сохранение в историю пациента")
+    patient_manager.add_history_entry(patient_id, history, enhanced_response)
+
+    degraded_stages = deadline.degraded_stages() if deadline is not None else {}
+    if degraded_stages:
+        print(f"⚠️ Этапы в упрощенном режиме: {degraded_stages}")
+
+    report_step(progress, 14, "📨 ШАГ 14: Формирование ответа клиенту")
+    return {
+        'success': True,
+        'result': enhanced_response,
+        'patient_id': patient_id,
+        'analysis_details': {
+            'cancer_type': cancer_type,
+            'lines_found': len(treatment_lines.get('lines', [])),
+            'score': score_result['score'],
+            'source': score_result.get('source', 'unknown'),
+            'protocols_available': len(scorer.protocols_db.get(cancer_type, [])),
+            'analysis_time': round(time.time() - start_time, 2),
+            'stage_timings': stages.get_timings(),
+            'deadline': deadline.seconds if deadline is not None else None,
+            'degraded_stages': degraded_stages
+        }
+    }
+
+
+def pipeline_error_response(e: Exception):
+    """Превращает ошибку пайплайна в (тело ответа, HTTP статус)"""
+    if isinstance(e, DeepSeekTimeout):
+        print(f"❌ Timeout: {e}")
+        return {'error': 'Сервер AI не отвечает. Попробуйте позже.'}, 504
+
+    if isinstance(e, DeepSeekUnavailable):
+        print(f"⛔ {e}")
+        return {'error': 'Сервер AI временно недоступен. Попробуйте позже.'}, 503
+
+    if isinstance(e, DeepSeekConnectionError):
+        print(f"❌ Connection error: {e}")
+        return {'error': 'Ошибка соединения с сервером AI'}, 503
+
+    if isinstance(e, DeepSeekError):
+        print(f"❌ {e}")
+        return {'error': str(e)}, 500
+
+    print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: {str(e)}")
+    import traceback
+    traceback.print_exception(type(e), e, e.__traceback__)
+
+    error_msg = str(e)
+    if 'detect_cancer_type' in error_msg:
+        step = 'определение типа рака'
+    elif 'extract_biomarkers' in error_msg:
+        step = 'извлечение биомаркеров'
+    elif 'extract_treatment_lines' in error_msg:
+        step = 'извлечение линий терапии'
+    elif 'calculate_score_from_protocols' in error_msg:
+        step = 'расчет score'
+    elif 'enhance_response_with_guidelines' in error_msg:
+        step = 'обогащение ответа'
+    else:
+        step = 'неизвестный'
+
+    return {
+        'success': False,
+        'error': f'Ошибка на шаге: {step}',
+        'details': str(e),
+        'fallback': {
+            'message': 'Произошла ошибка при анализе. Пожалуйста, попробуйте еще раз.',
+            'cancer_type': 'unknown',
+            'compliance_score': 50
+        }
+    }, 500
+
+
 print("🟢 Инициализация модели маммограмм...")
 try:
     try:
@@ -377,24 +910,15 @@ def delete_history_entry(patient_id, entry_id):
     try:
         print(f"\n🗑️ ЗАПРОС НА УДАЛЕНИЕ: Patient {patient_id}, Entry {entry_id}")
         
-        patient = patient_manager.get_patient(patient_id)
-        if not patient:
-            return jsonify({'error': 'Пациент не найден'}), 404
-        
-        original_length = len(patient.get('history', []))
-        patient['history'] = [h for h in patient.get('history', []) if h.get('id') != entry_id]
-        new_length = len(patient.get('history', []))
-        
-        if original_length == new_length:
-            return jsonify({'error': 'Запись не найдена'}), 404
-        
-        patient_manager._save_patients()
+        success, message = patient_manager.delete_history_entry(patient_id, entry_id)
+        if not success:
+            return jsonify({'error': message}), 404
         
         return jsonify({
             'success': True,
             'message': 'Запись удалена',
             'deleted_id': entry_id,
-            'new_count': new_length
+            'new_count': patient_manager.count_history(patient_id)
         })
         
     except Exception as e:
@@ -414,15 +938,10 @@ def clear_patient_history(patient_id):
     try:
         print(f"🧹 Очистка всей истории пациента {patient_id}")
         
-        patient = patient_manager.get_patient(patient_id)
-        if not patient:
-            return jsonify({'error': 'Пациент не найден'}), 404
-        
-        old_count = len(patient.get('history', []))
-        patient['history'] = []
-        patient['timeline'] = []
-        
-        patient_manager._save_patients()
+        old_count = patient_manager.count_history(patient_id)
+        success, message = patient_manager.clear_patient_history(patient_id)
+        if not success:
+            return jsonify({'error': message}), 404
         
         return jsonify({
             'success': True,
@@ -475,6 +994,15 @@ def get_metrics():
                 }
             }
         
+        metrics.setdefault('cache', {}).update(completion_cache.stats())
+        metrics['jobs'] = job_manager.stats()
+        metrics['knowledge_base'] = guideline_corpus.stats.to_dict()
+        metrics['drug_matching'] = scorer.canonical.stats()
+        metrics['score_memo'] = scorer.memo.stats()
+        metrics['unified_extraction'] = unified_extractor.stats()
+        metrics['deepseek'] = deepseek_client.stats()
+        metrics['cancer_classifier'] = cancer_classifier.stats()
+        
         return jsonify({'success': True, 'metrics': metrics})
         
     except Exception as e:
@@ -482,10 +1010,22 @@ def get_metrics():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+def read_page_args():
+    """Параметры пагинации ?limit=N&after=<cursor>; без limit отдается весь список"""
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, 500))
+    return limit, request.args.get('after') or None
+
+
 @app.route('/api/patients', methods=['GET'])
 def get_patients():
-    patients_list = patient_manager.get_all_patients()
-    return jsonify({"patients": patients_list})
+    limit, after = read_page_args()
+    try:
+        page = patient_manager.list_patients(limit=limit, after=after)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(page)
 
 
 @app.route('/api/patients/create', methods=['POST'])
@@ -511,8 +1051,12 @@ def create_patient():
 @app.route('/api/patients/search', methods=['GET'])
 def search_patients():
     query = request.args.get('q', '')
-    results = patient_manager.search_patients(query)
-    return jsonify({'results': results})
+    limit, after = read_page_args()
+    try:
+        page = patient_manager.find_patients(query, limit=limit, after=after)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(page)
 
 
 @app.route('/api/patient/<patient_id>', methods=['GET'])
@@ -529,12 +1073,39 @@ def get_patient(patient_id):
         "diagnosis": patient.get("diagnosis", ""),
         "last_visit": patient.get("last_visit", ""),
         "created_at": patient.get("created_at", ""),
-        "history_count": len(patient.get("history", []))
+        "history_count": len(patient.get("history", [])),
+        "version": patient.get("version")
     }
     
     return jsonify({"patient": patient_info})
 
 
+@app.route('/api/patient/<patient_id>', methods=['PATCH'])
+def update_patient(patient_id):
+    """
+    Обновляет карточку пациента. Если передан version (из GET /api/patient/<id>),
+    а запись успели изменить, возвращает 409 вместо перезаписи чужих изменений
+    """
+    try:
+        data = request.get_json() or {}
+        expected_version = data.pop('version', None)
+        
+        new_version = patient_manager.update_patient(patient_id, expected_version=expected_version, **data)
+        if new_version is None:
+            return jsonify({'error': 'Пациент не найден'}), 404
+        
+        return jsonify({'success': True, 'version': new_version})
+        
+    except VersionConflict as e:
+        return jsonify({
+            'error': 'Карточка пациента была изменена, обновите данные',
+            'version': e.actual_version
+        }), 409
+    except Exception as e:
+        print(f"❌ Ошибка при обновлении пациента: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/patient/<patient_id>/history', methods=['GET'])
 def get_patient_history(patient_id):
     patient = patient_manager.get_patient(patient_id)
@@ -546,19 +1117,24 @@ def get_patient_history(patient_id):
     return jsonify({"history": history})
 
 
+@app.route('/api/patient/<patient_id>/history/<entry_id>', methods=['GET'])
+def get_history_entry(patient_id, entry_id):
+    """Одна запись истории с полным результатом анализа (загружается по требованию)"""
+    entry = patient_manager.get_history_entry(patient_id, entry_id)
+    if not entry:
+        return jsonify({'error': 'Запись не найдена'}), 404
+    
+    return jsonify({'entry': entry})
+
+
 @app.route('/api/patient/<patient_id>', methods=['DELETE'])
 def delete_patient(patient_id):
     try:
-        patient = patient_manager.get_patient(patient_id)
-        if not patient:
-            return jsonify({'error': 'Пациент не найден'}), 404
+        success, message = patient_manager.delete_patient(patient_id)
+        if not success:
+            return jsonify({'error': message}), 404
         
-        if patient_id in patient_manager.patients:
-            del patient_manager.patients[patient_id]
-            patient_manager._save_patients()
-            return jsonify({'success': True, 'message': 'Пациент удален'})
-        else:
-            return jsonify({'error': 'Пациент не найден'}), 404
+        return jsonify({'success': True, 'message': message})
             
     except Exception as e:
         print(f"❌ Ошибка при удалении пациента: {e}")
@@ -576,6 +1152,14 @@ def update_analysis():
     
     start_time = time.time()
     
+    with use_deadline(Deadline(REQUEST_DEADLINE)):
+        return run_update_analysis(start_time)
+
+
+def run_update_analysis(start_time: float):
+    """Тело /api/update-analysis, выполняется внутри дедлайна запроса"""
+    deadline = current_deadline()
+    
     try:
         data = request.json
         patient_id = data.get('patientId')
@@ -589,29 +1173,29 @@ def update_analysis():
         impacts_score = False
         new_treatment = None
         
-        score_impacting_keys = ['planned_treatment', 'her2_therapy_type', 't790m_status', 'ihc_markers', 'pd_l1_cps']
-        
         for key, value in answers.items():
-            if key in score_impacting_keys:
+            if key in SCORE_IMPACTING_KEYS:
                 impacts_score = True
-                if key == 'planned_treatment' or key == 'her2_therapy_type':
+                if key in PLANNED_TREATMENT_KEYS:
                     new_treatment = value
                 print(f"⚠️ Найден вопрос, влияющий на score: {key} = {value}")
         
-        patient = patient_manager.get_patient(patient_id)
-        old_analysis = None
+        old_analysis = patient_manager.get_latest_result(patient_id) if patient_id else None
         old_score_result = None
         old_treatment_lines = None 
         
-        if patient and patient.get('history') and len(patient['history']) > 0:
-            old_analysis = patient['history'][-1].get('full_result', {})
-            old_score_result = old_analysis.get('doctor_version', {}).get('compliance_details')
+        if old_analysis:
+            old_doctor = old_analysis.get('doctor_version', {})
+            old_score_result = old_doctor.get('compliance_details')
             
-            old_treatment_lines = old_analysis.get('doctor_version', {}).get('treatment_lines')
+            old_treatment_lines = old_doctor.get('treatment_lines')
             
             if isinstance(old_treatment_lines, list):
                 print(f"⚠️ Обнаружен список вместо словаря, преобразую...")
-                old_treatment_lines = {"lines": old_treatment_lines, "planned": None}
+                old_treatment_lines = {"lines": old_treatment_lines, "planned": old_doctor.get('planned_treatment')}
+            
+            if not cancer_type:
+                cancer_type = old_analysis.get('cancer_type', '')
             
             print(f"📋 Найден предыдущий анализ: score={old_score_result.get('score') if old_score_result else 'N/A'}")
         
@@ -619,35 +1203,31 @@ def update_analysis():
         for key, value in answers.items():
             enhanced_history += f"- {key}: {value}\n"
         
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json"
-        }
+        # Дельта-пайплайн: при наличии предыдущего анализа пересчитываются только
+        # линии, затронутые ответами, а текст анализа запрашивается заново, только
+        # если среди ответов есть что-то кроме лечения и биомаркеров
+        incremental = bool(old_analysis and isinstance(old_treatment_lines, dict) and old_score_result)
+        narrative_changed = any(key not in SCORE_IMPACTING_KEYS for key in answers)
         
-        payload = {
-            "model": "deepseek-chat",
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPTS['analysis']},
-                {"role": "user", "content": enhanced_history}
-            ],
-            "temperature": 0.1,
-            "max_tokens": 2000,
-            "response_format": {"type": "json_object"}
-        }
-        
-        response = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=60)
-        
-        if response.status_code != 200:
-            return jsonify({'error': f'Ошибка DeepSeek: {response.status_code}'}), 500
-        
-        result = response.json()
-        content = result['choices'][0]['message']['content']
-        
-        new_ai_response, parse_success = safe_parse_ai_response(content)
+        if incremental and not narrative_changed:
+            print("⚡ Ответы касаются только лечения и биомаркеров, текст анализа переиспользуется")
+            new_ai_response, from_cache = reuse_previous_analysis(old_analysis, old_score_result), False
+        else:
+            new_ai_response, parse_success, from_cache = request_analysis(enhanced_history)
+        reused_analysis = incremental and not narrative_changed
         
         new_score_result = None
+        new_treatment_lines = old_treatment_lines
+        score_updated = impacts_score
+        
+        if incremental:
+            new_score_result, new_treatment_lines, score_updated = rescore_after_answers(
+                cancer_type, answers, enhanced_history, old_analysis, old_treatment_lines, old_score_result
+            )
+            if score_updated:
+                print(f"✅ Score пересчитан: {new_score_result['score']}%")
         
-        if impacts_score and new_treatment:
+        elif impacts_score and new_treatment:
             print(f"🔄 Пересчитываем score с учетом нового лечения: {new_treatment}")
             
             prescribed_treatments = extract_treatments_from_answer(new_treatment)
@@ -682,7 +1262,7 @@ def update_analysis():
             cancer_type=cancer_type,
             is_update=True,
             precomputed_score=new_score_result,
-            treatment_lines=old_treatment_lines  
+            treatment_lines=new_treatment_lines
         )
         
         if patient_id:
@@ -697,8 +1277,9 @@ def update_analysis():
                 cancer_type=cancer_type,
                 compliance_score=compliance_score,
                 response_time=response_time,
-                from_cache=False,
-                source=source
+                from_cache=from_cache,
+                source=source,
+                reused_analysis=reused_analysis
             )
         except Exception as e:
             print(f"⚠️ Ошибка записи метрик: {e}")
@@ -706,407 +1287,255 @@ def update_analysis():
         return jsonify({
             'success': True,
             'result': enhanced_response,
-            'score_updated': impacts_score
+            'score_updated': score_updated,
+            'incremental': incremental,
+            'reused_analysis': reused_analysis,
+            'degraded_stages': deadline.degraded_stages()
         })
         
-    except requests.exceptions.Timeout:
+    except DeepSeekTimeout:
         return jsonify({'error': 'Сервер AI не отвечает'}), 504
+    except DeepSeekConnectionError:
+        return jsonify({'error': 'Ошибка соединения с сервером AI'}), 503
+    except DeepSeekError as e:
+        return jsonify({'error': str(e)}), 500
     except Exception as e:
         print(f"❌ Ошибка в update_analysis: {e}")
         import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+def options_response(methods: str = 'POST, OPTIONS'):
+    response = jsonify({'status': 'ok'})
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
+    response.headers.add('Access-Control-Allow-Methods', methods)
+    return response, 200
+
+
 @app.route('/api/check-treatment', methods=['POST', 'OPTIONS'])
 def check_treatment():
     if request.method == 'OPTIONS':
-        response = jsonify({'status': 'ok'})
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-        response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        return response, 200
+        return options_response()
     
     start_time = time.time()
     
+    print("\n" + "="*60)
+    print("🔥 ПОЛУЧЕН ЗАПРОС НА /api/check-treatment")
+    print("="*60)
+    
+    data = request.get_json()
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+    
+    history = data.get('history', '')
+    patient_id = data.get('patient_id', None)
+    
+    if not history or history.strip() == "":
+        return jsonify({'error': 'Нет истории болезни'}), 400
+    
     try:
-        print("\n" + "="*60)
-        print("🔥 ПОЛУЧЕН ЗАПРОС НА /api/check-treatment")
-        print("="*60)
-        
-        print("📥 ШАГ 1: Получение данных запроса")
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
-        
-        history = data.get('history', '')
-        patient_id = data.get('patient_id', None)
-        
-        if not history or history.strip() == "":
-            return jsonify({'error': 'Нет истории болезни'}), 400
-        
-        print(f"📝 История получена, длина: {len(history)} символов")
-        print(f"🆔 Patient ID: {patient_id}")
-        
-        print("🔄 ШАГ 2: Анонимизация данных")
-        history = anonymize_text(history)
-        
-        print("👤 ШАГ 3: Работа с пациентом")
-        if not patient_id:
-            patient_id = patient_manager.create_patient()
-            print(f"✅ Создан новый пациент: {patient_id}")
-        else:
-            patient = patient_manager.get_patient(patient_id)
-            if not patient:
-                patient_id = patient_manager.create_patient_with_id(patient_id)
-                print(f"✅ Создан пациент с ID: {patient_id}")
-            else:
-                print(f"✅ Найден пациент: {patient_id}")
-        
-        print("🤖 ШАГ 4: Запрос к DeepSeek API")
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": "deepseek-chat",
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPTS['analysis']},
-                {"role": "user", "content": history}
-            ],
-            "temperature": 0.1,
-            "max_tokens": 2000,
-            "response_format": {"type": "json_object"}
-        }
-        
-        print("📤 Отправка запроса к DeepSeek...")
-        response = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=60)
-        print(f"📥 Статус ответа: {response.status_code}")
-        
-        if response.status_code != 200:
-            print(f"❌ Ошибка DeepSeek: {response.status_code}")
-            return jsonify({'error': f'Ошибка DeepSeek: {response.status_code}'}), 500
-        
-        result = response.json()
-        content = result['choices'][0]['message']['content']
-        print(f"📄 Получен ответ, длина: {len(content)} символов")
-        
-        print("🔧 ШАГ 5: Парсинг JSON ответа")
-        ai_response, parse_success = safe_parse_ai_response(content)
-        print(f"✅ Парсинг успешен: {parse_success}")
-        
-        print("🔍 ШАГ 6: Определение типа рака")
-        cancer_type = ai_service.detect_cancer_type(history)
-        print(f"📊 Тип рака: {cancer_type}")
-        
-        print("🧬 ШАГ 7: Извлечение биомаркеров")
-        biomarkers = ai_service.extract_biomarkers(history)
-        print(f"📊 Биомаркеры: {biomarkers}")
-        
-        print("📋 ШАГ 8: Извлечение линий терапии")
-        treatment_lines = ai_service.extract_treatment_lines(history)
-        print(f"✅ Найдено линий: {len(treatment_lines.get('lines', []))}")
-        
-        print("📊 ШАГ 9: Расчет compliance score")
-        score_result = scorer.calculate_score_from_protocols(
-            cancer_type=cancer_type,
-            treatment_lines=treatment_lines,
-            biomarkers=biomarkers
-        )
-        print(f"✅ Score: {score_result['score']}%")
-        print(f"📌 Источник: {score_result.get('source', 'unknown')}")
-        
-        print("🔄 ШАГ 10: Упрощение ответа для пациента")
-        try:
+        with use_deadline(Deadline(REQUEST_DEADLINE)):
+            return jsonify(run_check_pipeline(history, patient_id, start_time=start_time))
+    except Exception as e:
+        payload, status = pipeline_error_response(e)
+        return jsonify(payload), status
 
-            doctor_version = ai_response.get('doctor_version', {})
-            findings = doctor_version.get('findings', [])
-
-            simple_findings = []
-            for f in findings:
-                status = f.get('status', '')
-                treatment = f.get('prescribed', f.get('treatment', ''))
-                if status == 'correct':
-                    simple_findings.append(f"✅ {treatment} - правильно")
-                elif status == 'warning':
-                    simple_findings.append(f"⚠️ {treatment} - нужен контроль")
-                elif status == 'critical':
-                    simple_findings.append(f"❌ {treatment} - ошибка")
-
-            current_patient = ai_response.get('patient_version', {})
-            
-            simplify_prompt = f"""Ты - онколог, но объясняешь сложные вещи простым языком для пациента.
 
-Диагноз: {cancer_type}
-Общий результат: {score_result['score']}% соответствия стандартам
+def read_files_request():
+    """Разбирает FormData запроса с файлами: (history, patient_id, [(filename, bytes)])"""
+    history = request.form.get('history', '')
+    patient_id = request.form.get('patient_id', None)
+    files = [(file.filename, file.read()) for file in request.files.getlist('files')]
+    return history, patient_id, files
 
-Что важно знать:
-{chr(10).join(simple_findings[:5]) if simple_findings else 'Лечение в целом соответствует стандартам'}
 
-ПЕРЕПИШИ ЭТО ОЧЕНЬ ПРОСТО:
+@app.route('/api/check-treatment-with-files', methods=['POST', 'OPTIONS'])
+def check_treatment_with_files():
+    if request.method == 'OPTIONS':
+        return options_response()
+    
+    start_time = time.time()
+    
+    print("\n" + "="*50)
+    print("🔥 ПОЛУЧЕН ЗАПРОС С ФАЙЛАМИ")
+    print("="*50)
+    
+    history, patient_id, files = read_files_request()
+    
+    if not history and len(files) == 0:
+        return jsonify({'error': 'Нет данных для анализа'}), 400
+    
+    try:
+        extracted_text = combine_history_with_files(history, files)
+        with use_deadline(Deadline(REQUEST_DEADLINE)):
+            return jsonify(run_check_pipeline(extracted_text, patient_id, simplify=False, start_time=start_time))
+    except Exception as e:
+        payload, status = pipeline_error_response(e)
+        return jsonify(payload), status
 
-1. summary: Напиши 1-2 предложения самым простым языком.
-2. key_points: Список из 3-5 самых важных моментов.
-3. questions_for_doctor: Список простых вопросов.
 
-Верни ТОЛЬКО JSON.
-"""
-            
-            simplify_payload = {
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "system", "content": "Ты - врач, который объясняет сложные вещи простым языком. Отвечаешь только JSON."},
-                    {"role": "user", "content": simplify_prompt}
-                ],
-                "temperature": 0.1,
-                "max_tokens": 500,
-                "response_format": {"type": "json_object"}
-            }
-            
-            print("📤 Запрос на упрощение...")
-            simplify_response = requests.post(
-                DEEPSEEK_API_URL, 
-                headers=headers, 
-                json=simplify_payload, 
-                timeout=30
-            )
-            
-            if simplify_response.status_code == 200:
-                simplify_result = simplify_response.json()
-                simplified = json.loads(simplify_result['choices'][0]['message']['content'])
-                
-                if 'patient_version' not in ai_response:
-                    ai_response['patient_version'] = {}
-                
-                ai_response['patient_version']['summary'] = simplified.get('summary', current_patient.get('summary', 'Анализ завершен'))
-                ai_response['patient_version']['key_points'] = simplified.get('key_points', current_patient.get('key_points', []))
-                ai_response['patient_version']['questions_for_doctor'] = simplified.get('questions_for_doctor', current_patient.get('questions_for_doctor', []))
-                ai_response['patient_version']['status'] = '📋'
-                
-                print("✅ Ответ упрощен для пациента")
-            else:
-                print(f"⚠️ Ошибка упрощения: {simplify_response.status_code}")
-                
-        except Exception as e:
-            print(f"⚠️ Ошибка при упрощении: {e}")
-            import traceback
-            traceback.print_exc()
-            if 'patient_version' not in ai_response:
-                ai_response['patient_version'] = {
-                    'summary': 'Анализ завершен',
-                    'status': '📋',
-                    'key_points': ['Лечение проверено'],
-                    'questions_for_doctor': ['Задайте вопросы врачу']
-                }
-        
-        print("📦 ШАГ 11: Обогащение ответа из базы знаний")
-        enhanced_response = ai_service.enhance_response_with_guidelines(
-            patient_history=history,
-            ai_response=ai_response,
-            cancer_type=cancer_type,
-            is_update=False,
-            precomputed_score=score_result,
-            treatment_lines=treatment_lines
+@app.route('/api/jobs/check-treatment', methods=['POST', 'OPTIONS'])
+def submit_check_treatment_job():
+    """
+    То же, что /api/check-treatment, но сразу возвращает job_id (202) или 503,
+    если очередь задач заполнена. Задача живет в памяти принявшего ее процесса:
+    при нескольких процессах сервера нужны sticky-сессии (см. JobManager)
+    """
+    if request.method == 'OPTIONS':
+        return options_response()
+    
+    data = request.get_json()
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+    
+    history = data.get('history', '')
+    patient_id = data.get('patient_id', None)
+    
+    if not history or history.strip() == "":
+        return jsonify({'error': 'Нет истории болезни'}), 400
+    
+    start_time = time.time()
+    try:
+        job = job_manager.submit(
+            'check-treatment',
+            lambda progress: run_with_deadline(
+                Deadline(JOB_DEADLINE), run_check_pipeline,
+                history, patient_id, progress=progress, start_time=start_time
+            ),
+            error_handler=pipeline_error_response
         )
-        
+    except JobQueueFull as e:
+        return job_rejected_response(e)
+    print(f"📥 Задача анализа поставлена в очередь: {job.id}")
+    
+    return job_accepted_response(job)
 
-        print("📊 ШАГ 12: Запись метрик")
-        try:
-            response_time = time.time() - start_time
-            metrics_collector.record_analysis(
-                cancer_type=cancer_type,
-                compliance_score=score_result['score'],
-                response_time=response_time,
-                from_cache=False,
-                source=score_result.get('source', 'unknown')
-            )
-        except Exception as e:
-            print(f"⚠️ Ошибка записи метрик: {e}")
-        
 
-        print("💾 ШАГ 13: Сохранение в историю пациента")
-        patient_manager.add_history_entry(patient_id, history, enhanced_response)
+@app.route('/api/jobs/check-treatment-with-files', methods=['POST', 'OPTIONS'])
+def submit_check_treatment_with_files_job():
+    """То же, что /api/check-treatment-with-files, но в фоновом режиме"""
+    if request.method == 'OPTIONS':
+        return options_response()
+    
+    history, patient_id, files = read_files_request()
+    
+    if not history and len(files) == 0:
+        return jsonify({'error': 'Нет данных для анализа'}), 400
+    
+    start_time = time.time()
+    try:
+        job = job_manager.submit(
+            'check-treatment-with-files',
+            lambda progress: run_with_deadline(
+                Deadline(JOB_DEADLINE), run_check_pipeline,
+                combine_history_with_files(history, files), patient_id,
+                progress=progress, simplify=False, start_time=start_time
+            ),
+            error_handler=pipeline_error_response
+        )
+    except JobQueueFull as e:
+        return job_rejected_response(e)
+    print(f"📥 Задача анализа с файлами поставлена в очередь: {job.id}")
+    
+    return job_accepted_response(job)
+
+
+def job_accepted_response(job):
+    response = jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': f'/api/jobs/{job.id}',
+        'events_url': f'/api/jobs/{job.id}/events'
+    })
+    response.headers['Location'] = f'/api/jobs/{job.id}'
+    return response, 202
+
+
+def job_rejected_response(error: JobQueueFull):
+    """503 с Retry-After: очередь фоновых задач заполнена"""
+    print(f"⛔ {error}")
+    response = jsonify({'error': 'Сервер перегружен, повторите запрос позже'})
+    response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+    return response, 503
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Опрос состояния задачи; ?after=N дополнительно вернет события с номером > N"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    
+    after = request.args.get('after', type=int)
+    return jsonify(job.to_dict(include_events=after is not None, after=after or 0))
 
-        print("📨 ШАГ 14: Формирование ответа клиенту")
-        return jsonify({
-            'success': True,
-            'result': enhanced_response,
-            'patient_id': patient_id,
-            'analysis_details': {
-                'cancer_type': cancer_type,
-                'lines_found': len(treatment_lines.get('lines', [])),
-                'score': score_result['score'],
-                'source': score_result.get('source', 'unknown'),
-                'protocols_available': len(scorer.protocols_db.get(cancer_type, [])),
-                'analysis_time': round(time.time() - start_time, 2)
-            }
-        })
-        
-    except requests.exceptions.Timeout as e:
-        print(f"❌ Timeout: {e}")
-        return jsonify({'error': 'Сервер AI не отвечает. Попробуйте позже.'}), 504
-        
-    except requests.exceptions.ConnectionError as e:
-        print(f"❌ Connection error: {e}")
-        return jsonify({'error': 'Ошибка соединения с сервером AI'}), 503
-        
-    except Exception as e:
-        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        
 
-        error_msg = str(e)
-        if 'detect_cancer_type' in error_msg:
-            step = 'определение типа рака'
-        elif 'extract_biomarkers' in error_msg:
-            step = 'извлечение биомаркеров'
-        elif 'extract_treatment_lines' in error_msg:
-            step = 'извлечение линий терапии'
-        elif 'calculate_score_from_protocols' in error_msg:
-            step = 'расчет score'
-        elif 'enhance_response_with_guidelines' in error_msg:
-            step = 'обогащение ответа'
-        else:
-            step = 'неизвестный'
-        
-        fallback_response = {
-            'success': False,
-            'error': f'Ошибка на шаге: {step}',
-            'details': str(e),
-            'fallback': {
-                'message': 'Произошла ошибка при анализе. Пожалуйста, попробуйте еще раз.',
-                'cancer_type': 'unknown',
-                'compliance_score': 50
-            }
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def get_job_events(job_id):
+    """SSE-поток событий задачи: шаги 1-14, промежуточные результаты и итог"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('after', '0'))
+    try:
+        last_event_id = int(last_event_id)
+    except ValueError:
+        last_event_id = 0
+    
+    return Response(
+        stream_with_context(job_manager.stream(job, last_event_id)),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
         }
-        return jsonify(fallback_response), 500
+    )
 
 
-@app.route('/api/check-treatment-with-files', methods=['POST', 'OPTIONS'])
-def check_treatment_with_files():
+@app.route('/api/batch/score', methods=['POST', 'OPTIONS'])
+def batch_score():
+    """
+    Пакетный пересчет compliance score для ретроспективного аудита.
+    Тело - JSONL: по записи {"id", "cancer_type", "treatment_lines", "biomarkers"}
+    в строке (или JSON-массив таких записей). Ответ - JSONL в том же порядке,
+    строки отдаются по мере готовности. LLM вызывается только с ?use_ai=true
+    """
     if request.method == 'OPTIONS':
-        response = jsonify({'status': 'ok'})
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-        response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        return response, 200
+        return options_response()
     
-    start_time = time.time()
+    use_ai = request.args.get('use_ai', 'false').lower() in ('1', 'true', 'yes')
     
-    try:
-        print("\n" + "="*50)
-        print("🔥 ПОЛУЧЕН ЗАПРОС С ФАЙЛАМИ")
-        print("="*50)
-        
-        history = request.form.get('history', '')
-        patient_id = request.form.get('patient_id', None)
-        files = request.files.getlist('files')
-        
-        if not history and len(files) == 0:
-            return jsonify({'error': 'Нет данных для анализа'}), 400
-        
-        extracted_text = history
-        if files:
-            extracted_text += "\n\n--- ИЗВЛЕЧЕННЫЙ ТЕКСТ ИЗ ФАЙЛОВ ---\n"
-        
-        for file in files:
-            filename = file.filename
-            file_bytes = file.read()
-            text = extract_text_from_file(file_bytes, filename)
-            if text:
-                extracted_text += f"\n[{filename}]\n{text}\n"
-        
-        extracted_text = anonymize_text(extracted_text)
-        
-        if patient_id:
-            patient = patient_manager.get_patient(patient_id)
-            if not patient:
-                patient_id = patient_manager.create_patient_with_id(patient_id)
-        else:
-            patient_id = patient_manager.create_patient()
-        
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": "deepseek-chat",
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPTS['analysis']},
-                {"role": "user", "content": extracted_text}
-            ],
-            "temperature": 0.1,
-            "max_tokens": 2000,
-            "response_format": {"type": "json_object"}
-        }
-        
-        response = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=60)
-        
-        if response.status_code != 200:
-            return jsonify({'error': f'Ошибка DeepSeek: {response.status_code}'}), 500
-        
-        result = response.json()
-        content = result['choices'][0]['message']['content']
-        
-        ai_response, parse_success = safe_parse_ai_response(content)
-
-        cancer_type = ai_service.detect_cancer_type(extracted_text)
-        biomarkers = ai_service.extract_biomarkers(extracted_text)
-        treatment_lines = ai_service.extract_treatment_lines(extracted_text)
-        
-        score_result = scorer.calculate_score_from_protocols(
-            cancer_type=cancer_type,
-            treatment_lines=treatment_lines,
-            biomarkers=biomarkers
-        )
-        
-        enhanced_response = ai_service.enhance_response_with_guidelines(
-            patient_history=extracted_text,
-            ai_response=ai_response,
-            cancer_type=cancer_type,
-            is_update=False,
-            precomputed_score=score_result,
-            treatment_lines=treatment_lines
-        )
-        
-        try:
-            response_time = time.time() - start_time
-            metrics_collector.record_analysis(
-                cancer_type=cancer_type,
-                compliance_score=score_result['score'],
-                response_time=response_time,
-                from_cache=False,
-                source=score_result.get('source', 'unknown')
-            )
-        except Exception as e:
-            print(f"⚠️ Ошибка записи метрик: {e}")
-        
-        success = patient_manager.add_history_entry(patient_id, extracted_text, enhanced_response)
-        
-        return jsonify({
-            'success': True,
-            'result': enhanced_response,
-            'patient_id': patient_id
-        })
-        
-    except Exception as e:
-        print(f"❌ Ошибка: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+    if request.is_json:
+        records = request.get_json(silent=True)
+        if isinstance(records, dict):
+            records = records.get('records')
+        if not isinstance(records, list):
+            return jsonify({'success': False, 'error': 'Ожидается массив записей или JSONL'}), 400
+    else:
+        records = request.get_data(as_text=True).splitlines()
+    
+    pool = batch_scoring.get_pool() if batch_scoring.BATCH_WORKERS > 1 else None
+    print(f"🧮 Пакетный скоринг: {len(records)} строк, AI {'включен' if use_ai else 'отключен'}")
+    
+    return Response(
+        stream_with_context(
+            batch_scoring.to_jsonl(result)
+            for result in batch_scoring.iter_scores(records, use_ai=use_ai, pool=pool)
+        ),
+        mimetype='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no'}
+    )
 
 
 @app.route('/api/clear-history/<patient_id>', methods=['POST'])
 def clear_history(patient_id):
-    patient = patient_manager.get_patient(patient_id)
-    if patient:
-        patient["history"] = []
-        patient["timeline"] = []
-        patient_manager._save_patients()
+    success, message = patient_manager.clear_patient_history(patient_id)
+    if success:
         return jsonify({"success": True, "message": "История очищена"})
-    return jsonify({"error": "Пациент не найден"}), 404
+    return jsonify({"error": message}), 404
 
 
 if __name__ == '__main__':
@@ -1115,10 +1544,11 @@ if __name__ == '__main__':
     print("="*50)
     print(f"🔑 API Key: {DEEPSEEK_API_KEY[:10]}..." if DEEPSEEK_API_KEY else "❌ API Key не найден!")
     print("🤖 AI Service инициализирован")
-    print(f"📁 База пациентов: patients_db.json")
+    print(f"📁 База пациентов: {patient_manager.db_file}")
     print("\n📋 Доступные эндпоинты:")
     print("   - /api/check-treatment (JSON)")
     print("   - /api/check-treatment-with-files (FormData + файлы)")
+    print("   - /api/jobs/check-treatment, /api/jobs/<id>, /api/jobs/<id>/events (фоновый анализ, SSE)")
     print("   - /api/update-analysis")
     print("   - /api/patients")
     print("   - /api/mammogram/analyze")
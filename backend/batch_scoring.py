@@ -0,0 +1,188 @@
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Any, Iterable, Iterator, Optional, Tuple
+
+
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_SCORING_CHUNK_SIZE', '50'))
+BATCH_WORKERS = int(os.getenv('BATCH_SCORING_WORKERS', '0')) or (os.cpu_count() or 1)
+
+
+def parse_record(raw: Any) -> Tuple[str, Dict[str, Any], Dict[str, bool]]:
+    """
+    Разбирает одну запись пакета: {"cancer_type", "treatment_lines", "biomarkers"}.
+    treatment_lines может быть объектом {"lines": [...], "planned": {...}} или
+    просто списком линий
+    """
+    record = json.loads(raw) if isinstance(raw, (str, bytes)) else raw
+    if not isinstance(record, dict):
+        raise ValueError('запись должна быть JSON-объектом')
+
+    cancer_type = record.get('cancer_type')
+    if not cancer_type or not isinstance(cancer_type, str):
+        raise ValueError('не указан cancer_type')
+
+    treatment_lines = record.get('treatment_lines') or {}
+    if isinstance(treatment_lines, list):
+        treatment_lines = {'lines': treatment_lines, 'planned': None}
+    if not isinstance(treatment_lines, dict):
+        raise ValueError('treatment_lines должен быть объектом или списком линий')
+    treatment_lines.setdefault('lines', [])
+
+    biomarkers = record.get('biomarkers') or {}
+    if not isinstance(biomarkers, dict):
+        raise ValueError('biomarkers должен быть объектом')
+
+    return cancer_type, treatment_lines, biomarkers
+
+
+def score_chunk(chunk: List[Tuple[int, Any]], use_ai: bool = False) -> List[Dict[str, Any]]:
+    """
+    Оценивает часть пакета. Каждая запись дает одну строку результата;
+    ошибка в записи не прерывает остальные
+    """
+    from scoring import scorer
+
+    results = []
+    for index, raw in chunk:
+        started = time.time()
+        record_id = None
+        try:
+            if isinstance(raw, (str, bytes)):
+                raw = json.loads(raw)
+            record_id = raw.get('id') if isinstance(raw, dict) else None
+            cancer_type, treatment_lines, biomarkers = parse_record(raw)
+            result = scorer.calculate_score_from_protocols(cancer_type, treatment_lines, biomarkers, use_ai=use_ai)
+            results.append({
+                'index': index,
+                'id': record_id,
+                'success': True,
+                'result': result,
+                'seconds': round(time.time() - started, 4)
+            })
+        except Exception as e:
+            results.append({'index': index, 'id': record_id, 'success': False, 'error': str(e)})
+    return results
+
+
+def _silence_worker():
+    """Инициализатор процесса: логи scorer в пакетном режиме не нужны"""
+    sys.stdout = open(os.devnull, 'w')
+    import scoring  # noqa: F401 - загрузка корпуса и индексов один раз на процесс
+
+
+def create_pool(workers: int) -> ProcessPoolExecutor:
+    # spawn, а не fork: пул создается и внутри многопоточного Flask-процесса
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_silence_worker
+    )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """Общий пул процессов для API (создается при первом пакетном запросе)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            print(f"🧮 Пул пакетного скоринга: {BATCH_WORKERS} процессов")
+            _pool = create_pool(BATCH_WORKERS)
+        return _pool
+
+
+def _chunks(lines: Iterable[Any], size: int) -> Iterator[List[Tuple[int, Any]]]:
+    chunk = []
+    for index, line in enumerate(lines):
+        if isinstance(line, (str, bytes)) and not line.strip():
+            continue
+        chunk.append((index, line))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_scores(lines: Iterable[Any], use_ai: bool = False, pool: Optional[ProcessPoolExecutor] = None,
+                chunk_size: int = None, max_pending: int = None) -> Iterator[Dict[str, Any]]:
+    """
+    Оценивает записи (строки JSONL или словари) и отдает результаты в порядке
+    входа. Без пула - в текущем процессе. С пулом в работе одновременно не
+    больше max_pending частей, так что вход читается по мере выдачи результатов
+    """
+    chunk_size = chunk_size or BATCH_CHUNK_SIZE
+
+    if pool is None:
+        for chunk in _chunks(lines, chunk_size):
+            yield from score_chunk(chunk, use_ai)
+        return
+
+    max_pending = max_pending or max(2, BATCH_WORKERS * 2)
+    pending = deque()
+    try:
+        for chunk in _chunks(lines, chunk_size):
+            pending.append(pool.submit(score_chunk, chunk, use_ai))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        # клиент отключился или генератор закрыт - не начатые части не нужны
+        for future in pending:
+            future.cancel()
+
+
+def to_jsonl(result: Dict[str, Any]) -> str:
+    return json.dumps(result, ensure_ascii=False) + '\n'
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Пакетный пересчет compliance score по базе Минздрава (JSONL -> JSONL)'
+    )
+    parser.add_argument('input', help='JSONL с записями {"id", "cancer_type", "treatment_lines", "biomarkers"}; "-" - stdin')
+    parser.add_argument('-o', '--output', default='-', help='куда писать результаты JSONL (по умолчанию stdout)')
+    parser.add_argument('-w', '--workers', type=int, default=BATCH_WORKERS, help='число процессов (1 - без пула)')
+    parser.add_argument('--chunk-size', type=int, default=BATCH_CHUNK_SIZE, help='записей на одну задачу пула')
+    parser.add_argument('--use-ai', action='store_true',
+                        help='оценивать линии без протокола через LLM (по умолчанию LLM не вызывается)')
+    args = parser.parse_args()
+
+    source = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    target = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+
+    started = time.time()
+    total = failed = 0
+
+    # логи scorer уходят в stderr, stdout остается чистым JSONL
+    with contextlib.redirect_stdout(sys.stderr), source, contextlib.ExitStack() as stack:
+        pool = stack.enter_context(create_pool(args.workers)) if args.workers > 1 else None
+        for result in iter_scores(source, use_ai=args.use_ai, pool=pool, chunk_size=args.chunk_size,
+                                  max_pending=args.workers * 2):
+            target.write(to_jsonl(result))
+            total += 1
+            failed += 0 if result['success'] else 1
+
+    if target is not sys.stdout:
+        target.close()
+
+    elapsed = time.time() - started
+    print(f"✅ Оценено записей: {total}, ошибок: {failed}, {elapsed:.1f} с "
+          f"({total / elapsed if elapsed else 0:.0f} записей/с)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
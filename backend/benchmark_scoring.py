@@ -0,0 +1,118 @@
+
+import io
+import time
+import random
+import argparse
+import contextlib
+from typing import Dict, List, Any
+
+with contextlib.redirect_stdout(io.StringIO()):
+    from drug_recognizer import DRUG_FAMILIES, REGIMENS
+    from scoring import ComplianceScorer
+
+
+def make_lines(protocols: List[dict], count: int, rnd: random.Random) -> List[Dict[str, Any]]:
+    """
+    Случайные линии терапии для типа рака: препараты протоколов, их синонимы,
+    схемы и посторонние назначения, разные номера линий и HER2-статус
+    """
+    pool = sorted({str(m) for p in protocols for m in p.get('medications', [])})
+    synonyms = sorted({member for members in DRUG_FAMILIES.values() for member in members})
+    noise = ['лучевая терапия', 'дексаметазон', 'ондансетрон', 'золедроновая кислота']
+
+    lines = []
+    for _ in range(count):
+        treatments = []
+        for _ in range(rnd.randint(1, 4)):
+            source = rnd.random()
+            if source < 0.5 and pool:
+                treatments.append(rnd.choice(pool))
+            elif source < 0.8:
+                treatments.append(rnd.choice(synonyms))
+            elif source < 0.9:
+                treatments.append(rnd.choice(list(REGIMENS)).upper())
+            else:
+                treatments.append(rnd.choice(noise))
+        lines.append({
+            'line_num': rnd.choice([1, 1, 2, 3, 4, 99]),
+            'treatments': treatments,
+            'biomarkers': {'her2_negative': rnd.random() < 0.3}
+        })
+    return lines
+
+
+def timed(func, lines: List[Dict[str, Any]], repeat: int) -> float:
+    """Среднее время (с) одного прохода func по всем линиям"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            func(line['line_num'], line['treatments'], line['biomarkers'])
+    return (time.perf_counter() - started) / repeat
+
+
+def run(lines_per_type: int, seed: int, repeat: int):
+    with contextlib.redirect_stdout(io.StringIO()):
+        scorer = ComplianceScorer()
+    rnd = random.Random(seed)
+
+    print(f"📚 Типов рака: {len(scorer.protocols_db)}, "
+          f"протоколов: {sum(len(p) for p in scorer.protocols_db.values())}, "
+          f"файлов рекомендаций: {scorer.corpus.stats.files_loaded}; "
+          f"матрицы - для типов от {scorer.matrix_min_protocols} протоколов")
+    print(f"{'тип рака':<26}{'прот.':>6}{'линий':>7}{'индекс, мс':>12}{'матрицы, мс':>13}"
+          f"{'матр./инд.':>12}{'путь':>9}{'выбран, мс':>12}")
+
+    totals = {'index': 0.0, 'matrix': 0.0, 'routed': 0.0}
+    mismatches = 0
+    regressions = []
+
+    for cancer_type, protocols in sorted(scorer.protocols_db.items(), key=lambda x: -len(x[1])):
+        lines = make_lines(protocols, lines_per_type, rnd)
+        paths = {
+            'index': lambda *a: scorer._find_matching_protocol_index(cancer_type, *a),
+            'matrix': lambda *a: scorer._find_matching_protocol_matrix(cancer_type, *a),
+            'routed': lambda *a: scorer._find_matching_protocol(cancer_type, *a)
+        }
+
+        # прогрев: канонические формы попадают в кэш; оба пути сверяются с полным перебором
+        for line in lines:
+            args = (line['line_num'], line['treatments'], line['biomarkers'])
+            expected = scorer._find_matching_protocol_scan(protocols, *args)
+            for func in paths.values():
+                if func(*args) is not expected:
+                    mismatches += 1
+
+        times = {name: timed(func, lines, repeat) for name, func in paths.items()}
+        for name, value in times.items():
+            totals[name] += value
+
+        speedup = times['index'] / times['matrix'] if times['matrix'] else 0
+        routed = 'матрицы' if scorer.protocol_index[cancer_type]['use_matrix'] else 'индекс'
+        if speedup < 1:
+            regressions.append((cancer_type, len(protocols), speedup, routed))
+        print(f"{cancer_type:<26}{len(protocols):>6}{len(lines):>7}{times['index'] * 1000:>12.1f}"
+              f"{times['matrix'] * 1000:>13.1f}{speedup:>11.1f}x{routed:>9}{times['routed'] * 1000:>12.1f}")
+
+    print(f"{'ИТОГО':<39}{totals['index'] * 1000:>12.1f}{totals['matrix'] * 1000:>13.1f}"
+          f"{totals['index'] / totals['matrix'] if totals['matrix'] else 0:>11.1f}x{'':>9}{totals['routed'] * 1000:>12.1f}")
+
+    if regressions:
+        print(f"⚠️ Матрицы медленнее индекса для {len(regressions)} типов:")
+        for cancer_type, count, speedup, routed in regressions:
+            print(f"   {cancer_type} ({count} прот.): {speedup:.1f}x, используется {routed}")
+    print(f"{'✅' if not mismatches else '❌'} Расхождений с полным перебором: {mismatches}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение матричного ранжирования протоколов с кандидатами из инвертированного индекса')
+    parser.add_argument('--lines', type=int, default=200, help='линий терапии на тип рака')
+    parser.add_argument('--repeat', type=int, default=3, help='повторов замера')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    raise SystemExit(1 if run(args.lines, args.seed, args.repeat) else 0)
+
+
+if __name__ == '__main__':
+    main()
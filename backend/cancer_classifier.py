@@ -0,0 +1,532 @@
+
+import os
+import re
+import math
+import time
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Any, Iterable, Optional, Tuple
+
+import numpy as np
+
+from guideline_corpus import GuidelineCorpus, GuidelineDocument, guideline_corpus
+from cancer_vocabulary import CancerVocabulary, cancer_vocabulary
+
+
+# Ниже этой уверенности тип рака определяет LLM
+CLASSIFIER_THRESHOLD = float(os.getenv('CANCER_CLASSIFIER_THRESHOLD', '0.8'))
+
+# Каждый HOLDOUT_EVERY-й фрагмент рекомендаций типа откладывается для калибровки:
+# по ним подбирается температура модели и оценивается точность правил
+HOLDOUT_EVERY = int(os.getenv('CANCER_CLASSIFIER_HOLDOUT_EVERY', '5'))
+# Сила априорной оценки точности источника правил: коды МКБ-10 в тексте
+# рекомендаций редки, их точность стягивается к общей точности правил
+RULE_PRIOR_STRENGTH = 10
+
+# Рубрики МКБ-10 (C00-C97) -> тип рака
+ICD10_RUBRICS = {
+    'lip': ['C00'],
+    'oral_cavity': ['C02', 'C03', 'C04', 'C05', 'C06'],
+    'salivary_glands': ['C07', 'C08'],
+    'oropharynx': ['C01', 'C09', 'C10'],
+    'nasopharyngeal': ['C11'],
+    'hypopharynx': ['C12', 'C13'],
+    'esophageal': ['C15'],
+    'stomach': ['C16'],
+    'colon': ['C18', 'C19'],
+    'rectal': ['C20'],
+    'anal': ['C21'],
+    'liver': ['C22'],
+    'pancreatic': ['C25'],
+    'nasal': ['C30', 'C31'],
+    'laryngeal': ['C32'],
+    'lung': ['C34'],
+    'mediastinal_tumors': ['C37', 'C38'],
+    'bone_sarcoma': ['C40', 'C41'],
+    'melanoma': ['C43'],
+    'mesothelioma': ['C45'],
+    'retroperitoneal_sarcoma': ['C48'],
+    'soft_tissue_sarcoma': ['C49'],
+    'breast': ['C50'],
+    'cervical': ['C53'],
+    'uterine': ['C54', 'C55'],
+    'ovarian': ['C56'],
+    'penile': ['C60'],
+    'prostate': ['C61'],
+    'testicular': ['C62'],
+    'kidney': ['C64', 'C65', 'C66'],
+    'bladder': ['C67'],
+    'brain': ['C70', 'C71', 'C72'],
+    'thyroid': ['C73'],
+    'adrenal': ['C74'],
+    'cancer_unknown_primary': ['C80'],
+    'lymphoma': ['C81', 'C82', 'C83', 'C84', 'C85']
+}
+
+# Формулировки диагноза (текст в нижнем регистре, ё -> е)
+KEYWORD_RULES = {
+    'cancer_unknown_primary': [r'невыявленн\w* первичн', r'неизвестн\w* первичн', r'\bонпл\b', r'\bcup\b', r'primary unknown',
+                               r'без выявленн\w* первичн', r'первичн\w* (?:очаг|опухол)\w* не (?:выявлен|обнаружен|установлен)'],
+    'breast': [r'рак\w* молочн\w* желез', r'\bрмж\b', r'рак\w* груди', r'breast cancer'],
+    'lung': [r'рак\w* (?:правого |левого )?легк', r'\bн?мрл\b', r'немелкоклеточн\w* рак', r'аденокарцином\w* (?:правого |левого )?легк', r'\bnsclc\b'],
+    'prostate': [r'рак\w* предстательн', r'рак\w* простат', r'\bрпж\b'],
+    'colon': [r'рак\w* ободочн', r'рак\w* толст\w* кишк', r'рак\w* (?:сигмовидн|слеп)\w* кишк', r'колоректальн\w* рак'],
+    'rectal': [r'рак\w* прям\w* кишк'],
+    'stomach': [r'рак\w* желудк', r'аденокарцином\w* желудк'],
+    'pancreatic': [r'рак\w* поджелудочн', r'аденокарцином\w* поджелудочн'],
+    'esophageal': [r'рак\w* пищевод'],
+    'liver': [r'рак\w* печен', r'гепатоцеллюлярн', r'\bгцр\b'],
+    'kidney': [r'рак\w* (?:паренхимы )?почк', r'почечно-клеточн', r'\bпкр\b', r'уротелиальн\w* рак\w* верхн\w* мочевыводящ'],
+    'bladder': [r'рак\w* мочев\w* пузыр', r'\bрмп\b'],
+    'ovarian': [r'рак\w* яичник', r'опухол\w* яичник', r'карцином\w* яичник'],
+    'cervical': [r'рак\w* шейк\w* матк', r'\bршм\b'],
+    'uterine': [r'рак\w* (?:тела )?матк', r'рак\w* эндометри'],
+    'melanoma': [r'меланом'],
+    'thyroid': [r'рак\w* щитовидн', r'\bдрщж\b'],
+    'adrenal': [r'адренокортикальн', r'рак\w* (?:коры )?надпочечник'],
+    'anal': [r'рак\w* анальн'],
+    'bone_sarcoma': [r'саркома?\w* кост', r'остеосарком', r'саркома?\w* юинга', r'хондросарком'],
+    'brain': [r'глиом', r'глиобластом', r'менингиом', r'эпендимом', r'медуллобластом'],
+    'gist': [r'\bгисо\b', r'\bgist\b', r'гастроинтестинальн\w* стромальн'],
+    'hypopharynx': [r'рак\w* гортаноглотк'],
+    'laryngeal': [r'рак\w* гортани\b'],
+    'lip': [r'рак\w* (?:нижней |верхней )?губы'],
+    'lymphoma': [r'лимфом', r'лимфогранулематоз'],
+    'mediastinal_tumors': [r'опухол\w* средостени', r'тимом'],
+    'merkel_cell': [r'меркел'],
+    'mesothelioma': [r'мезотелиом'],
+    'nasal': [r'рак\w* полост\w* носа', r'рак\w* придаточн\w* пазух'],
+    'nasopharyngeal': [r'рак\w* носоглотк'],
+    'oral_cavity': [r'рак\w* (?:слизист\w* оболочк\w* )?полост\w* рта', r'рак\w* (?:дна полости рта|языка)'],
+    'oropharynx': [r'рак\w* ротоглотк', r'рак\w* небн\w* миндалин'],
+    'penile': [r'рак\w* полов\w* член'],
+    'retroperitoneal_sarcoma': [r'забрюшинн\w* (?:неорганн\w* )?саркома?', r'саркома?\w* забрюшин'],
+    'soft_tissue_sarcoma': [r'саркома?\w* мягк\w* ткан'],
+    'salivary_glands': [r'рак\w* (?:околоушн|подчелюстн|слюнн)'],
+    'skin_bcc': [r'базальноклеточн', r'базалиом', r'\bбкрк\b'],
+    'skin_scc': [r'плоскоклеточн\w* рак\w* кож', r'\bпкрк\b'],
+    'testicular': [r'рак\w* яичк', r'герминогенн\w* опухол', r'семином']
+}
+
+ICD10_PATTERN = re.compile(r'\b[CС](\d{2})(\.\d{1,2})?\b')
+WORD_PATTERN = re.compile(r'\w+')
+
+# Строка диагноза: 'Диагноз:', 'Диагноз основной:', 'DS:'
+DIAGNOSIS_HEADER = re.compile(r'(?<!\w)(?:диагноз|ds)(?:\s+[а-яё]+)?\s*[:\-–—]\s*', re.IGNORECASE)
+# Конец предложения (точка в 'C34.1' или 'T2N1M0.5' его не заканчивает)
+SENTENCE_END = re.compile(r'\n|\.(?=\s+[А-ЯЁA-Z])')
+CLAUSE_SPLIT = re.compile(r'[;,\n]|\.(?=\s|$)')
+# Части фразы про родственников, анамнез, отрицание и подозрение - не диагноз пациента
+EXCLUDED_CLAUSE = re.compile(
+    r'(?<!\w)(?:'
+    r'у (?:матери|мамы|отца|папы|брата|сестры|бабушки|дедушки|деда|тети|дяди|сына|дочери)'
+    r'|(?:мать|отец|брат|сестра|бабушка|дедушка|родственник\w*)(?!\w)'
+    r'|семейн\w* анамнез|наследствен\w*|анамнез\w*|ранее|перенес\w*'
+    r'|исключ\w*|не выявлен\w*|не обнаружен\w*|не подтвержд\w*|без признаков|нет данных'
+    r'|подозрени\w*'
+    r')'
+)
+# 'первичный очаг не выявлен' - это и есть диагноз (CUP), а не отрицание
+PRIMARY_NOT_FOUND = re.compile(r'первичн\w* (?:очаг|опухол)\w* не (?:выявлен|обнаружен|установлен)')
+
+
+@dataclass(frozen=True)
+class CancerPrediction:
+    label: str
+    confidence: float
+    source: str  # 'icd10', 'keyword' или 'model'
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'label': self.label, 'confidence': round(self.confidence, 3), 'source': self.source}
+
+
+def normalize(text: str) -> str:
+    return text.lower().replace('ё', 'е')
+
+
+def char_ngrams(text: str, low: int = 3, high: int = 5) -> Counter:
+    """Символьные n-граммы внутри слов (слово обрамлено пробелами), устойчивы к падежным окончаниям"""
+    grams = Counter()
+    for word in WORD_PATTERN.findall(normalize(text)):
+        padded = f' {word} '
+        for n in range(low, high + 1):
+            for i in range(len(padded) - n + 1):
+                grams[padded[i:i + n]] += 1
+    return grams
+
+
+def document_passages(document: GuidelineDocument) -> List[str]:
+    """
+    Обучающие фрагменты документа: заголовок, medical_conditions, key_topics и
+    qa_pairs (по фрагменту на список строк и на каждую пару вопрос-ответ).
+    У файлов нового формата (clinical_guideline) берутся название и краткое название
+    """
+    data = document.data
+    passages = [document.title]
+
+    info = data.get('document_info')
+    if isinstance(info, dict) and isinstance(info.get('title'), str):
+        passages.append(info['title'])
+
+    guideline = data.get('clinical_guideline')
+    if isinstance(guideline, dict):
+        passages.extend(v for v in (guideline.get('title'), guideline.get('short_title')) if isinstance(v, str))
+
+    for key in ('medical_conditions', 'key_topics', 'qa_pairs'):
+        passages.extend(_passages(data.get(key)))
+
+    return [p for p in passages if p and p.strip()]
+
+
+def _passages(value: Any) -> Iterable[str]:
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _passages(item)
+    elif isinstance(value, list):
+        if all(isinstance(item, str) for item in value):
+            if value:
+                yield '. '.join(value)
+        else:
+            for item in value:
+                if isinstance(item, dict):
+                    yield '. '.join(_strings(item))
+                else:
+                    yield from _passages(item)
+
+
+def _strings(value: Any) -> Iterable[str]:
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _strings(item)
+
+
+class CancerClassifier:
+    """
+    Локальное определение типа рака до обращения к LLM.
+    Первый уровень - правила: рубрика МКБ-10 или формулировка диагноза, только
+    в строке диагноза ('Диагноз: ...', предложение с кодом МКБ-10) и без частей
+    про родственников, анамнез и отрицание. Если сработали правила разных
+    типов, решает LLM.
+    Второй - линейная модель по TF-IDF символьных n-грамм: центроиды классов
+    (Rocchio) по фрагментам рекомендаций корпуса, косинусная близость
+    переводится в вероятность softmax с температурой.
+    Уверенность обоих уровней берется из отложенной выборки фрагментов:
+    температура минимизирует на ней логарифмическую ошибку, уверенность правила -
+    доля верных срабатываний. decide() возвращает предсказание, только если
+    уверенность не ниже порога
+    """
+
+    def __init__(self, corpus: GuidelineCorpus = None, threshold: float = None,
+                 vocabulary: CancerVocabulary = None):
+        self.threshold = threshold if threshold is not None else CLASSIFIER_THRESHOLD
+        vocabulary = vocabulary or cancer_vocabulary
+
+        # коды из самих рекомендаций (вплоть до подрубрики) уточняют общую таблицу рубрик
+        self.icd10 = {code: label for label, codes in ICD10_RUBRICS.items() for code in codes}
+        self.icd10.update(vocabulary.icd10)
+
+        # к ручным формулировкам добавляются синонимы из словаря базы рекомендаций
+        self.keyword_rules = {label: [re.compile(p) for p in patterns] for label, patterns in KEYWORD_RULES.items()}
+        for label, patterns in vocabulary.patterns.items():
+            self.keyword_rules.setdefault(label, []).extend(patterns)
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.accepted = 0
+        self.rule_conflicts = 0
+        self.by_source = Counter()
+
+        self.labels = []
+        self.vocabulary = {}
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.temperature = 1.0
+        # без отложенной выборки правилам не доверяем: решает LLM
+        self.rule_confidence = {'icd10': 0.5, 'keyword': 0.5}
+        self.calibration = {}
+        self.train_seconds = 0.0
+        self.passages = 0
+
+        self.train(corpus or guideline_corpus)
+
+    def train(self, corpus: GuidelineCorpus):
+        started = time.time()
+
+        samples = []
+        for label in corpus.cancer_types():
+            passages = [p for document in corpus.documents(label) for p in document_passages(document)]
+            samples.extend((label, passage, i % HOLDOUT_EVERY == HOLDOUT_EVERY - 1)
+                           for i, passage in enumerate(passages))
+
+        if not samples:
+            print("⚠️ Классификатор типа рака: в корпусе нет обучающих фрагментов, работают только правила")
+            return
+
+        grams = [char_ngrams(passage) for _, passage, _ in samples]
+        train = [(label, g) for (label, _, held_out), g in zip(samples, grams) if not held_out]
+        holdout = [(label, passage, g) for (label, passage, held_out), g in zip(samples, grams) if held_out]
+
+        # калибровка на отложенных фрагментах, затем модель переобучается на всех
+        self._fit(train)
+        if holdout:
+            self.temperature = self._calibrate_model(holdout)
+            self.rule_confidence = self._calibrate_rules(holdout)
+        self._fit([(label, g) for (label, _, _), g in zip(samples, grams)])
+
+        self.train_seconds = round(time.time() - started, 2)
+        self.passages = len(samples)
+
+        print(f"✅ Классификатор типа рака: {len(self.labels)} типов, {len(samples)} фрагментов "
+              f"({len(holdout)} для калибровки), {len(self.vocabulary)} n-грамм, T={self.temperature:.3f}, "
+              f"правила: {', '.join(f'{k} {v:.2f}' for k, v in self.rule_confidence.items())}, "
+              f"{self.train_seconds} с")
+
+    def _fit(self, samples: List[Tuple[str, Counter]]):
+        """TF-IDF словарь и нормированные центроиды классов по (тип, n-граммы)"""
+        labels = sorted({label for label, _ in samples})
+        label_index = {label: i for i, label in enumerate(labels)}
+
+        df = Counter()
+        for _, grams in samples:
+            df.update(grams.keys())
+        vocabulary = {gram: i for i, gram in enumerate(df)}
+
+        n = len(samples)
+        idf = np.zeros(len(vocabulary), dtype=np.float32)
+        for gram, count in df.items():
+            idf[vocabulary[gram]] = math.log((1 + n) / (1 + count)) + 1
+
+        self.vocabulary = vocabulary
+        self.idf = idf
+
+        sums = np.zeros((len(labels), len(vocabulary)), dtype=np.float32)
+        for label, grams in samples:
+            ids, weights = self._vectorize(grams)
+            np.add.at(sums[label_index[label]], ids, weights)
+
+        norms = np.linalg.norm(sums, axis=1)
+        norms[norms == 0] = 1
+        self.centroids = sums / norms[:, None]
+        self.labels = labels
+
+    def _vectorize(self, grams: Counter) -> Tuple[np.ndarray, np.ndarray]:
+        """Разреженный L2-нормированный TF-IDF вектор: (номера признаков, веса)"""
+        pairs = [(self.vocabulary[g], c) for g, c in grams.items() if g in self.vocabulary]
+        if not pairs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        ids = np.fromiter((i for i, _ in pairs), dtype=np.int64, count=len(pairs))
+        tf = np.fromiter((c for _, c in pairs), dtype=np.float32, count=len(pairs))
+        weights = (1 + np.log(tf)) * self.idf[ids]
+        weights /= np.linalg.norm(weights)
+        return ids, weights
+
+    def _calibrate_model(self, holdout: List[Tuple[str, str, Counter]]) -> float:
+        """
+        Температура softmax, минимизирующая логарифмическую ошибку на отложенных
+        фрагментах. Там же считаются точность и покрытие модели при пороге
+        """
+        label_index = {label: i for i, label in enumerate(self.labels)}
+        rows, targets = [], []
+        for label, _, grams in holdout:
+            ids, weights = self._vectorize(grams)
+            if not len(ids) or label not in label_index:
+                continue
+            rows.append(self.centroids[:, ids] @ weights)
+            targets.append(label_index[label])
+
+        if not rows:
+            return 0.05
+
+        scores = np.array(rows, dtype=np.float64)
+        targets = np.array(targets)
+        best_t, best_loss, best_probs = 0.05, math.inf, None
+        for t in np.geomspace(0.005, 1.0, 60):
+            logits = scores / t
+            logits -= logits.max(axis=1, keepdims=True)
+            log_probs = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+            loss = -log_probs[np.arange(len(targets)), targets].mean()
+            if loss < best_loss:
+                best_t, best_loss, best_probs = float(t), loss, np.exp(log_probs)
+
+        predicted = best_probs.argmax(axis=1)
+        confident = best_probs.max(axis=1) >= self.threshold
+        self.calibration['model'] = {
+            'holdout': len(targets),
+            'log_loss': round(float(best_loss), 4),
+            'accuracy': round(float((predicted == targets).mean()), 3),
+            'coverage_at_threshold': round(float(confident.mean()), 3),
+            'precision_at_threshold': round(float((predicted == targets)[confident].mean()), 3)
+            if confident.any() else None
+        }
+        return best_t
+
+    def _calibrate_rules(self, holdout: List[Tuple[str, str, Counter]]) -> Dict[str, float]:
+        """
+        Уверенность правил - доля верных однозначных срабатываний на отложенных
+        фрагментах (со сглаживанием Лапласа); у источника с малым числом
+        срабатываний она стягивается к общей точности правил
+        """
+        fired, correct = Counter(), Counter()
+        conflicts = 0
+        for label, passage, _ in holdout:
+            matches = self.rule_matches(self.without_excluded(passage))
+            if len(matches) > 1:
+                conflicts += 1
+            elif matches:
+                predicted, (_, _, source) = next(iter(matches.items()))
+                fired[source] += 1
+                correct[source] += predicted == label
+
+        pooled = (sum(correct.values()) + 1) / (sum(fired.values()) + 2)
+        confidence = {
+            source: (correct[source] + RULE_PRIOR_STRENGTH * pooled) / (fired[source] + RULE_PRIOR_STRENGTH)
+            for source in ('icd10', 'keyword')
+        }
+        self.calibration['rules'] = {
+            'holdout': len(holdout),
+            'conflicts': conflicts,
+            **{source: {'fired': fired[source], 'correct': correct[source],
+                        'confidence': round(confidence[source], 3)} for source in confidence}
+        }
+        return confidence
+
+    def probabilities(self, text: str) -> Dict[str, float]:
+        """Откалиброванные вероятности модели по всем типам корпуса"""
+        if not self.labels:
+            return {}
+        ids, weights = self._vectorize(char_ngrams(text))
+        if not len(ids):
+            return {}
+        logits = (self.centroids[:, ids] @ weights).astype(np.float64) / self.temperature
+        logits -= logits.max()
+        probs = np.exp(logits)
+        probs /= probs.sum()
+        return dict(zip(self.labels, probs.tolist()))
+
+    @staticmethod
+    def without_excluded(text: str) -> str:
+        """Текст без частей фраз про родственников, анамнез, отрицание и подозрение"""
+        clauses = CLAUSE_SPLIT.split(text)
+        return '\n'.join(
+            c for c in clauses
+            if c.strip() and (not EXCLUDED_CLAUSE.search(normalize(c)) or PRIMARY_NOT_FOUND.search(normalize(c)))
+        )
+
+    def diagnosis_text(self, text: str) -> str:
+        """
+        Формулировка диагноза: строки 'Диагноз: ...' до конца предложения и
+        предложения с кодом МКБ-10, без исключенных частей. Пусто, если их нет
+        """
+        parts = []
+        for header in DIAGNOSIS_HEADER.finditer(text):
+            end = SENTENCE_END.search(text, header.end())
+            parts.append(text[header.end():end.start() if end else len(text)])
+
+        start = 0
+        for end in list(SENTENCE_END.finditer(text)) + [None]:
+            sentence = text[start:end.start() if end else len(text)]
+            if ICD10_PATTERN.search(sentence):
+                parts.append(sentence)
+            if end:
+                start = end.end()
+
+        return self.without_excluded('\n'.join(parts))
+
+    def rule_matches(self, text: str) -> Dict[str, Tuple[int, int, str]]:
+        """Тип рака -> (начало, конец первого упоминания, 'icd10' или 'keyword')"""
+        text = normalize(text)
+        matches = {}
+
+        for match in ICD10_PATTERN.finditer(text.upper()):
+            rubric = 'C' + match.group(1)
+            label = self.icd10.get(rubric + (match.group(2) or '')) or self.icd10.get(rubric)
+            if label and label not in matches:
+                matches[label] = (match.start(), match.end(), 'icd10')
+
+        for label, patterns in self.keyword_rules.items():
+            for pattern in patterns:
+                match = pattern.search(text)
+                if match and (label not in matches or match.start() < matches[label][0]):
+                    matches[label] = (match.start(), match.end(), matches.get(label, (0, 0, 'keyword'))[2])
+
+        return matches
+
+    @staticmethod
+    def first_match(matches: Dict[str, Tuple[int, int, str]]) -> Optional[str]:
+        """Тип, упомянутый первым; при одинаковом начале - более длинное (точное) упоминание"""
+        if not matches:
+            return None
+        return min(matches, key=lambda label: (matches[label][0], matches[label][0] - matches[label][1]))
+
+    def classify(self, text: str, allowed: Iterable[str] = None) -> Optional[CancerPrediction]:
+        """
+        Лучший тип рака из allowed (по умолчанию - любой) с уверенностью.
+        Правило одного типа в формулировке диагноза - его тип с откалиброванной
+        уверенностью правила; правила разных типов - None (решает LLM);
+        без правил - модель по диагнозу (или по всему тексту без исключенных частей)
+        """
+        allowed = set(allowed) if allowed is not None else None
+        text = text[:4000]
+
+        diagnosis = self.diagnosis_text(text)
+        matches = self.rule_matches(diagnosis) if diagnosis else {}
+        if allowed is not None:
+            matches = {label: hit for label, hit in matches.items() if label in allowed}
+
+        if len(matches) > 1:
+            with self.lock:
+                self.rule_conflicts += 1
+            return None
+
+        if matches:
+            label, (_, _, source) = next(iter(matches.items()))
+            return CancerPrediction(label, self.rule_confidence[source], source)
+
+        probs = self.probabilities(diagnosis or self.without_excluded(text))
+        if allowed is not None:
+            probs = {label: p for label, p in probs.items() if label in allowed}
+        if not probs:
+            return None
+        label = max(probs, key=probs.get)
+        return CancerPrediction(label, probs[label], 'model')
+
+    def decide(self, text: str, allowed: Iterable[str] = None) -> Optional[CancerPrediction]:
+        """Предсказание, если уверенность не ниже порога (LLM не нужен), иначе None"""
+        prediction = self.classify(text, allowed)
+        confident = prediction is not None and prediction.confidence >= self.threshold
+
+        with self.lock:
+            self.requests += 1
+            if confident:
+                self.accepted += 1
+                self.by_source[prediction.source] += 1
+
+        return prediction if confident else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'llm_skipped': self.accepted,
+                'llm_calls': self.requests - self.accepted,
+                'skip_rate': round(self.accepted / self.requests * 100, 1) if self.requests > 0 else 0,
+                'by_source': dict(self.by_source),
+                'rule_conflicts': self.rule_conflicts,
+                'threshold': self.threshold,
+                'labels': len(self.labels),
+                'passages': self.passages,
+                'temperature': round(self.temperature, 4),
+                'calibration': self.calibration,
+                'train_seconds': self.train_seconds
+            }
+
+
+cancer_classifier = CancerClassifier()
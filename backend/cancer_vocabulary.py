@@ -0,0 +1,183 @@
+
+import re
+from typing import Dict, List, Any, Optional, Pattern
+
+from guideline_corpus import GuidelineCorpus, GuidelineDocument, guideline_corpus
+
+
+# Метка для истории, в которой тип рака не определен или его нет в базе
+GENERAL = 'general'
+
+TITLE_PREFIX = re.compile(r'^\s*клинические\s+рекомендации\s*[:.]?\s*', re.IGNORECASE)
+PARENTHESES = re.compile(r'\(([^()]*)\)')
+ABBREVIATION = re.compile(r'^[A-ZА-ЯЁ]{3,6}$')
+ICD10_CODE = re.compile(r'\b[CС](\d{2}(?:\.\d{1,2})?)\b')
+WORD = re.compile(r'\w+')
+
+
+def normalize(text: str) -> str:
+    return text.lower().replace('ё', 'е')
+
+
+def phrase_pattern(phrase: str) -> Optional[Pattern]:
+    """
+    Регулярное выражение для названия из рекомендаций с любыми падежными
+    окончаниями: у слов отбрасываются последние 3 буквы (основа не короче
+    3 букв, у слов длиннее 4 - не короче 4, у однословного названия - 5),
+    вместо них допускается до 4 букв, и слово должно на этом закончиться
+    ('рак легкого' находит 'рака легких', но 'рак гортани' - не 'рак гортаноглотки')
+    """
+    words = WORD.findall(normalize(phrase))
+    if not words:
+        return None
+    shortest = 5 if len(words) == 1 else 4
+    parts = []
+    for word in words:
+        if len(word) <= 2:
+            parts.append(re.escape(word))
+        else:
+            stem = word[:3] if len(word) <= 4 else word[:max(shortest, len(word) - 3)]
+            parts.append(re.escape(stem) + r'\w{0,4}')
+    return re.compile(r'(?<!\w)' + r'\W+'.join(parts) + r'(?!\w)')
+
+
+class CancerVocabulary:
+    """
+    Словарь типов рака, собранный из загруженной базы рекомендаций:
+    допустимые метки (типы корпуса + 'general'), русское название для промпта,
+    синонимы (названия состояний из medical_conditions, краткое название и
+    заголовок рекомендаций, аббревиатуры в скобках), регулярные выражения для
+    поиска этих синонимов в тексте и коды МКБ-10, указанные в самих рекомендациях
+    """
+
+    def __init__(self, corpus: GuidelineCorpus = None):
+        corpus = corpus or guideline_corpus
+
+        self.names: Dict[str, str] = {}
+        self.synonyms: Dict[str, List[str]] = {}
+        self.abbreviations: Dict[str, List[str]] = {}
+        self.patterns: Dict[str, List[Pattern]] = {}
+        self.icd10: Dict[str, str] = {}
+
+        ambiguous_codes = set()
+        for label in corpus.cancer_types():
+            synonyms, abbreviations, codes, display = [], [], [], []
+            for document in corpus.documents(label):
+                # название для промпта - первое состояние документа (или заголовок рекомендаций)
+                title = None
+                for name in self._document_names(document):
+                    for content in PARENTHESES.findall(name):
+                        codes.extend(ICD10_CODE.findall(content))
+                        abbreviations.extend(
+                            part.strip() for part in content.split(',') if ABBREVIATION.match(part.strip())
+                        )
+                    name = ' '.join(PARENTHESES.sub(' ', name).split()).strip(' .,:;«»"')
+                    if name.lower().startswith('по '):
+                        # 'Клинические рекомендации по раку прямой кишки': для поиска - 'раку прямой кишки'
+                        title = title or f'Клинические рекомендации {name}'
+                        name = name[3:]
+                    elif name and not title:
+                        title = name
+                    if name:
+                        synonyms.append(name)
+                if title:
+                    display.append(title)
+                codes.extend(self._document_codes(document))
+
+            synonyms = list(dict.fromkeys(synonyms))
+            abbreviations = list(dict.fromkeys(abbreviations))
+
+            self.synonyms[label] = synonyms
+            self.abbreviations[label] = abbreviations
+            self.names[label] = '; '.join(dict.fromkeys(display)) or label
+            self.patterns[label] = [p for p in map(phrase_pattern, synonyms) if p] + [
+                re.compile(r'(?<!\w)' + re.escape(normalize(abbr)) + r'(?!\w)') for abbr in abbreviations
+            ]
+
+            for code in codes:
+                code = 'C' + code
+                if self.icd10.get(code, label) != label:
+                    ambiguous_codes.add(code)
+                self.icd10[code] = label
+
+        for code in ambiguous_codes:
+            del self.icd10[code]
+
+        self.labels: List[str] = sorted(self.names) + [GENERAL]
+        self.names[GENERAL] = 'другое или тип рака не удалось определить'
+
+        print(f"✅ Словарь типов рака: {len(self.labels) - 1} типов из базы рекомендаций, "
+              f"{sum(len(s) for s in self.synonyms.values())} синонимов, {len(self.icd10)} кодов МКБ-10")
+
+    @staticmethod
+    def _document_names(document: GuidelineDocument) -> List[str]:
+        """Названия состояния: medical_conditions, краткое название, заголовок рекомендаций"""
+        data = document.data
+        names = []
+
+        conditions = data.get('medical_conditions')
+        if isinstance(conditions, dict):
+            conditions = conditions.get('conditions')
+        if isinstance(conditions, list):
+            names.extend(c for c in conditions if isinstance(c, str))
+
+        guideline = data.get('clinical_guideline')
+        if isinstance(guideline, dict):
+            names.extend(v for v in (guideline.get('short_title'), guideline.get('title')) if isinstance(v, str))
+
+        info = data.get('document_info')
+        titles = [info.get('title')] if isinstance(info, dict) else []
+        titles.append(document.title)
+        for title in titles:
+            if isinstance(title, str) and not title.endswith('.json'):
+                names.append(TITLE_PREFIX.sub('', title))
+
+        return [n for n in names if n.strip()]
+
+    @staticmethod
+    def _document_codes(document: GuidelineDocument) -> List[str]:
+        """Коды МКБ-10 из раздела coding_icd10 (рекомендации нового формата)"""
+        guideline = document.data.get('clinical_guideline')
+        coding = guideline.get('coding_icd10') if isinstance(guideline, dict) else None
+        if isinstance(coding, dict):
+            coding = coding.get('codes')
+        if not isinstance(coding, list):
+            return []
+        codes = []
+        for item in coding:
+            code = item.get('code') if isinstance(item, dict) else item
+            if isinstance(code, str):
+                codes.extend(ICD10_CODE.findall(code))
+        return codes
+
+    def describe(self, label: str) -> str:
+        name = self.names.get(label, label)
+        abbreviations = self.abbreviations.get(label)
+        return f"{name} ({', '.join(abbreviations)})" if abbreviations else name
+
+    def prompt_choices(self) -> str:
+        """Список допустимых значений для промпта: по строке на метку"""
+        return '\n'.join(f"    - '{label}' - {self.describe(label)}" for label in self.labels)
+
+    def resolve(self, answer: Any) -> Optional[str]:
+        """
+        Метка из ответа модели: точное значение (в кавычках, с точкой и т.п.)
+        или единственная допустимая метка, встречающаяся в ответе
+        """
+        if not isinstance(answer, str):
+            return None
+        value = answer.strip().strip('`\'"«». ').lower()
+        if value in self.names:
+            return value
+        found = [label for label in self.labels if re.search(r'(?<![\w])' + label + r'(?![\w])', value)]
+        return found[0] if len(found) == 1 else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'labels': len(self.labels),
+            'synonyms': sum(len(s) for s in self.synonyms.values()),
+            'icd10_codes': len(self.icd10)
+        }
+
+
+cancer_vocabulary = CancerVocabulary()
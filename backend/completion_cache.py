@@ -0,0 +1,147 @@
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+
+class CompletionCache:
+    """
+    Персистентный кэш ответов DeepSeek.
+    Ключ - sha256 от (model, system prompt, user prompt, temperature),
+    записи живут не дольше ttl секунд, при превышении max_entries
+    вытесняются давно не использованные (LRU).
+    """
+
+    def __init__(self, db_file: str = None, ttl: int = None, max_entries: int = None):
+        self.db_file = db_file or os.getenv('DEEPSEEK_CACHE_FILE', 'completion_cache.db')
+        self.ttl = ttl if ttl is not None else int(os.getenv('DEEPSEEK_CACHE_TTL', str(7 * 24 * 3600)))
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv('DEEPSEEK_CACHE_MAX_ENTRIES', '5000'))
+        self.enabled = os.getenv('DEEPSEEK_CACHE', '1') != '0'
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+
+        if self.enabled:
+            self._connect()
+
+    def _connect(self):
+        try:
+            self.conn = sqlite3.connect(self.db_file, check_same_thread=False, timeout=10)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                " key TEXT PRIMARY KEY,"
+                " content TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_completions_last_access ON completions(last_access)")
+            self.conn.commit()
+            print(f"✅ Кэш ответов DeepSeek: {self.db_file}")
+        except sqlite3.Error as e:
+            print(f"⚠️ Кэш ответов DeepSeek недоступен: {e}")
+            self.conn = None
+            self.enabled = False
+
+    @staticmethod
+    def make_key(model: str, system: str, user: str, temperature: float) -> str:
+        raw = json.dumps([model, system, user, round(float(temperature), 4)], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.lookup(key)
+        return entry[0] if entry is not None else None
+
+    def lookup(self, key: str) -> Optional[Tuple[str, float]]:
+        """(ответ, время истечения записи) или None"""
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self.lock:
+            try:
+                row = self.conn.execute(
+                    "SELECT content, created_at FROM completions WHERE key = ?", (key,)
+                ).fetchone()
+
+                if row is None or now - row[1] > self.ttl:
+                    if row is not None:
+                        self.conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                        self.conn.commit()
+                    self.misses += 1
+                    return None
+
+                self.conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+                self.conn.commit()
+                self.hits += 1
+                return row[0], row[1] + self.ttl
+            except sqlite3.Error as e:
+                print(f"⚠️ Ошибка чтения кэша: {e}")
+                self.misses += 1
+                return None
+
+    def set(self, key: str, content: str):
+        if not self.enabled or not content:
+            return
+
+        now = time.time()
+        with self.lock:
+            try:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO completions (key, content, created_at, last_access) VALUES (?, ?, ?, ?)",
+                    (key, content, now, now)
+                )
+                self._evict()
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Ошибка записи в кэш: {e}")
+
+    def delete(self, key: str):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            try:
+                self.conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Ошибка удаления из кэша: {e}")
+
+    def _evict(self):
+        """Удаляет просроченные записи и самые старые по last_access сверх лимита"""
+        self.conn.execute("DELETE FROM completions WHERE created_at < ?", (time.time() - self.ttl,))
+        count = self.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self.conn.execute(
+                "DELETE FROM completions WHERE key IN "
+                "(SELECT key FROM completions ORDER BY last_access ASC LIMIT ?)",
+                (overflow,)
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            entries = 0
+            if self.enabled:
+                try:
+                    entries = self.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+                except sqlite3.Error:
+                    pass
+
+            lookups = self.hits + self.misses
+            return {
+                'llm_hits': self.hits,
+                'llm_misses': self.misses,
+                'llm_hit_rate': round(self.hits / lookups * 100, 1) if lookups > 0 else 0,
+                'entries': entries,
+                'enabled': self.enabled
+            }
+
+
+completion_cache = CompletionCache()
@@ -0,0 +1,153 @@
+
+import os
+import json
+import mmap
+import pickle
+import struct
+import hashlib
+import tempfile
+from typing import Dict, List, Any, Optional, Tuple
+
+
+# Формат файла: MAGIC, версия формата и длина заголовка, затем JSON-заголовок
+# (манифест исходных файлов) и pickle с данными корпуса. Заголовок читается
+# без распаковки pickle, поэтому проверка актуальности дешевая
+MAGIC = b'GLCORPUS'
+FORMAT_VERSION = 1
+_PREFIX = struct.Struct('>8sIQ')
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(paths: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Имя файла -> mtime, размер и sha256 для каждого исходного JSON"""
+    manifest = {}
+    for path in paths:
+        st = os.stat(path)
+        manifest[os.path.basename(path)] = {
+            'mtime_ns': st.st_mtime_ns,
+            'size': st.st_size,
+            'sha256': file_sha256(path)
+        }
+    return manifest
+
+
+def manifest_matches(manifest: Dict[str, Dict[str, Any]], paths: List[str]) -> bool:
+    """
+    Совпадает ли манифест снимка с текущими файлами. Если mtime и размер
+    не изменились, файл считается тем же; иначе сравнивается sha256
+    (например, после git checkout меняется только mtime)
+    """
+    if set(manifest) != {os.path.basename(p) for p in paths}:
+        return False
+
+    for path in paths:
+        entry = manifest[os.path.basename(path)]
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_mtime_ns == entry.get('mtime_ns') and st.st_size == entry.get('size'):
+            continue
+        if st.st_size != entry.get('size') or file_sha256(path) != entry.get('sha256'):
+            return False
+
+    return True
+
+
+def write_snapshot(path: str, header: Dict[str, Any], payload: Any):
+    """Атомарно записывает снимок: временный файл + rename"""
+    header_bytes = json.dumps(header, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # mkstemp создает файл 0600, а снимок читают воркеры под другими пользователями
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_header(mm) -> Tuple[Optional[Dict[str, Any]], int]:
+    """Заголовок снимка и смещение pickle; (None, 0) для чужого или старого формата"""
+    if len(mm) < _PREFIX.size:
+        return None, 0
+
+    magic, version, header_len = _PREFIX.unpack_from(mm, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        return None, 0
+
+    start = _PREFIX.size
+    header = json.loads(bytes(mm[start:start + header_len]).decode('utf-8'))
+    return header, start + header_len
+
+
+def read_snapshot(path: str, sources: List[str], builder: str) -> Optional[Tuple[Dict[str, Any], Any]]:
+    """
+    Открывает снимок через mmap и возвращает (заголовок, данные), если он
+    собран той же версией кода из тех же исходных файлов. Иначе None
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+
+    with f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return None
+
+        with mm:
+            header, offset = read_header(mm)
+            if header is None or header.get('builder') != builder:
+                return None
+            if not manifest_matches(header.get('sources', {}), sources):
+                return None
+
+            with memoryview(mm) as view, view[offset:] as body:
+                payload = pickle.loads(body)
+
+    return header, payload
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Сборка бинарного снимка базы клинических рекомендаций')
+    parser.add_argument('--data-dir', help='папка с *_parsed.json (по умолчанию GUIDELINES_DIR или data/)')
+    parser.add_argument('--output', help='путь к снимку (по умолчанию GUIDELINES_SNAPSHOT или data/guidelines.snapshot)')
+    parser.add_argument('--force', action='store_true', help='пересобрать, даже если снимок актуален')
+    parser.add_argument('--check', action='store_true', help='только проверить, актуален ли снимок')
+    args = parser.parse_args()
+
+    # импорт здесь: классы корпуса должны сериализоваться как guideline_corpus.*, а не __main__.*;
+    # общий экземпляр при импорте снимок не трогает, этим управляет CLI
+    os.environ['GUIDELINES_SNAPSHOT_REBUILD'] = '0'
+    from guideline_corpus import GuidelineCorpus
+
+    corpus, fresh = GuidelineCorpus.load_snapshot(args.data_dir, args.output,
+                                                   rebuild=not args.check, force=args.force)
+    if args.check:
+        print("✅ Снимок актуален" if fresh else "⚠️ Снимок устарел или отсутствует")
+        raise SystemExit(0 if fresh else 1)
+
+    corpus.print_summary()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+
+import os
+import math
+import time
+import threading
+import contextlib
+from contextvars import ContextVar
+from typing import Dict, Any, Callable, Iterator, Optional, TypeVar
+from stage_executor import current_stage
+
+
+T = TypeVar('T')
+
+# Бюджет синхронного запроса и фоновой задачи анализа, секунд (0 - без ограничения)
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', '20'))
+JOB_DEADLINE = float(os.getenv('JOB_DEADLINE', '120'))
+# Вызов DeepSeek не начинается, если до дедлайна осталось меньше этого
+MIN_CALL_BUDGET = float(os.getenv('DEADLINE_MIN_CALL_BUDGET', '1'))
+
+
+class Deadline:
+    """
+    Дедлайн одного запроса. Создается в маршруте и через contextvars виден
+    всем этапам запроса (StageExecutor копирует контекст в потоки пула):
+    DeepSeekClient ограничивает таймаут каждого вызова оставшимся временем,
+    а этапы, ушедшие в локальный fallback, записываются в degraded
+    """
+
+    def __init__(self, seconds: Optional[float]):
+        self.seconds = seconds if seconds and seconds > 0 else None
+        self.started = time.time()
+        self.expires_at = self.started + self.seconds if self.seconds else None
+
+        self.lock = threading.Lock()
+        self.degraded = {}
+
+    def remaining(self) -> float:
+        """Оставшееся время в секундах (inf - без ограничения)"""
+        if self.expires_at is None:
+            return math.inf
+        return max(0.0, self.expires_at - time.time())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, default: float) -> float:
+        """Таймаут вызова: не больше default и не дольше оставшегося бюджета"""
+        return min(default, self.remaining())
+
+    def mark_degraded(self, stage: str, reason: str):
+        with self.lock:
+            self.degraded.setdefault(stage, reason)
+
+    def degraded_stages(self) -> Dict[str, str]:
+        with self.lock:
+            return dict(self.degraded)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'budget': self.seconds,
+            'elapsed': round(time.time() - self.started, 2),
+            'expired': self.expired(),
+            'degraded_stages': self.degraded_stages()
+        }
+
+
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar('deadline', default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+@contextlib.contextmanager
+def use_deadline(deadline: Deadline) -> Iterator[Deadline]:
+    """Делает deadline текущим для кода внутри блока (и этапов, запущенных из него)"""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def run_with_deadline(deadline: Deadline, func: Callable[..., T], *args, **kwargs) -> T:
+    with use_deadline(deadline):
+        return func(*args, **kwargs)
+
+
+def note_degraded(stage: str, reason: Any):
+    """
+    Отмечает, что этап отработал по локальному fallback. Имя берется из
+    StageExecutor, если код выполняется внутри этапа, иначе - stage
+    """
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.mark_degraded(current_stage.get() or stage, str(reason))
@@ -0,0 +1,378 @@
+
+import os
+import json
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, Callable, Iterable, NamedTuple, Optional
+from completion_cache import CompletionCache, completion_cache
+from resilience import Resilience, RetryPolicy, CircuitBreaker, CircuitOpenError
+from deadline import current_deadline, MIN_CALL_BUDGET
+
+
+DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
+DEFAULT_MODEL = "deepseek-chat"
+
+
+class DeepSeekError(Exception):
+    """Ошибка обращения к DeepSeek API"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class DeepSeekTimeout(DeepSeekError):
+    """DeepSeek не ответил за отведенное время"""
+
+
+class DeepSeekConnectionError(DeepSeekError):
+    """Не удалось установить соединение с DeepSeek"""
+
+
+class DeepSeekUnavailable(DeepSeekError):
+    """Запрос не отправлялся: после серии ошибок DeepSeek временно отключен"""
+
+
+class DeepSeekDeadlineExceeded(DeepSeekTimeout):
+    """Исчерпан бюджет времени запроса (дедлайн), а не таймаут самого DeepSeek"""
+
+
+# 429 и 5xx - перегрузка или сбой на стороне DeepSeek, запрос стоит повторить
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Повторяются только временные сбои. Запрос chat/completions ничего не меняет
+    на стороне DeepSeek, поэтому повтор после таймаута безопасен
+    """
+    if isinstance(error, DeepSeekDeadlineExceeded):
+        return False
+    if isinstance(error, (DeepSeekTimeout, DeepSeekConnectionError)):
+        return True
+    return isinstance(error, DeepSeekError) and error.status_code in TRANSIENT_STATUS_CODES
+
+
+class Completion(NamedTuple):
+    content: str
+    from_cache: bool
+    cache_key: Optional[str] = None
+    # когда ответ пропадет из кэша (None - кэш не используется)
+    expires_at: Optional[float] = None
+
+
+class DeepSeekClient:
+    """
+    Единый клиент DeepSeek для всех модулей: пул keep-alive соединений
+    (TCP+TLS рукопожатие выполняется один раз на соединение), общая сборка
+    заголовков/payload и таймаут на каждый вызов. При use_cache=True ответ
+    берется из CompletionCache, если такой запрос уже выполнялся.
+    HTTP/2 включается через DEEPSEEK_HTTP2=1, если установлен httpx[http2].
+    Временные ошибки повторяются с экспоненциальной задержкой; после серии
+    ошибок подряд предохранитель отключает DeepSeek, и вызовы сразу получают
+    DeepSeekUnavailable - этапы анализа уходят в локальные fallback-методы.
+    Если у запроса есть дедлайн (deadline.use_deadline), таймаут каждой
+    попытки и повторы ограничены оставшимся временем.
+    С on_delta ответ запрашивается потоком (stream=True), и текст передается
+    вызывающему по мере генерации.
+    """
+
+    def __init__(self, api_key: str = None, api_url: str = DEEPSEEK_API_URL,
+                 pool_size: int = None, http2: bool = None, default_timeout: float = 60,
+                 cache: CompletionCache = None, resilience: Resilience = None):
+        self._api_key = api_key
+        self.cache = cache
+        self.resilience = resilience or Resilience(
+            RetryPolicy(retryable=is_transient),
+            CircuitBreaker('DeepSeek'),
+            neutral=lambda e: isinstance(e, DeepSeekDeadlineExceeded)
+        )
+        self.api_url = api_url
+        self.default_timeout = default_timeout
+
+        if pool_size is None:
+            pool_size = int(os.getenv('DEEPSEEK_POOL_SIZE', os.getenv('PIPELINE_MAX_WORKERS', '16')))
+        self.pool_size = pool_size
+
+        if http2 is None:
+            http2 = os.getenv('DEEPSEEK_HTTP2', '0') == '1'
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.http2_client = None
+        if http2:
+            try:
+                import httpx
+                self.http2_client = httpx.Client(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+                )
+                print("✅ DeepSeek: используется HTTP/2")
+            except ImportError:
+                print("⚠️ DeepSeek: httpx[http2] не установлен, используется HTTP/1.1")
+
+        self.lock = threading.Lock()
+        self.total_requests = 0
+
+    @property
+    def api_key(self) -> Optional[str]:
+        # Ключ читается при каждом запросе, т.к. .env загружается уже после импорта модулей
+        return self._api_key or os.getenv('DEEPSEEK_API_KEY')
+
+    def build_headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def build_payload(self, system: str, user: str, temperature: float = 0.1,
+                      max_tokens: int = 500, json_mode: bool = False,
+                      model: str = DEFAULT_MODEL) -> Dict[str, Any]:
+        payload = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system},
+                {"role": "user", "content": user}
+            ],
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+        if json_mode:
+            payload["response_format"] = {"type": "json_object"}
+        return payload
+
+    def chat(self, system: str, user: str, temperature: float = 0.1, max_tokens: int = 500,
+             json_mode: bool = False, timeout: float = None, model: str = DEFAULT_MODEL,
+             use_cache: bool = False) -> str:
+        """
+        Отправляет запрос chat/completions и возвращает текст ответа.
+        Бросает DeepSeekError (и наследников) при любой ошибке.
+        """
+        return self.complete(system, user, temperature, max_tokens, json_mode, timeout, model, use_cache).content
+
+    def complete(self, system: str, user: str, temperature: float = 0.1, max_tokens: int = 500,
+                 json_mode: bool = False, timeout: float = None, model: str = DEFAULT_MODEL,
+                 use_cache: bool = False, on_delta: Callable[[str], None] = None) -> Completion:
+        """
+        То же, что chat, но дополнительно сообщает, взят ли ответ из кэша.
+        on_delta(text) получает ответ по частям во время генерации
+        (ответ из кэша - одной частью); возвращается все равно полный текст
+        """
+        cache_key = None
+        if use_cache and self.cache is not None:
+            cache_key = self.cache.make_key(model, system, user, temperature)
+            cached = self.cache.lookup(cache_key)
+            if cached is not None:
+                content, expires_at = cached
+                if on_delta is not None:
+                    on_delta(content)
+                return Completion(content, True, cache_key, expires_at)
+
+        if timeout is None:
+            timeout = self.default_timeout
+        deadline = current_deadline()
+
+        def deliver(delta: str):
+            on_delta(delta)
+            if deadline is not None and deadline.expired():
+                raise DeepSeekDeadlineExceeded("Дедлайн запроса истек во время генерации ответа")
+
+        def send(call_timeout: float) -> str:
+            if on_delta is not None:
+                return self.post_stream(payload, deliver, timeout=call_timeout)
+            result = self.post(payload, timeout=call_timeout)
+            try:
+                return result['choices'][0]['message']['content']
+            except (KeyError, IndexError, TypeError):
+                raise DeepSeekError("Некорректная структура ответа DeepSeek")
+
+        def attempt() -> str:
+            if deadline is None:
+                return send(timeout)
+            budget = deadline.timeout(timeout)
+            if budget < MIN_CALL_BUDGET:
+                raise DeepSeekDeadlineExceeded("Бюджет времени запроса исчерпан, DeepSeek не вызывается")
+            try:
+                return send(budget)
+            except DeepSeekTimeout as e:
+                if budget < timeout:
+                    raise DeepSeekDeadlineExceeded(f"DeepSeek не успел ответить до дедлайна запроса ({budget:.1f} с)") from e
+                raise
+            except DeepSeekError as e:
+                if deadline.expired():
+                    raise DeepSeekDeadlineExceeded(f"Дедлайн запроса истек во время ответа DeepSeek: {e}") from e
+                raise
+
+        payload = self.build_payload(system, user, temperature, max_tokens, json_mode, model)
+        if on_delta is not None:
+            payload["stream"] = True
+        try:
+            # под дедлайном попытка сама укорачивается до остатка времени,
+            # поэтому повтору достаточно MIN_CALL_BUDGET, без дедлайна - полный таймаут
+            content = self.resilience.call(
+                attempt,
+                budget=deadline.remaining() if deadline is not None else None,
+                attempt_timeout=MIN_CALL_BUDGET if deadline is not None else timeout
+            )
+        except CircuitOpenError as e:
+            raise DeepSeekUnavailable(str(e), status_code=503)
+
+        expires_at = None
+        if cache_key is not None:
+            self.cache.set(cache_key, content)
+            expires_at = time.time() + self.cache.ttl
+
+        return Completion(content, False, cache_key, expires_at)
+
+    def invalidate(self, completion: Completion):
+        """Убирает ответ из кэша (например, если он оказался невалидным JSON)"""
+        if completion.cache_key and self.cache is not None:
+            self.cache.delete(completion.cache_key)
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние предохранителя и счетчики повторов"""
+        stats = self.resilience.stats()
+        with self.lock:
+            stats['http_requests'] = self.total_requests
+        return stats
+
+    def post(self, payload: Dict[str, Any], timeout: float = None) -> Dict[str, Any]:
+        """Низкоуровневый POST через пул соединений, возвращает JSON ответа"""
+        if timeout is None:
+            timeout = self.default_timeout
+
+        with self.lock:
+            self.total_requests += 1
+
+        if self.http2_client is not None:
+            return self._post_http2(payload, timeout)
+
+        try:
+            response = self.session.post(self.api_url, headers=self.build_headers(), json=payload, timeout=timeout)
+        except requests.exceptions.Timeout as e:
+            raise DeepSeekTimeout(f"DeepSeek не ответил за {timeout} с: {e}")
+        except requests.exceptions.ConnectionError as e:
+            raise DeepSeekConnectionError(f"Ошибка соединения с DeepSeek: {e}")
+        except requests.exceptions.RequestException as e:
+            raise DeepSeekError(f"Ошибка запроса к DeepSeek: {e}")
+
+        if response.status_code != 200:
+            raise DeepSeekError(f"Ошибка DeepSeek: {response.status_code}", status_code=response.status_code)
+
+        try:
+            return response.json()
+        except ValueError:
+            raise DeepSeekError("DeepSeek вернул не JSON", status_code=response.status_code)
+
+    def post_stream(self, payload: Dict[str, Any], on_delta: Callable[[str], None],
+                    timeout: float = None) -> str:
+        """
+        POST с stream=True: читает SSE-фрагменты chat/completions, передает
+        каждый в on_delta и возвращает собранный текст. timeout ограничивает
+        ожидание каждого фрагмента. Обрыв после первого фрагмента не считается
+        временной ошибкой: повтор заново отдал бы уже полученный текст
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+
+        with self.lock:
+            self.total_requests += 1
+
+        if self.http2_client is not None:
+            return self._post_stream_http2(payload, on_delta, timeout)
+
+        received = []
+
+        def forward(delta: str):
+            received.append(delta)
+            on_delta(delta)
+
+        try:
+            response = self.session.post(self.api_url, headers=self.build_headers(), json=payload,
+                                         timeout=timeout, stream=True)
+        except requests.exceptions.Timeout as e:
+            raise DeepSeekTimeout(f"DeepSeek не ответил за {timeout} с: {e}")
+        except requests.exceptions.ConnectionError as e:
+            raise DeepSeekConnectionError(f"Ошибка соединения с DeepSeek: {e}")
+        except requests.exceptions.RequestException as e:
+            raise DeepSeekError(f"Ошибка запроса к DeepSeek: {e}")
+
+        try:
+            if response.status_code != 200:
+                raise DeepSeekError(f"Ошибка DeepSeek: {response.status_code}", status_code=response.status_code)
+            return self._read_stream(response.iter_lines(decode_unicode=True), forward)
+        except requests.exceptions.RequestException as e:
+            if received:
+                raise DeepSeekError(f"Поток ответа DeepSeek прерван: {e}")
+            raise DeepSeekConnectionError(f"Ошибка соединения с DeepSeek: {e}")
+        finally:
+            response.close()
+
+    def _post_stream_http2(self, payload: Dict[str, Any], on_delta: Callable[[str], None], timeout: float) -> str:
+        import httpx
+
+        received = []
+
+        def forward(delta: str):
+            received.append(delta)
+            on_delta(delta)
+
+        try:
+            with self.http2_client.stream('POST', self.api_url, headers=self.build_headers(),
+                                          json=payload, timeout=timeout) as response:
+                if response.status_code != 200:
+                    raise DeepSeekError(f"Ошибка DeepSeek: {response.status_code}", status_code=response.status_code)
+                return self._read_stream(response.iter_lines(), forward)
+        except httpx.TransportError as e:
+            if received:
+                raise DeepSeekError(f"Поток ответа DeepSeek прерван: {e}")
+            if isinstance(e, httpx.TimeoutException):
+                raise DeepSeekTimeout(f"DeepSeek не ответил за {timeout} с: {e}")
+            raise DeepSeekConnectionError(f"Ошибка соединения с DeepSeek: {e}")
+
+    @staticmethod
+    def _read_stream(lines: Iterable[Any], on_delta: Callable[[str], None]) -> str:
+        """Собирает текст из строк SSE вида 'data: {...}' до 'data: [DONE]'"""
+        parts = []
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if data == '[DONE]':
+                break
+            try:
+                delta = json.loads(data)['choices'][0].get('delta', {}).get('content') or ''
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                raise DeepSeekError("Некорректный фрагмент потока DeepSeek")
+            if delta:
+                parts.append(delta)
+                on_delta(delta)
+        return ''.join(parts)
+
+    def _post_http2(self, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        import httpx
+
+        try:
+            response = self.http2_client.post(self.api_url, headers=self.build_headers(), json=payload, timeout=timeout)
+        except httpx.TimeoutException as e:
+            raise DeepSeekTimeout(f"DeepSeek не ответил за {timeout} с: {e}")
+        except httpx.TransportError as e:
+            raise DeepSeekConnectionError(f"Ошибка соединения с DeepSeek: {e}")
+
+        if response.status_code != 200:
+            raise DeepSeekError(f"Ошибка DeepSeek: {response.status_code}", status_code=response.status_code)
+
+        try:
+            return response.json()
+        except ValueError:
+            raise DeepSeekError("DeepSeek вернул не JSON", status_code=response.status_code)
+
+
+deepseek_client = DeepSeekClient(cache=completion_cache)
@@ -0,0 +1,376 @@
+
+import os
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Any, Tuple, FrozenSet
+
+
+# Каноническое название -> все написания (МНН, торговые названия, латиница).
+# Общие слова вроде 'таксан' и 'платина' входят в несколько семейств: при
+# сравнении с протоколом они связывают родственные препараты, но сами
+# препаратом не считаются
+DRUG_FAMILIES = {
+
+    'трастузумаб': ['трастузумаб', 'герцептин', 'trastuzumab'],
+    'трастузумаб дерукстекан': ['трастузумаб дерукстекан', 'энхерту', 'tdxd', 'trastuzumab deruxtecan', 'трастузумаб'],
+    'трастузумаб-эмтансин': ['трастузумаб-эмтансин', 'трастузумаб-эмтанзин', 'т-дм1', 't-dm1', 'кадсила', 'трастузумаб'],
+    'пертузумаб': ['пертузумаб', 'перьета', 'pertuzumab'],
+    'тукатиниб': ['тукатиниб', 'tukysa', 'tucatinib'],
+
+
+    'паклитаксел': ['паклитаксел', 'taxol', 'paclitaxel', 'таксан'],
+    'доцетаксел': ['доцетаксел', 'taxotere', 'docetaxel', 'таксан'],
+
+
+    'карбоплатин': ['карбоплатин', 'carboplatin', 'платина'],
+    'цисплатин': ['цисплатин', 'cisplatin', 'платина'],
+    'оксалиплатин': ['оксалиплатин', 'oxaliplatin', 'платина'],
+
+
+    'капецитабин': ['капецитабин', 'кселода', 'capecitabine'],
+    'фторурацил': ['фторурацил', '5fu', '5-фторурацил', 'fluorouracil'],
+    'лейковорин': ['лейковорин', 'кальция фолинат', 'leucovorin'],
+    'гемцитабин': ['гемцитабин', 'гемзар', 'gemcitabine'],
+    'метотрексат': ['метотрексат', 'methotrexate'],
+
+
+    'иринотекан': ['иринотекан', 'camptosar', 'irinotecan'],
+
+
+    'рамуцирумаб': ['рамуцирумаб', 'цирамза', 'ramucirumab'],
+    'бевацизумаб': ['бевацизумаб', 'авастин', 'bevacizumab'],
+
+
+    'гефитиниб': ['гефитиниб', 'иресса', 'gefitinib'],
+    'эрлотиниб': ['эрлотиниб', 'тарцева', 'erlotinib'],
+    'осимертиниб': ['осимертиниб', 'тагрессо', 'osimertinib'],
+
+
+    'алектиниб': ['алектиниб', 'алеценза', 'alectinib'],
+    'кризотиниб': ['кризотиниб', 'ксалкори', 'crizotinib'],
+    'церитиниб': ['церитиниб', 'зикадия', 'ceritinib'],
+
+
+    'дабрафениб': ['дабрафениб', 'тафинлар', 'dabrafenib'],
+    'траметиниб': ['траметиниб', 'мекинист', 'trametinib'],
+    'вемурафениб': ['вемурафениб', 'зельбораф', 'vemurafenib'],
+
+
+    'пембролизумаб': ['пембролизумаб', 'кейтруда', 'pembrolizumab'],
+    'ниволумаб': ['ниволумаб', 'опдиво', 'nivolumab'],
+    'атезолизумаб': ['атезолизумаб', 'тецентрик', 'atezolizumab'],
+    'ипилимумаб': ['ипилимумаб', 'ервой', 'ipilimumab'],
+
+
+    'доксорубицин': ['доксорубицин', 'адриамицин', 'doxorubicin'],
+    'эпирубицин': ['эпирубицин', 'epirubicin'],
+
+
+    'циклофосфамид': ['циклофосфамид', 'cyclophosphamide'],
+    'ифосфамид': ['ифосфамид', 'ifosfamide'],
+    'митомицин': ['митомицин', 'mitomycin'],
+    'митотан': ['митотан', 'mitotane'],
+
+
+    'тамоксифен': ['тамоксифен', 'tamoxifen'],
+    'летрозол': ['летрозол', 'letrozole', 'фемара'],
+    'анастрозол': ['анастрозол', 'anastrozole', 'аримидекс'],
+    'эксеместан': ['эксеместан', 'exemestane', 'аромазин'],
+    'фулвестрант': ['фулвестрант', 'fulvestrant', 'фаслодекс'],
+
+    'палбоциклиб': ['палбоциклиб', 'palbociclib', 'ибранс'],
+    'рибоциклиб': ['рибоциклиб', 'ribociclib', 'кискали'],
+    'абемациклиб': ['абемациклиб', 'abemaciclib', 'верзенио'],
+
+    'этопозид': ['этопозид', 'etoposide'],
+    'винбластин': ['винбластин', 'vinblastine'],
+    'винкристин': ['винкристин', 'vincristine'],
+    'блеомицин': ['блеомицин', 'bleomycin'],
+    'пеметрексед': ['пеметрексед', 'alimta', 'pemetrexed'],
+    'винорельбин': ['винорельбин', 'navelbine', 'vinorelbine'],
+    'эрибулин': ['эрибулин', 'eribulin', 'халавен'],
+}
+
+# Аббревиатуры схем химиотерапии -> препараты схемы
+REGIMENS = {
+    'tc': ['паклитаксел', 'карбоплатин'],
+    'тс': ['паклитаксел', 'карбоплатин'],
+    'xelox': ['оксалиплатин', 'капецитабин'],
+    'capox': ['оксалиплатин', 'капецитабин'],
+    'folfox': ['оксалиплатин', 'фторурацил', 'лейковорин'],
+    'folfiri': ['иринотекан', 'фторурацил', 'лейковорин'],
+    'folfirinox': ['оксалиплатин', 'иринотекан', 'фторурацил', 'лейковорин'],
+    'ac': ['доксорубицин', 'циклофосфамид'],
+    'ec': ['эпирубицин', 'циклофосфамид'],
+    'edp-m': ['этопозид', 'доксорубицин', 'цисплатин', 'митотан'],
+    'gp': ['гемцитабин', 'цисплатин'],
+    'gc': ['гемцитабин', 'цисплатин'],
+    'gemcarbo': ['гемцитабин', 'карбоплатин'],
+}
+
+# Название препарата такой длины и длиннее может продолжаться падежным
+# окончанием ('паклитакселом'); короткие написания и схемы - только целым словом
+MIN_INFLECTED_LENGTH = 5
+
+
+@dataclass(frozen=True)
+class DrugMention:
+    """Упоминание препарата, общего названия группы или схемы в тексте"""
+    start: int
+    end: int
+    text: str
+    canonical: str
+    kind: str                      # 'drug', 'class' или 'regimen'
+    drugs: Tuple[str, ...]         # канонические препараты (для схемы - ее состав)
+    families: FrozenSet[str]       # семейства DRUG_FAMILIES, к которым относится написание
+
+
+@dataclass(frozen=True)
+class CanonicalDrug:
+    """
+    Строка препарата, приведенная к каноническому виду: номер препарата
+    (-1, если распознано не ровно одно название) и битовая маска семейств
+    """
+    text: str
+    canonical_id: int
+    family_mask: int
+    family_ids: Tuple[int, ...]
+
+
+@dataclass(frozen=True)
+class _Pattern:
+    text: str
+    canonical: str
+    kind: str
+    drugs: Tuple[str, ...]
+    families: FrozenSet[str]
+    inflected: bool
+
+
+class DrugRecognizer:
+    """
+    Распознавание препаратов автоматом Ахо-Корасик: все написания из
+    drug_families и аббревиатуры схем ищутся за один линейный проход по
+    тексту. Совпадение засчитывается только с начала слова; в конце слова
+    допускается окончание для длинных названий
+    """
+
+    def __init__(self, families: Dict[str, List[str]] = None, regimens: Dict[str, List[str]] = None):
+        self.families = families if families is not None else DRUG_FAMILIES
+        self.regimens = regimens if regimens is not None else REGIMENS
+
+        self.family_ids = {family: i for i, family in enumerate(self.families)}
+        self._patterns = self._collect_patterns()
+        self._build_automaton()
+
+    def _collect_patterns(self) -> List[_Pattern]:
+        member_families = {}
+        for family, members in self.families.items():
+            for member in [family] + list(members):
+                member_families.setdefault(member.lower(), []).append(family)
+
+        patterns = []
+        for text, families in member_families.items():
+            families = list(dict.fromkeys(families))
+            if text in self.families:
+                canonical, kind = text, 'drug'
+            elif len(families) == 1:
+                canonical, kind = families[0], 'drug'
+            else:
+                canonical, kind = text, 'class'
+            patterns.append(_Pattern(
+                text=text,
+                canonical=canonical,
+                kind=kind,
+                drugs=(canonical,) if kind == 'drug' else tuple(families),
+                families=frozenset(families),
+                inflected=len(text) >= MIN_INFLECTED_LENGTH and text[-1].isalpha()
+            ))
+
+        for abbr, drugs in self.regimens.items():
+            abbr = abbr.lower()
+            if abbr in member_families:
+                continue
+            patterns.append(_Pattern(
+                text=abbr,
+                canonical=abbr,
+                kind='regimen',
+                drugs=tuple(drugs),
+                families=frozenset(f for d in drugs for f in member_families.get(d, ())),
+                inflected=False
+            ))
+
+        return patterns
+
+    def _build_automaton(self):
+        """Бор по всем написаниям + суффиксные ссылки (BFS)"""
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+
+        for pid, pattern in enumerate(self._patterns):
+            state = 0
+            for ch in pattern.text:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = nxt
+            self._out[state] = self._out[state] + (pid,)
+
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[nxt] = self._goto[fallback].get(ch, 0) if state else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find_all(self, text: str) -> List[DrugMention]:
+        """Все упоминания, включая вложенные ('трастузумаб' внутри 'трастузумаб дерукстекан')"""
+        if not text:
+            return []
+
+        text_lower = text.lower()
+        # lower() почти всегда сохраняет длину; если нет - позиции считаются по тексту в нижнем регистре
+        source = text if len(text_lower) == len(text) else text_lower
+        goto, fail, out, patterns = self._goto, self._fail, self._out, self._patterns
+        mentions = []
+        state = 0
+
+        for i, ch in enumerate(text_lower):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+
+            for pid in out[state]:
+                pattern = patterns[pid]
+                start = i - len(pattern.text) + 1
+                if not self._at_boundary(text_lower, start, i + 1, pattern):
+                    continue
+                mentions.append(DrugMention(
+                    start=start,
+                    end=i + 1,
+                    text=source[start:i + 1],
+                    canonical=pattern.canonical,
+                    kind=pattern.kind,
+                    drugs=pattern.drugs,
+                    families=pattern.families
+                ))
+
+        mentions.sort(key=lambda m: (m.start, -m.end))
+        return mentions
+
+    @staticmethod
+    def _at_boundary(text: str, start: int, end: int, pattern: _Pattern) -> bool:
+        if start > 0 and text[start - 1].isalnum():
+            return False
+        if end < len(text) and text[end].isalpha() and not pattern.inflected:
+            return False
+        return True
+
+    def find(self, text: str) -> List[DrugMention]:
+        """Упоминания без перекрытий: из вложенных берется самое длинное"""
+        result = []
+        last_end = 0
+        for mention in self.find_all(text):
+            if mention.start >= last_end:
+                result.append(mention)
+                last_end = mention.end
+        return result
+
+    def drugs(self, text: str, expand_regimens: bool = True) -> List[str]:
+        """Канонические названия препаратов в порядке появления, без повторов"""
+        found = []
+        for mention in self.find(text):
+            if mention.kind == 'drug' or (mention.kind == 'regimen' and expand_regimens):
+                found.extend(mention.drugs)
+        return list(dict.fromkeys(found))
+
+    def families_in(self, text: str) -> FrozenSet[str]:
+        """Все семейства DRUG_FAMILIES, написания которых встречаются в тексте"""
+        families = set()
+        for mention in self.find_all(text):
+            if mention.kind != 'regimen':
+                families.update(mention.families)
+        return frozenset(families)
+
+    def canonicalize(self, text: str) -> CanonicalDrug:
+        """Канонический вид строки препарата (без кэша, см. DrugCanonicalizer)"""
+        text_lower = text.lower()
+        mentions = self.find_all(text_lower)
+
+        family_ids = sorted({self.family_ids[f] for m in mentions if m.kind != 'regimen'
+                             for f in m.families if f in self.family_ids})
+        canonical = {d for m in self.find(text_lower) if m.kind == 'drug' for d in m.drugs}
+        canonical_id = self.family_ids.get(next(iter(canonical)), -1) if len(canonical) == 1 else -1
+
+        mask = 0
+        for family_id in family_ids:
+            mask |= 1 << family_id
+        return CanonicalDrug(text_lower, canonical_id, mask, tuple(family_ids))
+
+    def stats(self) -> Dict[str, Any]:
+        kinds = {}
+        for pattern in self._patterns:
+            kinds[pattern.kind] = kinds.get(pattern.kind, 0) + 1
+        return {'patterns': len(self._patterns), 'states': len(self._goto), 'by_kind': kinds}
+
+
+class DrugCanonicalizer:
+    """
+    Кэш канонических форм. Препараты из протоколов закрепляются один раз
+    при загрузке (pin) и не вытесняются; произвольные строки из историй
+    болезни проходят через ограниченный LRU
+    """
+
+    def __init__(self, recognizer: DrugRecognizer, maxsize: int = None):
+        if maxsize is None:
+            maxsize = int(os.getenv('DRUG_CANONICAL_CACHE_SIZE', '4096'))
+        self.recognizer = recognizer
+        self.maxsize = maxsize
+        self._pinned = {}
+        self._pinned_hits = 0
+        self._lock = threading.Lock()
+        self._lookup = lru_cache(maxsize=maxsize)(recognizer.canonicalize)
+
+    def pin(self, text: str) -> CanonicalDrug:
+        drug = self._pinned.get(text)
+        if drug is None:
+            drug = self.recognizer.canonicalize(text)
+            self._pinned[text] = drug
+        return drug
+
+    def get(self, text: str) -> CanonicalDrug:
+        drug = self._pinned.get(text)
+        if drug is not None:
+            with self._lock:
+                self._pinned_hits += 1
+            return drug
+        return self._lookup(text)
+
+    def stats(self) -> Dict[str, Any]:
+        info = self._lookup.cache_info()
+        lookups = self._pinned_hits + info.hits + info.misses
+        return {
+            'pinned': len(self._pinned),
+            'pinned_hits': self._pinned_hits,
+            'lru_hits': info.hits,
+            'lru_misses': info.misses,
+            'lru_size': info.currsize,
+            'lru_maxsize': info.maxsize,
+            'hit_rate': round((self._pinned_hits + info.hits) / lookups * 100, 1) if lookups else 0
+        }
+
+
+drug_recognizer = DrugRecognizer()
+drug_canonicalizer = DrugCanonicalizer(drug_recognizer)
@@ -0,0 +1,523 @@
+
+import os
+import json
+import time
+import hashlib
+from dataclasses import dataclass, field, replace
+from glob import glob
+from typing import Dict, List, Any, Optional, Tuple
+
+import drug_recognizer as drug_recognizer_module
+from corpus_snapshot import build_manifest, read_snapshot, write_snapshot
+from drug_recognizer import drug_recognizer
+
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+# Имя файла (без _parsed.json) -> тип рака. Если несколько файлов дают один
+# тип, их протоколы объединяются; основным документом считается файл,
+# который стоит в этом списке раньше
+FILE_TYPE_MAP = {
+    'adrenal_cancer': 'adrenal',
+    'anal_cancer': 'anal',
+    'bladder_cancer': 'bladder',
+    'bone_sarcoma': 'bone_sarcoma',
+    'brain_metastasis': 'brain',
+    'cns_tumors': 'brain',
+    'breast_cancer': 'breast',
+    'cancer_unknown_primary': 'cancer_unknown_primary',
+    'cervical_cancer': 'cervical',
+    'cervical_cancer_neck': 'cervical',
+    'colon_cancer': 'colon',
+    'esophageal_cancer': 'esophageal',
+    'germ_cell_male': 'testicular',
+    'testicular_cancer': 'testicular',
+    'gist': 'gist',
+    'head_neck_cancer': 'head_neck',
+    'hypopharynx': 'hypopharynx',
+    'hypopharynx_cancer': 'hypopharynx',
+    'kidney_cancer': 'kidney',
+    'kidney_parenchyma_cancer': 'kidney',
+    'laryngeal_cancer': 'laryngeal',
+    'lip_cancer': 'lip',
+    'liver_cancer': 'liver',
+    'lung_cancer': 'lung',
+    'lymphoid_cancer': 'lymphoma',
+    'mediastinal_tumors': 'mediastinal_tumors',
+    'melanoma': 'melanoma',
+    'merkel_cell_carcinoma': 'merkel_cell',
+    'mesothelioma': 'mesothelioma',
+    'nasal_cancer': 'nasal',
+    'nasopharyngeal_cancer': 'nasopharyngeal',
+    'oral_cavity': 'oral_cavity',
+    'oral_cavity_cancer': 'oral_cavity',
+    'oropharynx': 'oropharynx',
+    'oropharynx_cancer': 'oropharynx',
+    'ovarian_cancer': 'ovarian',
+    'ovarian_borderline': 'ovarian',
+    'ovarian_nonepithelial': 'ovarian',
+    'pancreatic_cancer': 'pancreatic',
+    'penile_cancer': 'penile',
+    'prostate_cancer': 'prostate',
+    'rectal_cancer': 'rectal',
+    'retroperitoneal_sarcoma': 'retroperitoneal_sarcoma',
+    'salivary_glands_cancer': 'salivary_glands',
+    'skin_bcc': 'skin_bcc',
+    'skin_scc': 'skin_scc',
+    'soft_tissue_sarcoma': 'soft_tissue_sarcoma',
+    'stomach_cancer': 'stomach',
+    'thyroid_cancer': 'thyroid',
+    'thyroid_diff_cancer': 'thyroid',
+    'uterine_cancer': 'uterine',
+}
+
+SOURCE_NAME = 'Минздрав РФ'
+
+SNAPSHOT_FILENAME = 'guidelines.snapshot'
+
+BIOMARKER_KEYWORDS = {
+    'her2_positive': ['her2+', 'her2-положительн', 'her2 позитивн', 'her2 overexpressing', 'her2 3+'],
+    'her2_negative': ['her2-', 'her2-отрицательн', 'her2 негативн', 'her2 0', 'her2 1+'],
+    'egfr_mutated': ['egfr мутац', 'egfr+', 'egfr mut', 'egfr mutated'],
+    'alk_positive': ['alk+', 'alk-положительн', 'alk позитивн', 'alk rearrangement'],
+    'ros1_positive': ['ros1+', 'ros1 rearrangement'],
+    'braf_mutated': ['braf мутац', 'braf v600e', 'braf mutated'],
+    'pd_l1_high': ['pd-l1 ≥50', 'pd-l1 high', 'pdl1 high', 'pd-l1 >50%'],
+    'msi_high': ['msi-h', 'msi высок', 'microsatellite instability-high'],
+    'mss': ['mss', 'microsatellite stable'],
+    'triple_negative': ['трижды негативн', 'тройной негативн', 'triple negative'],
+    'tp53_mutated': ['tp53', 'p53 мутация'],
+    'brca_mutated': ['brca мутация', 'brca1', 'brca2']
+}
+
+
+def map_filename_to_type(stem: str) -> str:
+    """Имя файла без _parsed.json -> тип рака"""
+    return FILE_TYPE_MAP.get(stem, stem)
+
+
+def detect_line(text: str) -> str:
+    """Определяет линию терапии из текста"""
+    text_lower = text.lower()
+
+    if any(x in text_lower for x in ['первая линия', 'first-line', '1st', 'первой линии']):
+        return 'first_line'
+    elif any(x in text_lower for x in ['вторая линия', 'second-line', '2nd', 'второй линии']):
+        return 'second_line'
+    elif any(x in text_lower for x in ['третья линия', 'third-line', '3rd', 'третьей линии']):
+        return 'third_line'
+    elif any(x in text_lower for x in ['адъювант', 'adjuvant']):
+        return 'adjuvant'
+    elif any(x in text_lower for x in ['неоадъювант', 'neoadjuvant']):
+        return 'neoadjuvant'
+    elif any(x in text_lower for x in ['метастатич', 'metastatic']):
+        return 'metastatic'
+    else:
+        return 'unknown'
+
+
+def extract_drugs_from_text(text: str) -> List[str]:
+    """Извлекает названия препаратов (и состав упомянутых схем) из текста рекомендации"""
+    return drug_recognizer.drugs(text)
+
+
+def extract_biomarkers_from_text(text: str) -> List[str]:
+    """Извлекает биомаркеры из текста условия протокола"""
+    text_lower = text.lower()
+    return [biomarker for biomarker, keywords in BIOMARKER_KEYWORDS.items()
+            if any(keyword in text_lower for keyword in keywords)]
+
+
+def build_scoring_rules(cancer_type: str, records: Tuple['ProtocolRecord', ...]) -> Dict[str, Any]:
+    """
+    Правила скоринга для типа рака: биомаркер -> препараты correct/warning/critical.
+    Препараты берутся из протоколов, противопоказания добавляются вручную
+    """
+    rules = {}
+
+    for record in records:
+        biomarkers = extract_biomarkers_from_text(record.condition.lower() + " " + record.name.lower())
+        if not biomarkers:
+            biomarkers = ['general']
+
+        meds_list = [str(m).lower() for m in record.medications if m]
+        for biomarker in biomarkers:
+            rule = rules.setdefault(biomarker, {'correct': [], 'warning': [], 'critical': []})
+            for med in meds_list:
+                if med not in rule['correct']:
+                    rule['correct'].append(med)
+
+    if cancer_type in ['breast', 'stomach', 'cancer_unknown_primary']:
+        if 'her2_negative' in rules:
+            rules['her2_negative']['critical'] = ['трастузумаб', 'trastuzumab', 'пертузумаб', 'pertuzumab', 'тукатиниб', 'tucatinib']
+
+    if cancer_type == 'lung':
+        if 'egfr_mutated' not in rules and 'general' in rules:
+            rules['general']['warning'] = rules['general'].get('warning', []) + ['гефитиниб', 'gefitinib', 'эрлотиниб', 'erlotinib']
+
+    if 'triple_negative' in rules:
+        rules['triple_negative']['critical'] = ['тамоксифен', 'tamoxifen', 'летрозол', 'letrozole', 'анастрозол', 'anastrozole']
+
+    return rules
+
+
+def build_drug_index(records: Tuple['ProtocolRecord', ...]) -> Dict[str, Tuple[int, ...]]:
+    """Препарат (в нижнем регистре) -> номера протоколов, в которых он указан"""
+    index = {}
+    for i, record in enumerate(records):
+        for med in record.medications:
+            drug = str(med).lower()
+            if i not in index.setdefault(drug, []):
+                index[drug].append(i)
+    return {drug: tuple(positions) for drug, positions in index.items()}
+
+
+def builder_fingerprint() -> str:
+    """
+    Хэш исходного кода разбора (этот модуль и словари drug_recognizer): снимок,
+    собранный другой версией разбора, считается устаревшим
+    """
+    digest = hashlib.sha256()
+    for path in (__file__, drug_recognizer_module.__file__):
+        with open(os.path.abspath(path), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class ProtocolRecord:
+    """Один протокол лечения (или текстовая рекомендация с препаратами)"""
+    cancer_type: str
+    name: str
+    condition: str
+    stage: str
+    line: str
+    medications: Tuple[str, ...]
+    treatment_steps: Tuple[Any, ...]
+    document: str
+    file: str
+    kind: str = 'protocol'
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Словарь в формате, который ожидают scorer, kb_loader и фронтенд"""
+        return {
+            'name': self.name,
+            'protocol_name': self.name,
+            'condition': self.condition,
+            'stage': self.stage,
+            'line': self.line,
+            'medications': list(self.medications),
+            'treatment_steps': list(self.treatment_steps),
+            'source': SOURCE_NAME,
+            'document': self.document,
+            'cancer_type': self.cancer_type,
+            'kind': self.kind
+        }
+
+
+@dataclass(frozen=True)
+class GuidelineDocument:
+    """Исходный документ клинических рекомендаций (содержимое только для чтения)"""
+    cancer_type: str
+    file: str
+    title: str
+    data: Dict[str, Any] = field(repr=False, compare=False)
+
+
+@dataclass(frozen=True)
+class CorpusStats:
+    data_dir: str
+    files_found: int
+    files_loaded: int
+    protocols: int
+    protocols_by_type: Dict[str, int]
+    merged_types: Tuple[str, ...]
+    errors: Tuple[str, ...]
+    load_seconds: float
+    snapshot: Optional[str] = None
+    version: str = ''
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'data_dir': self.data_dir,
+            'files_found': self.files_found,
+            'files_loaded': self.files_loaded,
+            'protocols': self.protocols,
+            'protocols_by_type': dict(self.protocols_by_type),
+            'merged_types': list(self.merged_types),
+            'errors': list(self.errors),
+            'load_seconds': self.load_seconds,
+            'snapshot': self.snapshot,
+            'version': self.version
+        }
+
+
+class GuidelineCorpus:
+    """
+    База клинических рекомендаций Минздрава, которая разбирается один раз
+    при старте и общая для scorer, kb_loader и ai_service. После создания
+    не меняется; для старого кода есть словарные представления протоколов.
+    Вместе с протоколами хранит индекс препаратов и правила по биомаркерам;
+    все это сохраняется в бинарный снимок (см. load_snapshot).
+    """
+
+    def __init__(self, documents: List[GuidelineDocument], records: List[ProtocolRecord], stats: CorpusStats,
+                 drug_index: Dict[str, Dict[str, Tuple[int, ...]]] = None,
+                 rules: Dict[str, Dict[str, Any]] = None):
+        self._documents = {}
+        for document in documents:
+            self._documents.setdefault(document.cancer_type, []).append(document)
+        self._documents = {k: tuple(v) for k, v in self._documents.items()}
+
+        self._records = {}
+        for record in records:
+            self._records.setdefault(record.cancer_type, []).append(record)
+        self._records = {k: tuple(v) for k, v in self._records.items()}
+
+        if drug_index is None:
+            drug_index = {t: build_drug_index(self.scoring_protocols(t)) for t in self._records}
+        if rules is None:
+            rules = {t: build_scoring_rules(t, self.protocols(t)) for t in self._records}
+        self._drug_index = drug_index
+        self._rules = rules
+
+        self.stats = stats
+        self._dict_views = {}
+
+    @staticmethod
+    def source_files(data_dir: str) -> List[str]:
+        """Исходные *_parsed.json в порядке FILE_TYPE_MAP (он задает основной документ)"""
+        files = glob(os.path.join(data_dir, '*_parsed.json'))
+        order = {stem: i for i, stem in enumerate(FILE_TYPE_MAP)}
+        files.sort(key=lambda path: (order.get(GuidelineCorpus._stem(path), len(order)), os.path.basename(path)))
+        return files
+
+    @classmethod
+    def load(cls, data_dir: str = None) -> 'GuidelineCorpus':
+        """Читает все data/*_parsed.json и строит корпус"""
+        started = time.time()
+        data_dir = data_dir or os.getenv('GUIDELINES_DIR', DEFAULT_DATA_DIR)
+
+        files = cls.source_files(data_dir)
+
+        # версия корпуса: код разбора + содержимое исходных файлов
+        version = hashlib.sha256(builder_fingerprint().encode('utf-8'))
+        documents, records, errors = [], [], []
+        for path in files:
+            filename = os.path.basename(path)
+            try:
+                with open(path, 'rb') as f:
+                    raw = f.read()
+                version.update(filename.encode('utf-8') + hashlib.sha256(raw).digest())
+                data = json.loads(raw.decode('utf-8'))
+            except Exception as e:
+                errors.append(f"{filename}: {e}")
+                print(f"  ❌ Ошибка загрузки {filename}: {e}")
+                continue
+
+            cancer_type = map_filename_to_type(cls._stem(path))
+            title = data.get('document_info', {}).get('title', filename)
+            documents.append(GuidelineDocument(cancer_type, filename, title, data))
+            records.extend(cls._extract_records(data, cancer_type, title, filename))
+
+        protocols_by_type = {}
+        for record in records:
+            protocols_by_type[record.cancer_type] = protocols_by_type.get(record.cancer_type, 0) + 1
+
+        files_by_type = {}
+        for document in documents:
+            files_by_type[document.cancer_type] = files_by_type.get(document.cancer_type, 0) + 1
+
+        stats = CorpusStats(
+            data_dir=data_dir,
+            files_found=len(files),
+            files_loaded=len(documents),
+            protocols=len(records),
+            protocols_by_type=protocols_by_type,
+            merged_types=tuple(sorted(t for t, n in files_by_type.items() if n > 1)),
+            errors=tuple(errors),
+            load_seconds=round(time.time() - started, 3),
+            version=version.hexdigest()[:16]
+        )
+        return cls(documents, records, stats)
+
+    @classmethod
+    def load_snapshot(cls, data_dir: str = None, snapshot_path: str = None,
+                      rebuild: bool = True, force: bool = False) -> Tuple['GuidelineCorpus', bool]:
+        """
+        Загружает корпус из бинарного снимка (mmap + pickle). Если снимка нет,
+        он собран другой версией кода или какой-то *_parsed.json изменился
+        (mtime/размер, затем sha256), корпус разбирается заново и снимок
+        пересобирается. Возвращает (корпус, был ли снимок актуален)
+        """
+        started = time.time()
+        data_dir = data_dir or os.getenv('GUIDELINES_DIR', DEFAULT_DATA_DIR)
+        snapshot_path = snapshot_path or os.getenv('GUIDELINES_SNAPSHOT') or os.path.join(data_dir, SNAPSHOT_FILENAME)
+        if snapshot_path == 'off':
+            return cls.load(data_dir), False
+
+        files = cls.source_files(data_dir)
+        builder = builder_fingerprint()
+
+        snapshot = None
+        if not force:
+            try:
+                snapshot = read_snapshot(snapshot_path, files, builder)
+            except Exception as e:
+                print(f"⚠️ Снимок базы рекомендаций не прочитан ({snapshot_path}): {e}")
+
+        if snapshot is not None:
+            _, payload = snapshot
+            stats = replace(payload['stats'], data_dir=data_dir, snapshot=snapshot_path,
+                            load_seconds=round(time.time() - started, 3))
+            corpus = cls(payload['documents'], payload['records'], stats,
+                         drug_index=payload['drug_index'], rules=payload['rules'])
+            print(f"⚡ База рекомендаций загружена из снимка {snapshot_path}")
+            return corpus, True
+
+        corpus = cls.load(data_dir)
+        if not rebuild:
+            return corpus, False
+
+        try:
+            corpus.save_snapshot(snapshot_path, files, builder)
+            corpus.stats = replace(corpus.stats, snapshot=snapshot_path)
+            print(f"💾 Снимок базы рекомендаций пересобран: {snapshot_path}")
+        except OSError as e:
+            print(f"⚠️ Не удалось сохранить снимок базы рекомендаций: {e}")
+
+        return corpus, False
+
+    def save_snapshot(self, snapshot_path: str, files: List[str], builder: str = None):
+        """Сохраняет корпус вместе с манифестом исходных файлов"""
+        header = {
+            'builder': builder or builder_fingerprint(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'sources': build_manifest(files)
+        }
+        payload = {
+            'documents': [d for docs in self._documents.values() for d in docs],
+            'records': [r for recs in self._records.values() for r in recs],
+            'stats': self.stats,
+            'drug_index': self._drug_index,
+            'rules': self._rules
+        }
+        write_snapshot(snapshot_path, header, payload)
+
+    @staticmethod
+    def _stem(path: str) -> str:
+        return os.path.basename(path).replace('_parsed.json', '')
+
+    @staticmethod
+    def _extract_records(data: Dict[str, Any], cancer_type: str, title: str, filename: str) -> List[ProtocolRecord]:
+        records = []
+
+        for p in data.get('treatment_protocols', []) or []:
+            name = p.get('protocol_name', '') or ''
+            condition = p.get('condition', '') or ''
+            records.append(ProtocolRecord(
+                cancer_type=cancer_type,
+                name=name,
+                condition=condition,
+                stage=p.get('stage', '') or '',
+                line=detect_line(condition + ' ' + name),
+                medications=tuple(p.get('medications', []) or []),
+                treatment_steps=tuple(p.get('treatment_steps', []) or []),
+                document=title,
+                file=filename
+            ))
+
+        recs = data.get('clinical_recommendations', {})
+        specific = recs.get('specific') if isinstance(recs, dict) else None
+        if isinstance(specific, list):
+            for rec in specific:
+                if not isinstance(rec, str):
+                    continue
+                drugs = extract_drugs_from_text(rec)
+                if drugs:
+                    records.append(ProtocolRecord(
+                        cancer_type=cancer_type,
+                        name='Клиническая рекомендация',
+                        condition=rec[:100],
+                        stage='',
+                        line=detect_line(rec),
+                        medications=tuple(drugs),
+                        treatment_steps=(),
+                        document=title,
+                        file=filename,
+                        kind='recommendation'
+                    ))
+
+        return records
+
+    @property
+    def version(self) -> str:
+        """Версия корпуса: меняется вместе с исходными файлами или кодом разбора"""
+        return self.stats.version
+
+    def cancer_types(self) -> List[str]:
+        return list(self._documents.keys())
+
+    def protocols(self, cancer_type: str) -> Tuple[ProtocolRecord, ...]:
+        """Все протоколы типа рака"""
+        return self._records.get(cancer_type, ())
+
+    def scoring_protocols(self, cancer_type: str) -> Tuple[ProtocolRecord, ...]:
+        """Протоколы, пригодные для скоринга (с указанными препаратами)"""
+        return tuple(r for r in self.protocols(cancer_type) if r.medications)
+
+    def protocol_dicts(self, cancer_type: str, scoring: bool = False) -> List[Dict[str, Any]]:
+        """
+        Словарное представление протоколов (строится один раз и переиспользуется,
+        изменять его нельзя)
+        """
+        key = (cancer_type, scoring)
+        view = self._dict_views.get(key)
+        if view is None:
+            records = self.scoring_protocols(cancer_type) if scoring else self.protocols(cancer_type)
+            view = [record.as_dict() for record in records]
+            self._dict_views[key] = view
+        return view
+
+    def scoring_db(self) -> Dict[str, List[Dict[str, Any]]]:
+        """protocols_db для ComplianceScorer: тип рака -> протоколы с препаратами"""
+        db = {}
+        for cancer_type in self._records:
+            view = self.protocol_dicts(cancer_type, scoring=True)
+            if view:
+                db[cancer_type] = view
+        return db
+
+    def drug_index(self, cancer_type: str) -> Dict[str, Tuple[int, ...]]:
+        """Препарат -> номера протоколов в scoring_protocols(cancer_type)"""
+        return self._drug_index.get(cancer_type, {})
+
+    def scoring_rules(self, cancer_type: str) -> Dict[str, Any]:
+        """Правила по биомаркерам (correct/warning/critical) для типа рака"""
+        return self._rules.get(cancer_type, {})
+
+    def documents(self, cancer_type: str) -> Tuple[GuidelineDocument, ...]:
+        return self._documents.get(cancer_type, ())
+
+    def document(self, cancer_type: str) -> Optional[GuidelineDocument]:
+        """Основной документ рекомендаций для типа рака"""
+        documents = self.documents(cancer_type)
+        return documents[0] if documents else None
+
+    def print_summary(self):
+        stats = self.stats
+        print("\n📚 БАЗА КЛИНИЧЕСКИХ РЕКОМЕНДАЦИЙ МИНЗДРАВА")
+        print(f"📁 Папка: {stats.data_dir}")
+        print(f"✅ Загружено файлов: {stats.files_loaded}/{stats.files_found}, "
+              f"типов рака: {len(self._documents)}, протоколов: {stats.protocols} "
+              f"({stats.load_seconds} с)")
+        if stats.merged_types:
+            print(f"🔗 Объединены документы для типов: {', '.join(stats.merged_types)}")
+        if stats.errors:
+            print(f"⚠️ Ошибок загрузки: {len(stats.errors)}")
+
+
+# GUIDELINES_SNAPSHOT_REBUILD=0: не пересобирать снимок при старте (например, если
+# папка data/ только для чтения и снимок собирается отдельным шагом сборки)
+guideline_corpus, _ = GuidelineCorpus.load_snapshot(rebuild=os.getenv('GUIDELINES_SNAPSHOT_REBUILD', '1') != '0')
+guideline_corpus.print_summary()
@@ -1,203 +1,382 @@
-
 import json
 import os
+import atexit
+import threading
+from bisect import bisect_right
 from datetime import datetime
-from collections import defaultdict
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Границы корзин гистограмм. Среди них есть все пороги, которые использует
+# отчет (1-4 с для времени ответа, 65 и 85 для score), поэтому распределения
+# в отчете получаются точно такими же, как при подсчете по сырым значениям
+RESPONSE_TIME_BOUNDS = [0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 2.5, 3, 3.5, 4, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120]
+SCORE_BOUNDS = list(range(5, 101, 5))
+CONFIDENCE_BOUNDS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами: count/sum/min/max и счетчики
+    по корзинам. Память и время отчета не зависят от числа событий,
+    гистограммы с одинаковыми границами складываются
+    """
+
+    def __init__(self, bounds: List[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value: float):
+        self.counts[bisect_right(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: 'Histogram'):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        if other.max is not None:
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def count_between(self, low: float = None, high: float = None) -> int:
+        """Число значений в [low, high); low и high должны быть границами корзин"""
+        start = 0 if low is None else self.bounds.index(low) + 1
+        end = len(self.counts) if high is None else self.bounds.index(high) + 1
+        return sum(self.counts[start:end])
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'counts': self.counts, 'count': self.count, 'sum': self.total, 'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, bounds: List[float], data: Any) -> 'Histogram':
+        histogram = cls(bounds)
+        if isinstance(data, list):
+            # старый формат metrics_data.json: сырые значения
+            for value in data:
+                histogram.add(value)
+        elif isinstance(data, dict) and len(data.get('counts', [])) == len(histogram.counts):
+            histogram.counts = list(data['counts'])
+            histogram.count = data.get('count', 0)
+            histogram.total = data.get('sum', 0.0)
+            histogram.min = data.get('min')
+            histogram.max = data.get('max')
+        return histogram
+
+
+class DayRollup:
+    """Агрегаты за один день"""
 
-class MetricsCollector:
     def __init__(self):
-        self.metrics_file = "metrics_data.json"
+        self.analyses = 0
+        self.cache_hits = 0
+        self.reused_analyses = 0
+        self.errors = 0
+        self.cancer_types = {}
+        self.response_times = Histogram(RESPONSE_TIME_BOUNDS)
+        self.compliance_scores = Histogram(SCORE_BOUNDS)
+        self.mammogram_total = 0
+        self.mammogram_malignant = 0
+        self.mammogram_benign = 0
+        self.mammogram_confidences = Histogram(CONFIDENCE_BOUNDS)
+
+    def merge(self, other: 'DayRollup'):
+        self.analyses += other.analyses
+        self.cache_hits += other.cache_hits
+        self.reused_analyses += other.reused_analyses
+        self.errors += other.errors
+        for cancer_type, count in other.cancer_types.items():
+            self.cancer_types[cancer_type] = self.cancer_types.get(cancer_type, 0) + count
+        self.response_times.merge(other.response_times)
+        self.compliance_scores.merge(other.compliance_scores)
+        self.mammogram_total += other.mammogram_total
+        self.mammogram_malignant += other.mammogram_malignant
+        self.mammogram_benign += other.mammogram_benign
+        self.mammogram_confidences.merge(other.mammogram_confidences)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'analyses': self.analyses,
+            'cache_hits': self.cache_hits,
+            'reused_analyses': self.reused_analyses,
+            'errors': self.errors,
+            'cancer_types': self.cancer_types,
+            'response_times': self.response_times.to_dict(),
+            'compliance_scores': self.compliance_scores.to_dict(),
+            'mammogram': {
+                'total': self.mammogram_total,
+                'malignant': self.mammogram_malignant,
+                'benign': self.mammogram_benign,
+                'confidences': self.mammogram_confidences.to_dict()
+            }
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'DayRollup':
+        day = cls()
+        day.analyses = data.get('analyses', 0)
+        day.cache_hits = data.get('cache_hits', 0)
+        day.reused_analyses = data.get('reused_analyses', 0)
+        day.errors = data.get('errors', 0)
+        day.cancer_types = dict(data.get('cancer_types', {}))
+        day.response_times = Histogram.from_dict(RESPONSE_TIME_BOUNDS, data.get('response_times'))
+        day.compliance_scores = Histogram.from_dict(SCORE_BOUNDS, data.get('compliance_scores'))
+        mammo = data.get('mammogram') or {}
+        day.mammogram_total = mammo.get('total', 0)
+        day.mammogram_malignant = mammo.get('malignant', 0)
+        day.mammogram_benign = mammo.get('benign', 0)
+        day.mammogram_confidences = Histogram.from_dict(CONFIDENCE_BOUNDS, mammo.get('confidences'))
+        return day
+
+
+def _merge_protocol_stats(base: Dict[str, Any], delta: Dict[str, Any]):
+    base['minzdrav_hits'] = base.get('minzdrav_hits', 0) + delta.get('minzdrav_hits', 0)
+    base['ai_fallbacks'] = base.get('ai_fallbacks', 0) + delta.get('ai_fallbacks', 0)
+    by_type = base.setdefault('by_cancer_type', {})
+    for cancer_type, counts in delta.get('by_cancer_type', {}).items():
+        target = by_type.setdefault(cancer_type, {'hits': 0, 'misses': 0})
+        target['hits'] += counts.get('hits', 0)
+        target['misses'] += counts.get('misses', 0)
+
+
+class MetricsCollector:
+    """
+    Сборщик метрик. События только обновляют счетчики и гистограммы в памяти
+    (O(1) на запросе), фоновый поток раз в flush_interval секунд дописывает
+    накопленные изменения в metrics_data.json. Запись идет как слияние дельты
+    с содержимым файла под файловой блокировкой, поэтому несколько процессов
+    не затирают метрики друг друга.
+    """
+
+    def __init__(self, metrics_file: str = "metrics_data.json", flush_interval: float = None):
+        self.metrics_file = metrics_file
+        self.flush_interval = flush_interval if flush_interval is not None else float(os.getenv('METRICS_FLUSH_INTERVAL', '10'))
         self.start_time = datetime.now()
-        self.daily_stats = {}
+        self.lock = threading.Lock()
+
+        # flushed - состояние файла на момент последнего сброса, pending - еще не записанные изменения
+        self.flushed = {}
+        self.flushed_protocol_stats = {}
+        self.pending = {}
+        self.pending_protocol_stats = {}
+        self.inflight = {}
+
         self.load_metrics()
-    
+
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+
     def load_metrics(self):
-        if os.path.exists(self.metrics_file):
-            try:
-                with open(self.metrics_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.daily_stats = data.get('daily', {})
-                    self.start_time = datetime.fromisoformat(data.get('start_time', datetime.now().isoformat()))
-            except:
-                self.daily_stats = {}
-    
+        data = self._read_file()
+        if data is None:
+            return
+        with self.lock:
+            self.start_time, self.flushed, self.flushed_protocol_stats = self._parse(data)
+
+    def _read_file(self) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(self.metrics_file):
+            return None
+        try:
+            with open(self.metrics_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"⚠️ Не удалось прочитать {self.metrics_file}: {e}")
+            return None
+
+    def _parse(self, data: Dict[str, Any]):
+        start_time = datetime.fromisoformat(data.get('start_time', self.start_time.isoformat()))
+        days = {}
+        protocol_stats = dict(data.get('protocol_stats', {}))
+        for key, stats in data.get('daily', {}).items():
+            if key == 'protocol_stats':
+                # в старом формате статистика протоколов лежала среди дней
+                _merge_protocol_stats(protocol_stats, stats)
+                continue
+            days[key] = DayRollup.from_dict(stats)
+        return start_time, days, protocol_stats
+
     def save_metrics(self):
+        """Сохраняет накопленные изменения (оставлено для совместимости, см. flush)"""
+        self.flush()
+
+    def flush(self):
+        """Сливает pending с файлом и атомарно перезаписывает его"""
+        with self.lock:
+            if not self.pending and not self.pending_protocol_stats:
+                return
+            pending, self.pending = self.pending, {}
+            pending_protocol, self.pending_protocol_stats = self.pending_protocol_stats, {}
+            # пока идет запись, дельта остается видна в отчетах через inflight
+            self.inflight = pending
+
+        lock_file = None
         try:
-            data = {
-                'start_time': self.start_time.isoformat(),
-                'daily': self.daily_stats
+            if fcntl is not None:
+                lock_file = open(self.metrics_file + '.lock', 'w')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            data = self._read_file()
+            if data is not None:
+                start_time, days, protocol_stats = self._parse(data)
+            else:
+                start_time, days, protocol_stats = self.start_time, {}, {}
+
+            for key, delta in pending.items():
+                days.setdefault(key, DayRollup()).merge(delta)
+            _merge_protocol_stats(protocol_stats, pending_protocol)
+
+            payload = {
+                'start_time': min(start_time, self.start_time).isoformat(),
+                'daily': {key: day.to_dict() for key, day in days.items()},
+                'protocol_stats': protocol_stats
             }
-            with open(self.metrics_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except:
-            pass
-    
+            tmp_file = self.metrics_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(payload, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_file, self.metrics_file)
+
+            with self.lock:
+                self.start_time = min(start_time, self.start_time)
+                self.flushed = days
+                self.flushed_protocol_stats = protocol_stats
+                self.inflight = {}
+        except Exception as e:
+            print(f"⚠️ Ошибка сохранения метрик: {e}")
+            # не теряем события: возвращаем дельту обратно в pending
+            with self.lock:
+                for key, delta in pending.items():
+                    self.pending.setdefault(key, DayRollup()).merge(delta)
+                _merge_protocol_stats(self.pending_protocol_stats, pending_protocol)
+                self.inflight = {}
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
     def get_today_key(self):
         return datetime.now().strftime('%Y-%m-%d')
-    
+
+    def _today(self) -> DayRollup:
+        """Дельта за сегодня; вызывать под self.lock"""
+        today = self.get_today_key()
+        day = self.pending.get(today)
+        if day is None:
+            day = self.pending[today] = DayRollup()
+        return day
+
     def record_protocol_usage(self, cancer_type: str, protocol_found: bool, source: str):
         """
         Записывает статистику использования базы протоколов
         """
-        if 'protocol_stats' not in self.daily_stats:
-            self.daily_stats['protocol_stats'] = {
-                'minzdrav_hits': 0,
-                'ai_fallbacks': 0,
-                'by_cancer_type': {}
-            }
-        
-        if protocol_found:
-            self.daily_stats['protocol_stats']['minzdrav_hits'] += 1
-        else:
-            self.daily_stats['protocol_stats']['ai_fallbacks'] += 1
-        
-        if cancer_type not in self.daily_stats['protocol_stats']['by_cancer_type']:
-            self.daily_stats['protocol_stats']['by_cancer_type'][cancer_type] = {
-                'hits': 0, 'misses': 0
-            }
-        
-        if protocol_found:
-            self.daily_stats['protocol_stats']['by_cancer_type'][cancer_type]['hits'] += 1
-        else:
-            self.daily_stats['protocol_stats']['by_cancer_type'][cancer_type]['misses'] += 1
-    
-    def _ensure_today(self):
-        today = self.get_today_key()
-        if today not in self.daily_stats:
-            self.daily_stats[today] = {
-                'analyses': 0,
-                'cache_hits': 0,
-                'errors': 0,
-                'response_times': [],
-                'cancer_types': {},
-                'compliance_scores': [],
-                'mammogram': {
-                    'total': 0,
-                    'malignant': 0,
-                    'benign': 0,
-                    'confidences': []
-                }
-            }
-        return today
-    
+        with self.lock:
+            stats = self.pending_protocol_stats
+            _merge_protocol_stats(stats, {
+                'minzdrav_hits': 1 if protocol_found else 0,
+                'ai_fallbacks': 0 if protocol_found else 1,
+                'by_cancer_type': {cancer_type: {'hits': 1 if protocol_found else 0, 'misses': 0 if protocol_found else 1}}
+            })
+
     def record_analysis(self, cancer_type: str, compliance_score: int, response_time: float, from_cache: bool = False,
-                   source: str = 'unknown'):
+                   source: str = 'unknown', reused_analysis: bool = False):
+        """
+        from_cache - текст анализа взят из кэша ответов DeepSeek;
+        reused_analysis - обновление переиспользовало текст предыдущего анализа
+        (запроса анализа не было вовсе), в попадания кэша это не входит
+        """
         try:
-            today = self._ensure_today()
-            
-            self.daily_stats[today]['analyses'] += 1
-            
-            if cancer_type not in self.daily_stats[today]['cancer_types']:
-                self.daily_stats[today]['cancer_types'][cancer_type] = 0
-            self.daily_stats[today]['cancer_types'][cancer_type] += 1
-            
-            self.daily_stats[today]['compliance_scores'].append(compliance_score)
-            if len(self.daily_stats[today]['compliance_scores']) > 1000:
-                self.daily_stats[today]['compliance_scores'] = self.daily_stats[today]['compliance_scores'][-1000:]
-            
-            self.daily_stats[today]['response_times'].append(response_time)
-            if len(self.daily_stats[today]['response_times']) > 1000:
-                self.daily_stats[today]['response_times'] = self.daily_stats[today]['response_times'][-1000:]
-            
-            if from_cache:
-                self.daily_stats[today]['cache_hits'] += 1
-            
-            self.save_metrics()
+            with self.lock:
+                day = self._today()
+                day.analyses += 1
+                day.cancer_types[cancer_type] = day.cancer_types.get(cancer_type, 0) + 1
+                day.compliance_scores.add(compliance_score)
+                day.response_times.add(response_time)
+                if from_cache:
+                    day.cache_hits += 1
+                if reused_analysis:
+                    day.reused_analyses += 1
         except Exception as e:
             print(f"Metrics error: {e}")
-    
+
     def record_mammogram_analysis(self, success: bool, is_malignant: bool, confidence: float, response_time: float):
         try:
-            today = self._ensure_today()
-            
-            if 'mammogram' not in self.daily_stats[today]:
-                self.daily_stats[today]['mammogram'] = {
-                    'total': 0,
-                    'malignant': 0,
-                    'benign': 0,
-                    'confidences': []
-                }
-            
-            self.daily_stats[today]['mammogram']['total'] += 1
-            if is_malignant:
-                self.daily_stats[today]['mammogram']['malignant'] += 1
-            else:
-                self.daily_stats[today]['mammogram']['benign'] += 1
-            
-            self.daily_stats[today]['mammogram']['confidences'].append(confidence)
-            if len(self.daily_stats[today]['mammogram']['confidences']) > 1000:
-                self.daily_stats[today]['mammogram']['confidences'] = self.daily_stats[today]['mammogram']['confidences'][-1000:]
-            
-            self.save_metrics()
+            with self.lock:
+                day = self._today()
+                day.mammogram_total += 1
+                if is_malignant:
+                    day.mammogram_malignant += 1
+                else:
+                    day.mammogram_benign += 1
+                day.mammogram_confidences.add(confidence)
         except:
             pass
-    
+
     def record_error(self, error_type: str):
         try:
-            today = self._ensure_today()
-            self.daily_stats[today]['errors'] += 1
-            self.save_metrics()
+            with self.lock:
+                self._today().errors += 1
         except:
             pass
-    
+
+    def _snapshot(self) -> Dict[str, DayRollup]:
+        """Сумма записанного и еще не сброшенного по дням"""
+        with self.lock:
+            days = {}
+            for source in (self.flushed, self.inflight, self.pending):
+                for key, day in source.items():
+                    days.setdefault(key, DayRollup()).merge(day)
+            return days
+
     def get_metrics_report(self) -> Dict[str, Any]:
         try:
-            total_analyses = 0
-            total_scores = []
-            total_times = []
-            cancer_type_counts = {}
-            total_cache_hits = 0
-            total_errors = 0
-            total_mammogram = 0
-            total_malignant = 0
-            total_benign = 0
-            mammogram_confidences = []
-            
-            for day, stats in self.daily_stats.items():
-                total_analyses += stats.get('analyses', 0)
-                total_cache_hits += stats.get('cache_hits', 0)
-                total_errors += stats.get('errors', 0)
-                
-                for ct, count in stats.get('cancer_types', {}).items():
-                    cancer_type_counts[ct] = cancer_type_counts.get(ct, 0) + count
-                
-                scores = stats.get('compliance_scores', [])
-                if isinstance(scores, list):
-                    total_scores.extend(scores)
-                
-                times = stats.get('response_times', [])
-                if isinstance(times, list):
-                    total_times.extend(times)
-                
-                mammo = stats.get('mammogram', {})
-                if mammo:
-                    total_mammogram += mammo.get('total', 0)
-                    total_malignant += mammo.get('malignant', 0)
-                    total_benign += mammo.get('benign', 0)
-                    mammogram_confidences.extend(mammo.get('confidences', []))
-            
+            total = DayRollup()
+            for day in self._snapshot().values():
+                total.merge(day)
+
+            total_analyses = total.analyses
+            times = total.response_times
+            scores = total.compliance_scores
+
             days_passed = max(1, (datetime.now() - self.start_time).days)
-            
-            avg_score = sum(total_scores) / len(total_scores) if total_scores else 0
-            avg_time = sum(total_times) / len(total_times) if total_times else 0
-            min_time = min(total_times) if total_times else 0
-            max_time = max(total_times) if total_times else 0
-            
+
             time_dist = {
-                '<1s': len([t for t in total_times if t < 1]),
-                '1-2s': len([t for t in total_times if 1 <= t < 2]),
-                '2-3s': len([t for t in total_times if 2 <= t < 3]),
-                '3-4s': len([t for t in total_times if 3 <= t < 4]),
-                '>4s': len([t for t in total_times if t >= 4])
+                '<1s': times.count_between(None, 1),
+                '1-2s': times.count_between(1, 2),
+                '2-3s': times.count_between(2, 3),
+                '3-4s': times.count_between(3, 4),
+                '>4s': times.count_between(4, None)
             }
-            
+
             score_dist = {
-                'high': len([s for s in total_scores if s >= 85]),
-                'medium': len([s for s in total_scores if 65 <= s < 85]),
-                'low': len([s for s in total_scores if s < 65])
+                'high': scores.count_between(85, None),
+                'medium': scores.count_between(65, 85),
+                'low': scores.count_between(None, 65)
             }
-            
+
             return {
                 'period': {
                     'start': self.start_time.strftime('%Y-%m-%d'),
@@ -209,30 +388,31 @@ class MetricsCollector:
                     'analyses_per_day': round(total_analyses / days_passed, 1)
                 },
                 'performance': {
-                    'avg_response_time': round(avg_time, 2),
-                    'min_response_time': round(min_time, 2),
-                    'max_response_time': round(max_time, 2),
+                    'avg_response_time': round(times.mean, 2),
+                    'min_response_time': round(times.min or 0, 2),
+                    'max_response_time': round(times.max or 0, 2),
                     'response_time_distribution': time_dist
                 },
                 'cache': {
-                    'hits': total_cache_hits,
-                    'hit_rate': round(total_cache_hits / total_analyses * 100, 1) if total_analyses > 0 else 0
+                    'hits': total.cache_hits,
+                    'hit_rate': round(total.cache_hits / total_analyses * 100, 1) if total_analyses > 0 else 0,
+                    'reused_analyses': total.reused_analyses
                 },
                 'quality': {
-                    'avg_compliance_score': round(avg_score, 1),
+                    'avg_compliance_score': round(scores.mean, 1),
                     'score_distribution': score_dist
                 },
-                'cancer_types': cancer_type_counts,
+                'cancer_types': total.cancer_types,
                 'errors': {
-                    'total': total_errors,
-                    'error_rate': round(total_errors / total_analyses * 100, 2) if total_analyses > 0 else 0
+                    'total': total.errors,
+                    'error_rate': round(total.errors / total_analyses * 100, 2) if total_analyses > 0 else 0
                 },
                 'mammogram': {
-                    'total': total_mammogram,
-                    'malignant': total_malignant,
-                    'benign': total_benign,
-                    'malignant_rate': round(total_malignant / total_mammogram * 100, 1) if total_mammogram > 0 else 0,
-                    'avg_confidence': round(sum(mammogram_confidences) / len(mammogram_confidences), 3) if mammogram_confidences else 0
+                    'total': total.mammogram_total,
+                    'malignant': total.mammogram_malignant,
+                    'benign': total.mammogram_benign,
+                    'malignant_rate': round(total.mammogram_malignant / total.mammogram_total * 100, 1) if total.mammogram_total > 0 else 0,
+                    'avg_confidence': round(total.mammogram_confidences.mean, 3)
                 }
             }
         except Exception as e:
@@ -240,4 +420,4 @@ class MetricsCollector:
             return {}
 
 
-metrics_collector = MetricsCollector()
\ No newline at end of file
+metrics_collector = MetricsCollector()
@@ -4,166 +4,575 @@ import uuid
 from datetime import datetime
 import json
 import os
+import base64
+import sqlite3
+import threading
+from contextlib import contextmanager
+from result_store import ResultStore, result_store
+
+PATIENT_FIELDS = ("id", "initials", "age", "gender", "diagnosis", "created_at", "last_visit", "version")
+EDITABLE_FIELDS = ("initials", "age", "gender", "diagnosis")
+HISTORY_FIELDS = ("id", "timestamp", "history", "diagnosis", "compliance_score", "status", "result_hash")
+SEARCH_FIELDS = ("id", "initials", "diagnosis")
+MAX_GRAM = 3
+
+
+def make_grams(text, max_len=MAX_GRAM):
+    """Все подстроки длиной 1..max_len (n-граммы) строки в нижнем регистре"""
+    text = (text or "").lower()
+    grams = set()
+    for size in range(1, max_len + 1):
+        for i in range(len(text) - size + 1):
+            grams.add(text[i:i + size])
+    return grams
+
+
+def encode_cursor(created_at, patient_id):
+    raw = json.dumps([created_at, patient_id], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Курсор пагинации -> (created_at, id); ValueError для некорректного курсора"""
+    try:
+        created_at, patient_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(created_at), str(patient_id)
+    except Exception:
+        raise ValueError(f"Некорректный курсор: {cursor}")
+
+
+class VersionConflict(Exception):
+    """Запись пациента изменена другим запросом после того, как ее прочитали"""
+
+    def __init__(self, patient_id, expected_version, actual_version):
+        super().__init__(f"Пациент {patient_id} изменен: версия {actual_version}, ожидалась {expected_version}")
+        self.patient_id = patient_id
+        self.expected_version = expected_version
+        self.actual_version = actual_version
+
 
 class PatientManager:
-    def __init__(self, db_file="patients_db.json"):
-        self.db_file = db_file
-        self.patients = {}
-        self.load_patients()
-        print(f"📁 Загружено пациентов: {len(self.patients)}")
-
-    def load_patients(self):
-        """Загружает пациентов из файла"""
-        if os.path.exists(self.db_file):
-            try:
-                with open(self.db_file, 'r', encoding='utf-8') as f:
-                    self.patients = json.load(f)
-                print(f"✅ Пациенты загружены из {self.db_file}")
-            except Exception as e:
-                print(f"❌ Ошибка загрузки пациентов: {e}")
-                self.patients = {}
+    """
+    Хранилище пациентов и истории проверок на SQLite (WAL).
+    Каждая операция пишет только затронутые строки, а не всю базу целиком.
+    При первом запуске данные переносятся из старого patients_db.json.
+
+    Безопасно для нескольких потоков и нескольких процессов (gunicorn workers):
+    у каждого потока свое соединение, все изменения идут в транзакциях
+    BEGIN IMMEDIATE, а у записи пациента есть счетчик version, который
+    увеличивается при каждом изменении (оптимистическая блокировка).
+    Код вне модуля работает только через методы, а не с таблицами напрямую.
+
+    Записи истории хранят только краткую сводку (диагноз, score, статус),
+    полный результат анализа лежит в ResultStore и читается по result_hash
+    только при открытии конкретной записи.
+    """
+
+    def __init__(self, db_file=None, json_file=None, results: ResultStore = None):
+        self.db_file = db_file or os.getenv('PATIENTS_DB_FILE', 'patients_db.sqlite3')
+        self.json_file = json_file if json_file is not None else os.getenv('PATIENTS_JSON_FILE', 'patients_db.json')
+        self.results = results or result_store
+        self.busy_timeout = int(os.getenv('PATIENTS_DB_BUSY_TIMEOUT', '10000'))
+        self._local = threading.local()
+        self._init_schema()
+
+        if self.json_file and os.path.exists(self.json_file):
+            self.migrate_from_json(self.json_file)
+
+        print(f"📁 Загружено пациентов: {self.count_patients()}")
+
+    @property
+    def conn(self):
+        """Соединение текущего потока (sqlite3 не стоит делить между потоками)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=self.busy_timeout / 1000, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute(f"PRAGMA busy_timeout={self.busy_timeout}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Пишущая транзакция. BEGIN IMMEDIATE сразу берет блокировку записи,
+        поэтому проверка и изменение внутри нее атомарны и между процессами
+        """
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def _init_schema(self):
+        conn = self.conn
+        conn.execute("PRAGMA journal_mode=WAL")
+        with self._transaction():
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS patients (
+                    id TEXT PRIMARY KEY,
+                    initials TEXT NOT NULL DEFAULT '',
+                    age INTEGER NOT NULL DEFAULT 0,
+                    gender TEXT NOT NULL DEFAULT '',
+                    diagnosis TEXT NOT NULL DEFAULT '',
+                    created_at TEXT NOT NULL,
+                    last_visit TEXT NOT NULL DEFAULT '',
+                    timeline TEXT NOT NULL DEFAULT '[]',
+                    version INTEGER NOT NULL DEFAULT 1
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS history (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    patient_id TEXT NOT NULL REFERENCES patients(id) ON DELETE CASCADE,
+                    timestamp TEXT NOT NULL,
+                    history TEXT NOT NULL DEFAULT '',
+                    diagnosis TEXT NOT NULL DEFAULT '',
+                    compliance_score REAL NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT '📋',
+                    result_hash TEXT NOT NULL DEFAULT ''
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_patient ON history(patient_id, seq)")
+
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(patients)")}
+            if "version" not in columns:
+                conn.execute("ALTER TABLE patients ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS patient_grams (
+                    gram TEXT NOT NULL,
+                    patient_id TEXT NOT NULL REFERENCES patients(id) ON DELETE CASCADE,
+                    PRIMARY KEY (gram, patient_id)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_grams_patient ON patient_grams(patient_id)")
+
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(patients)")}
+            if "initials_lc" not in columns:
+                # lower() в SQLite не понимает кириллицу, поэтому нижний регистр храним готовым
+                conn.execute("ALTER TABLE patients ADD COLUMN initials_lc TEXT NOT NULL DEFAULT ''")
+                conn.execute("ALTER TABLE patients ADD COLUMN diagnosis_lc TEXT NOT NULL DEFAULT ''")
+                for row in conn.execute("SELECT id FROM patients").fetchall():
+                    self._reindex(conn, row["id"])
+
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_created ON patients(created_at, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_last_visit ON patients(last_visit)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_initials ON patients(initials_lc)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_diagnosis ON patients(diagnosis_lc)")
+
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(history)")}
+            if "full_result" in columns:
+                self._move_results_out_of_line(conn, has_hash_column="result_hash" in columns)
+
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_result ON history(result_hash)")
+
+    def _move_results_out_of_line(self, conn, has_hash_column):
+        """Переносит full_result из таблицы history (старая схема) в ResultStore"""
+        if not has_hash_column:
+            conn.execute("ALTER TABLE history ADD COLUMN result_hash TEXT NOT NULL DEFAULT ''")
+
+        moved = 0
+        rows = conn.execute(
+            "SELECT seq, full_result FROM history WHERE full_result NOT IN ('', '{}')"
+        ).fetchall()
+        for row in rows:
+            result_hash = self.results.put(json.loads(row["full_result"]))
+            conn.execute("UPDATE history SET result_hash = ? WHERE seq = ?", (result_hash, row["seq"]))
+            moved += 1
+
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            conn.execute("ALTER TABLE history DROP COLUMN full_result")
         else:
-            self.patients = {}
+            conn.execute("UPDATE history SET full_result = ''")
+
+        print(f"✅ Результаты анализов вынесены в {self.results.root}: {moved}")
 
-    def _save_patients(self):
-        """Сохраняет пациентов в файл"""
+    def migrate_from_json(self, json_file):
+        """
+        Одноразовый перенос пациентов из patients_db.json в SQLite.
+        После успешного переноса файл переименовывается в *.migrated,
+        поэтому повторный запуск ничего не делает. Если миграцию одновременно
+        начали несколько процессов, INSERT OR IGNORE делает ее идемпотентной.
+        """
         try:
-            with open(self.db_file, 'w', encoding='utf-8') as f:
-                json.dump(self.patients, f, ensure_ascii=False, indent=2)
-            return True
+            with open(json_file, 'r', encoding='utf-8') as f:
+                patients = json.load(f)
+        except FileNotFoundError:
+            return 0
         except Exception as e:
-            print(f"❌ Ошибка сохранения пациентов: {e}")
-            return False
+            print(f"❌ Ошибка чтения {json_file} для миграции: {e}")
+            return 0
+
+        migrated = 0
+        try:
+            with self._transaction() as conn:
+                for patient_id, data in patients.items():
+                    conn.execute(
+                        "INSERT OR IGNORE INTO patients "
+                        "(id, initials, age, gender, diagnosis, created_at, last_visit, timeline) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            patient_id,
+                            data.get("initials", "") or "",
+                            data.get("age", 0) or 0,
+                            data.get("gender", "") or "",
+                            data.get("diagnosis", "") or "",
+                            data.get("created_at") or datetime.now().isoformat(),
+                            data.get("last_visit", "") or "",
+                            json.dumps(data.get("timeline", []), ensure_ascii=False)
+                        )
+                    )
+                    self._reindex(conn, patient_id)
+                    for entry in data.get("history", []):
+                        self._insert_history(conn, patient_id, entry)
+                    migrated += 1
+        except sqlite3.Error as e:
+            print(f"❌ Ошибка миграции пациентов: {e}")
+            return 0
+
+        try:
+            os.replace(json_file, json_file + ".migrated")
+        except OSError as e:
+            print(f"⚠️ Не удалось переименовать {json_file}: {e}")
+
+        print(f"✅ Перенесено пациентов из {json_file}: {migrated}")
+        return migrated
+
+    def _insert_history(self, conn, patient_id, entry):
+        # blob пишется внутри транзакции: _delete_results проверяет ссылки
+        # тоже под блокировкой записи и не удалит его до вставки строки
+        full_result = entry.get("full_result") or {}
+        result_hash = self.results.put(full_result) if full_result else ''
+
+        conn.execute(
+            "INSERT OR IGNORE INTO history "
+            "(id, patient_id, timestamp, history, diagnosis, compliance_score, status, result_hash) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                entry.get("id") or str(uuid.uuid4()),
+                patient_id,
+                entry.get("timestamp") or datetime.now().isoformat(),
+                entry.get("history", "") or "",
+                entry.get("diagnosis", "") or "",
+                entry.get("compliance_score", 0) or 0,
+                entry.get("status", "📋") or "📋",
+                result_hash
+            )
+        )
+
+    @staticmethod
+    def _bump_version(conn, patient_id):
+        conn.execute("UPDATE patients SET version = version + 1 WHERE id = ?", (patient_id,))
+
+    @staticmethod
+    def _exists(conn, patient_id):
+        return conn.execute("SELECT 1 FROM patients WHERE id = ?", (patient_id,)).fetchone() is not None
+
+    @staticmethod
+    def _row_to_patient(row):
+        patient = {field: row[field] for field in PATIENT_FIELDS}
+        patient["timeline"] = json.loads(row["timeline"] or "[]")
+        return patient
+
+    @staticmethod
+    def _row_to_entry(row):
+        return {field: row[field] for field in HISTORY_FIELDS}
+
+    @staticmethod
+    def _unreferenced(conn, result_hashes):
+        """Хэши blob'ов, на которые больше не ссылается ни одна запись истории"""
+        return [
+            result_hash for result_hash in set(result_hashes)
+            if result_hash and conn.execute(
+                "SELECT 1 FROM history WHERE result_hash = ? LIMIT 1", (result_hash,)
+            ).fetchone() is None
+        ]
+
+    def _delete_results(self, result_hashes):
+        """
+        Удаляет blob'ы после COMMIT транзакции, которая убрала ссылки на них
+        (при ROLLBACK ссылки вернулись бы, а файлы - нет). Ссылки проверяются
+        еще раз под блокировкой записи: тот же результат (blob адресуется
+        содержимым) мог уже сохранить и сослаться на него другой запрос.
+        Эта транзакция ничего не пишет в базу, поэтому ее откат не оставит
+        ссылок на удаленный файл; если удалить не удалось, файл остается
+        на диске без ссылок
+        """
+        if not result_hashes:
+            return
+        try:
+            with self._transaction() as conn:
+                for result_hash in self._unreferenced(conn, result_hashes):
+                    self.results.delete(result_hash)
+        except sqlite3.Error as e:
+            print(f"⚠️ Не удалось удалить результаты анализа: {e}")
+
+    def _hashes_for(self, conn, where, params):
+        return [row[0] for row in conn.execute(f"SELECT result_hash FROM history WHERE {where}", params)]
+
+    def count_patients(self):
+        return self.conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+
+    def _new_patient_row(self, conn, patient_id, initials="", age=0, gender=""):
+        conn.execute(
+            "INSERT OR IGNORE INTO patients (id, initials, age, gender, diagnosis, created_at, last_visit, timeline) "
+            "VALUES (?, ?, ?, ?, '', ?, '', '[]')",
+            (patient_id, initials, age, gender, datetime.now().isoformat())
+        )
+        self._reindex(conn, patient_id)
+
+    @staticmethod
+    def _reindex(conn, patient_id):
+        """Обновляет поисковые колонки и n-граммы пациента"""
+        row = conn.execute("SELECT initials, diagnosis FROM patients WHERE id = ?", (patient_id,)).fetchone()
+        if row is None:
+            return
+
+        conn.execute(
+            "UPDATE patients SET initials_lc = ?, diagnosis_lc = ? WHERE id = ?",
+            ((row["initials"] or "").lower(), (row["diagnosis"] or "").lower(), patient_id)
+        )
+
+        grams = make_grams(patient_id) | make_grams(row["initials"]) | make_grams(row["diagnosis"])
+        conn.execute("DELETE FROM patient_grams WHERE patient_id = ?", (patient_id,))
+        conn.executemany(
+            "INSERT OR IGNORE INTO patient_grams (gram, patient_id) VALUES (?, ?)",
+            [(gram, patient_id) for gram in grams]
+        )
 
     def create_patient(self, initials="", age=0, gender=""):
         """Создает нового пациента"""
         patient_id = f"patient-{uuid.uuid4().hex[:8]}"
-        
-        self.patients[patient_id] = {
-            "id": patient_id,
-            "initials": initials,
-            "age": age,
-            "gender": gender,
-            "diagnosis": "",
-            "created_at": datetime.now().isoformat(),
-            "last_visit": "",
-            "history": [],
-            "timeline": []
-        }
-        
-        self._save_patients()
+
+        with self._transaction() as conn:
+            self._new_patient_row(conn, patient_id, initials, age, gender)
+
         print(f"✅ Создан пациент {patient_id}")
         return patient_id
 
     def create_patient_with_id(self, patient_id):
         """Создает пациента с указанным ID"""
-        if patient_id not in self.patients:
-            self.patients[patient_id] = {
-                "id": patient_id,
-                "initials": "",
-                "age": 0,
-                "gender": "",
-                "diagnosis": "",
-                "created_at": datetime.now().isoformat(),
-                "last_visit": "",
-                "history": [],
-                "timeline": []
-            }
-            self._save_patients()
+        with self._transaction() as conn:
+            created = not self._exists(conn, patient_id)
+            if created:
+                self._new_patient_row(conn, patient_id)
+
+        if created:
             print(f"✅ Создан пациент с ID {patient_id}")
-        
+
         return patient_id
 
     def get_patient(self, patient_id):
-        """Возвращает данные пациента"""
-        return self.patients.get(patient_id)
-
-    def get_all_patients(self):
-        """Возвращает список всех пациентов"""
-        patients_list = []
-        for patient_id, data in self.patients.items():
-            patients_list.append({
-                "id": patient_id,
-                "initials": data.get("initials", ""),
-                "age": data.get("age", 0),
-                "gender": data.get("gender", ""),
-                "diagnosis": data.get("diagnosis", ""),
-                "last_visit": data.get("last_visit", ""),
-                "created_at": data.get("created_at", ""),
-                "history_count": len(data.get("history", []))
-            })
-        
-
-        patients_list.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-        return patients_list
-
-    def search_patients(self, query):
+        """
+        Возвращает данные пациента вместе со сводкой истории (копию, а не ссылку на хранилище).
+        Полные результаты не загружаются - для этого есть get_history_entry.
+        Поле version можно передать в update_patient для защиты от потерянных изменений.
+        """
+        conn = self.conn
+        # пациент и его история читаются из одного снимка базы
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT * FROM patients WHERE id = ?", (patient_id,)).fetchone()
+            if row is None:
+                return None
+
+            patient = self._row_to_patient(row)
+            patient["history"] = [
+                self._row_to_entry(entry)
+                for entry in conn.execute(
+                    "SELECT * FROM history WHERE patient_id = ? ORDER BY seq", (patient_id,)
+                )
+            ]
+            return patient
+        finally:
+            conn.execute("COMMIT")
+
+    def update_patient(self, patient_id, expected_version=None, **fields):
+        """
+        Обновляет карточку пациента (initials, age, gender, diagnosis).
+        Если передан expected_version, а запись уже изменил кто-то другой,
+        бросает VersionConflict. Возвращает новую версию или None, если пациента нет.
+        """
+        fields = {key: value for key, value in fields.items() if key in EDITABLE_FIELDS}
+
+        with self._transaction() as conn:
+            row = conn.execute("SELECT version FROM patients WHERE id = ?", (patient_id,)).fetchone()
+            if row is None:
+                return None
+
+            if expected_version is not None and row["version"] != expected_version:
+                raise VersionConflict(patient_id, expected_version, row["version"])
+
+            if fields:
+                assignments = ", ".join(f"{key} = ?" for key in fields)
+                conn.execute(
+                    f"UPDATE patients SET {assignments}, version = version + 1 WHERE id = ?",
+                    (*fields.values(), patient_id)
+                )
+                if "initials" in fields or "diagnosis" in fields:
+                    self._reindex(conn, patient_id)
+                return row["version"] + 1
+
+            return row["version"]
+
+    @staticmethod
+    def _row_to_summary(row):
+        return {
+            "id": row["id"],
+            "initials": row["initials"],
+            "age": row["age"],
+            "gender": row["gender"],
+            "diagnosis": row["diagnosis"],
+            "last_visit": row["last_visit"],
+            "created_at": row["created_at"],
+            "history_count": row["history_count"]
+        }
+
+    def _page_query(self, where, params, limit, after):
+        """
+        Страница пациентов в порядке (created_at, id) по убыванию.
+        Курсор - последняя выданная пара (created_at, id), поэтому страница
+        читается по индексу idx_patients_created без OFFSET
+        """
+        conditions = list(where)
+        params = list(params)
+        if after:
+            created_at, patient_id = decode_cursor(after)
+            conditions.append("(p.created_at < ? OR (p.created_at = ? AND p.id < ?))")
+            params += [created_at, created_at, patient_id]
+
+        sql = (
+            "SELECT p.*, (SELECT COUNT(*) FROM history h WHERE h.patient_id = p.id) AS history_count "
+            "FROM patients p"
+        )
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY p.created_at DESC, p.id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        return self.conn.execute(sql, params).fetchall()
+
+    def list_patients(self, limit=None, after=None):
+        """
+        Страница списка пациентов: {"patients": [...], "next_cursor": str | None}.
+        Без limit возвращаются все пациенты
+        """
+        rows = self._page_query([], [], limit + 1 if limit is not None else None, after)
+        return self._make_page(rows, limit, "patients")
+
+    def find_patients(self, query, limit=None, after=None):
+        """
+        Поиск по подстроке в ID, инициалах и диагнозе с пагинацией:
+        {"results": [...], "next_cursor": str | None}.
+        Кандидаты берутся из индекса n-грамм: запрос до 3 символов ищется
+        в нем напрямую, для длинных - пересечение триграмм с проверкой подстроки
+        """
+        query = (query or "").lower()
+        if not query:
+            rows = self._page_query([], [], limit + 1 if limit is not None else None, after)
+            return self._make_page(rows, limit, "results")
+
+        if len(query) <= MAX_GRAM:
+            rows = self._page_query(
+                ["p.id IN (SELECT patient_id FROM patient_grams WHERE gram = ?)"], [query],
+                limit + 1 if limit is not None else None, after
+            )
+            return self._make_page(rows, limit, "results")
+
+        grams = sorted(make_grams(query, MAX_GRAM) - make_grams(query, MAX_GRAM - 1))
+        placeholders = ", ".join("?" * len(grams))
+        where = [
+            f"p.id IN (SELECT patient_id FROM patient_grams WHERE gram IN ({placeholders}) "
+            f"GROUP BY patient_id HAVING COUNT(*) = ?)"
+        ]
+        params = grams + [len(grams)]
+
+        # триграммы дают надмножество, поэтому кандидатов проверяем и при нехватке дочитываем
+        matched = []
+        batch = max(limit or 200, 50)
+        cursor = after
+        while True:
+            rows = self._page_query(where, params, batch, cursor)
+            for row in rows:
+                if (query in row["id"].lower() or
+                    query in row["initials_lc"] or
+                    query in row["diagnosis_lc"]):
+                    matched.append(row)
+            if len(rows) < batch or (limit is not None and len(matched) > limit):
+                break
+            cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+
+        return self._make_page(matched, limit, "results")
+
+    def _make_page(self, rows, limit, key):
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+
+        return {key: [self._row_to_summary(row) for row in rows], "next_cursor": next_cursor}
+
+    def get_all_patients(self, limit=None, after=None):
+        """Возвращает список всех пациентов (новые первыми)"""
+        return self.list_patients(limit, after)["patients"]
+
+    def search_patients(self, query, limit=None, after=None):
         """Поиск пациентов"""
-        results = []
-        query = query.lower()
-        
-        for patient_id, data in self.patients.items():
-            if (query in patient_id.lower() or 
-                query in data.get("initials", "").lower() or
-                query in data.get("diagnosis", "").lower()):
-                results.append({
-                    "id": patient_id,
-                    "initials": data.get("initials", ""),
-                    "age": data.get("age", 0),
-                    "gender": data.get("gender", ""),
-                    "diagnosis": data.get("diagnosis", "")
-                })
-        
-        return results
+        return self.find_patients(query, limit, after)["results"]
 
     def add_history_entry(self, patient_id, history_text, analysis_result):
         """Добавляет запись в историю пациента"""
         try:
-            patient = self.get_patient(patient_id)
-            if not patient:
-                print(f"❌ Пациент {patient_id} не найден")
-                return False
-            
-
             entry_id = str(uuid.uuid4())
-            
 
             doctor_version = analysis_result.get('doctor_version', {})
             patient_version = analysis_result.get('patient_version', {})
-            
 
             diagnosis = doctor_version.get('diagnosis', {}).get('extracted', '')
             if not diagnosis:
                 diagnosis = analysis_result.get('cancer_type', 'Диагноз не указан')
-            
 
+            now = datetime.now().isoformat()
             entry = {
                 "id": entry_id,
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": now,
                 "history": history_text[:200] + "..." if len(history_text) > 200 else history_text,
                 "diagnosis": diagnosis,
                 "compliance_score": doctor_version.get('compliance_score', 0),
                 "status": patient_version.get('status', '📋'),
                 "full_result": analysis_result
             }
-            
+
+            with self._transaction() as conn:
+                if not self._exists(conn, patient_id):
+                    print(f"❌ Пациент {patient_id} не найден")
+                    return False
+
+                self._insert_history(conn, patient_id, entry)
+                conn.execute(
+                    "UPDATE patients SET last_visit = ?, version = version + 1 WHERE id = ?",
+                    (now, patient_id)
+                )
+                total = conn.execute(
+                    "SELECT COUNT(*) FROM history WHERE patient_id = ?", (patient_id,)
+                ).fetchone()[0]
+
             print(f"➕ Создана запись с ID: {entry_id}")
             print(f"   Диагноз: {entry['diagnosis']}")
             print(f"   Score: {entry['compliance_score']}")
-            
-
-            if "history" not in patient:
-                patient["history"] = []
-            
-            patient["history"].append(entry)
-            patient["last_visit"] = datetime.now().isoformat()
-            
-
-            self._save_patients()
-            
-            print(f"✅ Запись добавлена. Всего записей: {len(patient['history'])}")
+            print(f"✅ Запись добавлена. Всего записей: {total}")
             return True
-            
+
         except Exception as e:
             print(f"❌ Ошибка при добавлении записи: {e}")
             import traceback
@@ -172,56 +581,104 @@ class PatientManager:
 
     def get_patient_history(self, patient_id, limit=20):
         """Возвращает историю проверок пациента"""
-        patient = self.get_patient(patient_id)
-        if not patient:
-            return []
-        
-        history = patient.get("history", [])
+        rows = self.conn.execute(
+            "SELECT * FROM history WHERE patient_id = ? ORDER BY timestamp DESC LIMIT ?",
+            (patient_id, limit)
+        ).fetchall()
+
+        return [self._row_to_entry(row) for row in rows]
+
+    def get_history_entry(self, patient_id, entry_id):
+        """Возвращает запись истории вместе с полным результатом анализа"""
+        row = self.conn.execute(
+            "SELECT * FROM history WHERE patient_id = ? AND id = ?", (patient_id, entry_id)
+        ).fetchone()
+        if row is None:
+            return None
 
-        history.sort(key=lambda x: x.get("timestamp", ""), reverse=True)
-        
+        entry = self._row_to_entry(row)
+        entry["full_result"] = self.results.get(row["result_hash"]) or {}
+        return entry
 
-        if len(history) > limit:
-            history = history[:limit]
-        
-        return history
+    def get_latest_result(self, patient_id):
+        """Полный результат последнего анализа пациента или None"""
+        row = self.conn.execute(
+            "SELECT result_hash FROM history WHERE patient_id = ? ORDER BY seq DESC LIMIT 1", (patient_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        return self.results.get(row["result_hash"])
 
     def delete_history_entry(self, patient_id, entry_id):
         """Удаляет конкретную запись из истории"""
         try:
-            patient = self.get_patient(patient_id)
-            if not patient:
-                return False, "Пациент не найден"
-            
-            original_length = len(patient.get("history", []))
-            patient["history"] = [h for h in patient.get("history", []) if h.get("id") != entry_id]
-            new_length = len(patient.get("history", []))
-            
-            if original_length == new_length:
+            with self._transaction() as conn:
+                if not self._exists(conn, patient_id):
+                    return False, "Пациент не найден"
+
+                hashes = self._hashes_for(conn, "patient_id = ? AND id = ?", (patient_id, entry_id))
+                deleted = conn.execute(
+                    "DELETE FROM history WHERE patient_id = ? AND id = ?", (patient_id, entry_id)
+                ).rowcount
+                orphans = []
+                if deleted:
+                    self._bump_version(conn, patient_id)
+                    orphans = self._unreferenced(conn, hashes)
+
+            self._delete_results(orphans)
+            if deleted == 0:
                 return False, "Запись не найдена"
-            
-            self._save_patients()
-            return True, f"Удалено записей: {original_length - new_length}"
-            
+
+            return True, f"Удалено записей: {deleted}"
+
         except Exception as e:
             return False, str(e)
 
     def clear_patient_history(self, patient_id):
         """Очищает всю историю пациента"""
         try:
-            patient = self.get_patient(patient_id)
-            if not patient:
-                return False, "Пациент не найден"
-            
-            old_count = len(patient.get("history", []))
-            patient["history"] = []
-            patient["timeline"] = []
-            
-            self._save_patients()
+            with self._transaction() as conn:
+                if not self._exists(conn, patient_id):
+                    return False, "Пациент не найден"
+
+                hashes = self._hashes_for(conn, "patient_id = ?", (patient_id,))
+                old_count = conn.execute(
+                    "DELETE FROM history WHERE patient_id = ?", (patient_id,)
+                ).rowcount
+                orphans = self._unreferenced(conn, hashes)
+                conn.execute(
+                    "UPDATE patients SET timeline = '[]', version = version + 1 WHERE id = ?", (patient_id,)
+                )
+
+            self._delete_results(orphans)
             return True, f"Очищено записей: {old_count}"
-            
+
         except Exception as e:
             return False, str(e)
 
+    def delete_patient(self, patient_id):
+        """Удаляет пациента вместе с историей"""
+        try:
+            with self._transaction() as conn:
+                hashes = self._hashes_for(conn, "patient_id = ?", (patient_id,))
+                deleted = conn.execute("DELETE FROM patients WHERE id = ?", (patient_id,)).rowcount
+                orphans = self._unreferenced(conn, hashes)
+
+            self._delete_results(orphans)
+            if deleted == 0:
+                return False, "Пациент не найден"
+
+            return True, "Пациент удален"
+
+        except Exception as e:
+            return False, str(e)
+
+    def count_history(self, patient_id):
+        """Количество записей в истории пациента"""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM history WHERE patient_id = ?", (patient_id,)
+        ).fetchone()[0]
+
 
-patient_manager = PatientManager()
\ No newline at end of file
+patient_manager = PatientManager()
@@ -0,0 +1,230 @@
+
+import os
+import time
+import random
+import threading
+from typing import Dict, Any, Callable, Optional, TypeVar
+
+
+T = TypeVar('T')
+
+
+class CircuitOpenError(Exception):
+    """Вызов не выполнялся: предохранитель разомкнут"""
+
+
+class RetryPolicy:
+    """
+    Повторы с экспоненциальной задержкой и полным джиттером: перед попыткой
+    n+1 ждем случайное время из [0, min(max_delay, base_delay * 2^(n-1))].
+    Повтор не начинается, если задержка вместе с таймаутом следующей
+    попытки выходит за budget секунд от первой попытки - попытку, которая
+    может не уложиться в бюджет, не начинаем
+    """
+
+    def __init__(self, max_attempts: int = None, base_delay: float = None,
+                 max_delay: float = None, budget: float = None,
+                 retryable: Callable[[BaseException], bool] = None):
+        self.max_attempts = max(1, max_attempts if max_attempts is not None else int(os.getenv('DEEPSEEK_RETRY_ATTEMPTS', '3')))
+        self.base_delay = base_delay if base_delay is not None else float(os.getenv('DEEPSEEK_RETRY_BASE_DELAY', '0.5'))
+        self.max_delay = max_delay if max_delay is not None else float(os.getenv('DEEPSEEK_RETRY_MAX_DELAY', '8'))
+        self.budget = budget if budget is not None else float(os.getenv('DEEPSEEK_RETRY_BUDGET', '90'))
+        self.retryable = retryable or (lambda e: False)
+
+    def delay(self, attempt: int) -> float:
+        """Пауза после неудачной попытки номер attempt (с 1)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def should_retry(self, error: BaseException, attempt: int, elapsed: float, delay: float,
+                     budget: float = None, attempt_timeout: float = 0.0) -> bool:
+        """attempt_timeout - сколько может занять следующая попытка"""
+        budget = self.budget if budget is None else min(self.budget, budget)
+        return (attempt < self.max_attempts
+                and self.retryable(error)
+                and elapsed + delay + attempt_timeout <= budget)
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после failure_threshold ошибок подряд размыкается на
+    recovery_timeout секунд, и все вызовы сразу получают CircuitOpenError.
+    Затем пропускает один пробный вызов (half_open): успех замыкает цепь,
+    ошибка снова размыкает ее
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = None, recovery_timeout: float = None):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold if failure_threshold is not None else int(os.getenv('DEEPSEEK_BREAKER_THRESHOLD', '5')))
+        self.recovery_timeout = recovery_timeout if recovery_timeout is not None else float(os.getenv('DEEPSEEK_BREAKER_COOLDOWN', '30'))
+
+        self.lock = threading.Lock()
+        self._state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+        self.times_opened = 0
+        self.rejected = 0
+        self.last_error = None
+
+    @property
+    def state(self) -> str:
+        with self.lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and time.time() - self.opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self.probe_in_flight = False
+        return self._state
+
+    def allow(self) -> bool:
+        """Можно ли выполнить вызов сейчас"""
+        with self.lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                print(f"🔌 {self.name}: пробный запрос после паузы")
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self._state != self.CLOSED:
+                print(f"✅ {self.name}: сервис снова отвечает, предохранитель замкнут")
+            self._state = self.CLOSED
+            self.consecutive_failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self, error: BaseException = None):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.last_error = str(error) if error is not None else None
+            state = self._current_state()
+            if state == self.HALF_OPEN or (state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+                self._state = self.OPEN
+                self.opened_at = time.time()
+                self.probe_in_flight = False
+                self.times_opened += 1
+                print(f"⛔ {self.name}: {self.consecutive_failures} ошибок подряд, "
+                      f"предохранитель разомкнут на {self.recovery_timeout:.0f} с")
+
+    def release(self):
+        """Вызов завершился ошибкой, которая ничего не говорит о сервисе: пробный слот освобождается"""
+        with self.lock:
+            self.probe_in_flight = False
+
+    def reset(self):
+        with self.lock:
+            self._state = self.CLOSED
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            state = self._current_state()
+            return {
+                'state': state,
+                'consecutive_failures': self.consecutive_failures,
+                'failure_threshold': self.failure_threshold,
+                'recovery_timeout': self.recovery_timeout,
+                'retry_in': round(max(0.0, self.opened_at + self.recovery_timeout - time.time()), 1)
+                if state == self.OPEN else 0,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected,
+                'last_error': self.last_error
+            }
+
+
+class Resilience:
+    """
+    Общая обвязка внешнего вызова: предохранитель + повторы по RetryPolicy.
+    Ошибки, которые политика не считает временными, пробрасываются сразу
+    и предохранитель не размыкают (сервис ответил, неверен сам запрос).
+    neutral - ошибки вызывающей стороны (например, исчерпан ее дедлайн):
+    они не повторяются и не считаются ни успехом, ни отказом сервиса
+    """
+
+    def __init__(self, policy: RetryPolicy, breaker: CircuitBreaker,
+                 sleep: Callable[[float], None] = time.sleep,
+                 neutral: Callable[[BaseException], bool] = None):
+        self.policy = policy
+        self.breaker = breaker
+        self.sleep = sleep
+        self.neutral = neutral or (lambda e: False)
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    def call(self, func: Callable[[], T], budget: float = None, attempt_timeout: float = 0.0) -> T:
+        """
+        budget - сколько секунд вызывающий готов ждать вместе с повторами,
+        attempt_timeout - таймаут одной попытки: повтор начинается, только
+        если и пауза, и вся попытка укладываются в бюджет
+        """
+        with self.lock:
+            self.calls += 1
+
+        started = time.time()
+        attempt = 0
+        last_error: Optional[BaseException] = None
+        while True:
+            if not self.breaker.allow():
+                if last_error is not None:
+                    with self.lock:
+                        self.failures += 1
+                raise CircuitOpenError(
+                    f"{self.breaker.name} временно недоступен (предохранитель разомкнут)"
+                    + (f": {last_error}" if last_error is not None else '')
+                ) from last_error
+
+            attempt += 1
+            try:
+                result = func()
+            except Exception as e:
+                if self.neutral(e):
+                    self.breaker.release()
+                    raise
+                if not self.policy.retryable(e):
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure(e)
+                last_error = e
+
+                delay = self.policy.delay(attempt)
+                if not self.policy.should_retry(e, attempt, time.time() - started, delay, budget, attempt_timeout):
+                    with self.lock:
+                        self.failures += 1
+                    raise
+                with self.lock:
+                    self.retries += 1
+                print(f"🔄 {self.breaker.name}: {e}; повтор {attempt + 1}/{self.policy.max_attempts} через {delay:.1f} с")
+                self.sleep(delay)
+                continue
+
+            self.breaker.record_success()
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            counters = {'calls': self.calls, 'retries': self.retries, 'failures': self.failures}
+        return {
+            'breaker': self.breaker.stats(),
+            'retry': {
+                'max_attempts': self.policy.max_attempts,
+                'base_delay': self.policy.base_delay,
+                'max_delay': self.policy.max_delay,
+                'budget': self.policy.budget
+            },
+            **counters
+        }
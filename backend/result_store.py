@@ -0,0 +1,80 @@
+
+import os
+import json
+import zlib
+import hashlib
+import tempfile
+from typing import Dict, Any, Optional
+
+
+class ResultStore:
+    """
+    Хранилище полных результатов анализа вне записи пациента.
+    Результат сериализуется в канонический JSON, сжимается zlib и кладется
+    в файл, имя которого - sha256 содержимого (одинаковые результаты
+    хранятся один раз). Файлы разложены по подкаталогам по первым двум
+    символам хэша, чтобы каталоги не разрастались.
+    """
+
+    def __init__(self, root: str = None, compress_level: int = 6):
+        self.root = root or os.getenv('RESULTS_STORE_DIR', 'results_store')
+        self.compress_level = compress_level
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, result_hash: str) -> str:
+        return os.path.join(self.root, result_hash[:2], result_hash)
+
+    @staticmethod
+    def serialize(result: Dict[str, Any]) -> bytes:
+        return json.dumps(result, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+
+    def put(self, result: Dict[str, Any]) -> str:
+        """Сохраняет результат и возвращает его хэш"""
+        data = self.serialize(result)
+        result_hash = hashlib.sha256(data).hexdigest()
+        path = self._path(result_hash)
+
+        if os.path.exists(path):
+            return result_hash
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # запись через временный файл + rename: читатель никогда не увидит половину blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(data, self.compress_level))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return result_hash
+
+    def get(self, result_hash: str) -> Optional[Dict[str, Any]]:
+        """Загружает результат по хэшу или None, если его нет"""
+        if not result_hash:
+            return None
+
+        try:
+            with open(self._path(result_hash), 'rb') as f:
+                return json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        except FileNotFoundError:
+            return None
+        except (zlib.error, ValueError) as e:
+            print(f"❌ Поврежден результат {result_hash}: {e}")
+            return None
+
+    def exists(self, result_hash: str) -> bool:
+        return bool(result_hash) and os.path.exists(self._path(result_hash))
+
+    def delete(self, result_hash: str):
+        try:
+            os.remove(self._path(result_hash))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"⚠️ Не удалось удалить результат {result_hash}: {e}")
+
+
+result_store = ResultStore()
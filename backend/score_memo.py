@@ -0,0 +1,149 @@
+
+import os
+import copy
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
+
+
+class ScoreMemo:
+    """
+    Кэш результатов calculate_score_from_protocols в памяти процесса.
+    Ключ - версия корпуса рекомендаций и sha256 канонического JSON входа:
+    препараты внутри линии и сами линии сортируются, биомаркеры - по ключу,
+    поэтому порядок ввода на ключ не влияет. Хранится не больше max_entries
+    результатов (LRU). Результат с оценками AI живет, пока в кэше ответов
+    DeepSeek лежит самая старая из этих оценок (expires_at), и не дольше ai_ttl.
+    """
+
+    def __init__(self, max_entries: int = None, ai_ttl: int = None):
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv('SCORE_MEMO_SIZE', '2048'))
+        self.ai_ttl = ai_ttl if ai_ttl is not None else int(os.getenv('DEEPSEEK_CACHE_TTL', str(7 * 24 * 3600)))
+        self.enabled = os.getenv('SCORE_MEMO', '1') != '0' and self.max_entries > 0
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    @staticmethod
+    def canonicalize(treatment_lines: Dict[str, Any]) -> Tuple[Dict[str, Any], List[int]]:
+        """
+        Каноническая форма линий: препараты каждой линии и сами линии
+        отсортированы, из линии остаются только поля, которые читает scorer.
+        Второе значение - исходный номер (по порядку ввода) каждого препарата
+        канонической формы, по нему findings возвращаются в порядок ввода
+        """
+        numbered = []
+        order = 0
+        for line_data in treatment_lines.get('lines', []):
+            treatments = list(line_data.get('treatments', []) or [])
+            numbered.append((line_data, treatments, list(range(order, order + len(treatments)))))
+            order += len(treatments)
+
+        lines = []
+        for line_data, treatments, positions in numbered:
+            perm = sorted(range(len(treatments)), key=lambda j: str(treatments[j]))
+            line = {
+                'line': line_data.get('line', 1),
+                'treatments': [treatments[j] for j in perm],
+                'response': line_data.get('response', '')
+            }
+            lines.append((json.dumps(line, ensure_ascii=False, sort_keys=True, default=str), line,
+                          [positions[j] for j in perm]))
+        lines.sort(key=lambda item: item[0])
+
+        canonical = {'lines': [line for _, line, _ in lines], 'planned': None}
+        positions = [p for _, line, line_positions in lines if line['treatments'] for p in line_positions]
+
+        planned = treatment_lines.get('planned')
+        if planned:
+            treatments = list(planned.get('treatments', []) or [])
+            perm = sorted(range(len(treatments)), key=lambda j: str(treatments[j]))
+            canonical['planned'] = {'treatments': [treatments[j] for j in perm]}
+            positions.extend(order + j for j in perm)
+
+        return canonical, positions
+
+    @staticmethod
+    def fingerprint(cancer_type: str, canonical_lines: Dict[str, Any],
+                    biomarkers: Dict[str, bool], use_ai: bool) -> str:
+        """sha256 канонического JSON входа scorer (линии - из canonicalize)"""
+        raw = json.dumps({
+            'cancer_type': cancer_type,
+            'treatment_lines': canonical_lines,
+            'biomarkers': biomarkers or {},
+            'use_ai': bool(use_ai)
+        }, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def restore_order(result: Dict[str, Any], positions: List[int]) -> Dict[str, Any]:
+        """
+        Переставляет findings результата, посчитанного по канонической форме,
+        в порядок ввода: на каждый препарат приходится ровно одна находка
+        """
+        findings = result.get('findings', [])
+        if len(findings) == len(positions):
+            result['findings'] = [f for _, f in sorted(zip(positions, findings), key=lambda item: item[0])]
+        return result
+
+    def get(self, version: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Копия сохраненного результата или None"""
+        if not self.enabled:
+            return None
+
+        key = (version, fingerprint)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            result = entry[0]
+
+        return copy.deepcopy(result)
+
+    def put(self, version: str, fingerprint: str, result: Dict[str, Any], uses_ai: bool = False,
+            expires_at: float = None):
+        """expires_at - когда из кэша ответов пропадет первая из оценок AI результата"""
+        if not self.enabled:
+            return
+
+        expires = None
+        if uses_ai:
+            expires = time.time() + self.ai_ttl
+            if expires_at is not None:
+                expires = min(expires, expires_at)
+        result = copy.deepcopy(result)
+        with self.lock:
+            self.entries[(version, fingerprint)] = (result, expires)
+            self.entries.move_to_end((version, fingerprint))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def skip(self):
+        """Результат не сохранен: в нем есть оценки AI, которых нет в кэше ответов"""
+        with self.lock:
+            self.skipped += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups * 100, 1) if lookups > 0 else 0,
+                'skipped_ai': self.skipped,
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'enabled': self.enabled
+            }
@@ -1,9 +1,16 @@
 
 import os
-import json
+import copy
 import re
+import threading
+import contextvars
 from typing import Dict, List, Any, Optional, Tuple
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
+from guideline_corpus import GuidelineCorpus, guideline_corpus
+from drug_recognizer import drug_canonicalizer
+from score_memo import ScoreMemo
 
 
 class ComplianceScorer:
@@ -11,10 +18,17 @@ class ComplianceScorer:
     Расчет compliance_score на основе базы Минздрава с AI-дополнением
     """
     
-    def __init__(self):
+    # линии протокола, за совпадение с которыми дается бонус: 1, 2 и 3+ линия
+    LINE_BONUS = {
+        1: ('first_line', 'adjuvant', 'neoadjuvant'),
+        2: ('second_line', 'metastatic'),
+        3: ('third_line', 'metastatic')
+    }
+
+    def __init__(self, corpus: GuidelineCorpus = None):
         self.max_score = 100
         self.max_score_per_treatment = 25
-        self.protocols_db = {}  
+        self.max_parallel_ai_calls = 8
         self.line_weights = {
             'first_line': 1.0,    
             'second_line': 0.9,     
@@ -26,288 +40,276 @@ class ComplianceScorer:
             'metastatic': 0.8       
         }
         
-
-        self.drug_families = {
-
-            'трастузумаб': ['трастузумаб', 'герцептин', 'trastuzumab'],
-            'трастузумаб дерукстекан': ['трастузумаб дерукстекан', 'энхерту', 'tdxd', 'trastuzumab deruxtecan', 'трастузумаб'],
-            'трастузумаб-эмтансин': ['трастузумаб-эмтансин', 'т-дм1', 't-dm1', 'кадсила', 'трастузумаб'],
-            'пертузумаб': ['пертузумаб', 'перьета', 'pertuzumab'],
-            'тукатиниб': ['тукатиниб', 'tukysa', 'tucatinib'],
-            
-
-            'паклитаксел': ['паклитаксел', 'taxol', 'paclitaxel', 'таксан'],
-            'доцетаксел': ['доцетаксел', 'taxotere', 'docetaxel', 'таксан'],
-            
-
-            'карбоплатин': ['карбоплатин', 'carboplatin', 'платина'],
-            'цисплатин': ['цисплатин', 'cisplatin', 'платина'],
-            'оксалиплатин': ['оксалиплатин', 'oxaliplatin', 'платина'],
-            
-
-            'капецитабин': ['капецитабин', 'кселода', 'capecitabine'],
-            'фторурацил': ['фторурацил', '5fu', '5-фторурацил', 'fluorouracil'],
-            
-
-            'иринотекан': ['иринотекан', 'camptosar', 'irinotecan'],
-            
-
-            'рамуцирумаб': ['рамуцирумаб', 'цирамза', 'ramucirumab'],
-            'бевацизумаб': ['бевацизумаб', 'авастин', 'bevacizumab'],
-            
-
-            'гефитиниб': ['гефитиниб', 'иресса', 'gefitinib'],
-            'эрлотиниб': ['эрлотиниб', 'тарцева', 'erlotinib'],
-            'осимертиниб': ['осимертиниб', 'тагрессо', 'osimertinib'],
-            
-
-            'алектиниб': ['алектиниб', 'алеценза', 'alectinib'],
-            'кризотиниб': ['кризотиниб', 'ксалкори', 'crizotinib'],
-            'церитиниб': ['церитиниб', 'зикадия', 'ceritinib'],
-            
-
-            'дабрафениб': ['дабрафениб', 'тафинлар', 'dabrafenib'],
-            'траметиниб': ['траметиниб', 'мекинист', 'trametinib'],
-            'вемурафениб': ['вемурафениб', 'зельбораф', 'vemurafenib'],
-            
-
-            'пембролизумаб': ['пембролизумаб', 'кейтруда', 'pembrolizumab'],
-            'ниволумаб': ['ниволумаб', 'опдиво', 'nivolumab'],
-            'атезолизумаб': ['атезолизумаб', 'тецентрик', 'atezolizumab'],
-            
-
-            'доксорубицин': ['доксорубицин', 'адриамицин', 'doxorubicin'],
-            'эпирубицин': ['эпирубицин', 'epirubicin'],
-            
-
-            'циклофосфамид': ['циклофосфамид', 'cyclophosphamide'],
-            'ифосфамид': ['ифосфамид', 'ifosfamide'],
-            'митомицин': ['митомицин', 'mitomycin'],
-            'митотан': ['митотан', 'mitotane'],
-            
-
-            'тамоксифен': ['тамоксифен', 'tamoxifen'],
-            'летрозол': ['летрозол', 'letrozole', 'фемара'],
-            'анастрозол': ['анастрозол', 'anastrozole', 'аримидекс'],
-            'эксеместан': ['эксеместан', 'exemestane', 'аромазин'],
-            'фулвестрант': ['фулвестрант', 'fulvestrant', 'фаслодекс'],
-
-            'палбоциклиб': ['палбоциклиб', 'palbociclib', 'ибранс'],
-            'рибоциклиб': ['рибоциклиб', 'ribociclib', 'кискали'],
-            'абемациклиб': ['абемациклиб', 'abemaciclib', 'верзенио'],
-            
-            'этопозид': ['этопозид', 'etoposide'],
-            'винбластин': ['винбластин', 'vinblastine'],
-            'винкристин': ['винкристин', 'vincristine'],
-            'блеомицин': ['блеомицин', 'bleomycin'],
-            'пеметрексед': ['пеметрексед', 'alimta', 'pemetrexed'],
-            'винорельбин': ['винорельбин', 'navelbine', 'vinorelbine'],
-            'эрибулин': ['эрибулин', 'eribulin', 'халавен'],
-        }
-        
-
-        self._load_protocols_from_json()
+        self.canonical = drug_canonicalizer
+        self.memo = ScoreMemo()
+        # были ли в текущем расчете оценки AI не из кэша ответов (по потокам)
+        self._ai_state = threading.local()
+        self.corpus = corpus or guideline_corpus
+        self.protocols_db = self.corpus.scoring_db()
+        # с какого числа протоколов типа рака матричное ранжирование быстрее
+        # кандидатов из инвертированного индекса (см. benchmark_scoring.py)
+        self.matrix_min_protocols = int(os.getenv('SCORING_MATRIX_MIN_PROTOCOLS', '10'))
+        self._build_protocol_index()
+        self._cached_treatment_hits = lru_cache(maxsize=8192)(self._treatment_hits)
+        print(f"📚 Протоколы для скоринга: {len(self.protocols_db)} типов рака, "
+              f"{sum(len(p) for p in self.protocols_db.values())} протоколов")
     
-    def _load_protocols_from_json(self):
-        """Загружает все протоколы из запаршенных JSON файлов"""
-        print("\n" + "="*60)
-        print("📚 ЗАГРУЗКА ПРОТОКОЛОВ ИЗ БАЗЫ МИНЗДРАВА")
-        print("="*60)
-        
-
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        json_dir = os.path.join(os.path.dirname(current_dir), 'data')
-        
-        if not os.path.exists(json_dir):
-            print(f"❌ Папка {json_dir} не найдена")
-            print(f"   Создайте папку data и поместите туда JSON файлы")
-            return
-        
-        json_files = glob(os.path.join(json_dir, '*_parsed.json'))
-        print(f"🔍 Найдено JSON файлов: {len(json_files)}")
+    def _build_protocol_index(self):
+        """
+        Индексы протоколов для _find_matching_protocol, по каждому типу рака.
+        Инвертированный индекс (для типов с малым числом протоколов):
+        - drug_positions: препарат протокола (как записан) -> номера протоколов
+        - by_family: номер семейства -> номера протоколов
+        - first_by_line: линия -> первый протокол этой линии
+        Битовые матрицы (для типов, где протоколов не меньше matrix_min_protocols):
+        - drugs: протокол x препарат протокола (как записан, в нижнем регистре)
+        - families: протокол x семейство DRUG_FAMILIES
+        - line_bonus: группа линии (1, 2, 3+) -> бонус за линию для каждого протокола
+        Препараты протоколов канонизируются здесь один раз и закрепляются в кэше
+        """
+        self.protocol_index = {}
+        family_count = len(self.canonical.recognizer.family_ids)
+        
+        for cancer_type, protocols in self.protocols_db.items():
+            vocab = list(self.corpus.drug_index(cancer_type))
+            vocab_ids = {drug: j for j, drug in enumerate(vocab)}
+            drugs = np.zeros((len(protocols), len(vocab)), dtype=bool)
+            families = np.zeros((len(protocols), family_count), dtype=bool)
+            by_family = {}
+            first_by_line = {}
+            
+            for i, protocol in enumerate(protocols):
+                first_by_line.setdefault(protocol.get('line', 'unknown'), i)
+                for pm in protocol.get('medications', []):
+                    family_ids = self.canonical.pin(pm).family_ids
+                    drugs[i, vocab_ids[str(pm).lower()]] = True
+                    families[i, list(family_ids)] = True
+                    for family_id in family_ids:
+                        by_family.setdefault(family_id, set()).add(i)
+            
+            protocol_lines = [protocol.get('line', 'unknown') for protocol in protocols]
+            # группа 0 (линия 0 и меньше) бонуса не дает
+            line_bonus = {0: np.zeros(len(protocols), dtype=np.int64)}
+            for group, bonus_lines in self.LINE_BONUS.items():
+                line_bonus[group] = np.array([30 if line in bonus_lines else 0 for line in protocol_lines], dtype=np.int64)
+            
+            self.protocol_index[cancer_type] = {
+                'use_matrix': len(protocols) >= self.matrix_min_protocols,
+                'drug_positions': self.corpus.drug_index(cancer_type),
+                'by_family': by_family,
+                'first_by_line': first_by_line,
+                'vocab': vocab,
+                'drugs': drugs,
+                'families': families,
+                'line_bonus': line_bonus
+            }
+    
+    def _protocols_matching_treatment(self, index: Dict[str, Any], treatment: str) -> set:
+        """
+        Номера протоколов, где хотя бы один препарат совпадает с назначенным
+        по правилам _is_drug_match (подстрока или общее семейство)
+        """
+        drug = self.canonical.get(treatment)
+        positions = set()
         
-        if not json_files:
-            print("⚠️ Нет файлов *_parsed.json в папке data")
-            return
+        for protocol_drug, drug_positions in index['drug_positions'].items():
+            if protocol_drug in drug.text or drug.text in protocol_drug:
+                positions.update(drug_positions)
         
-        loaded_count = 0
-        total_protocols = 0
+        for family_id in drug.family_ids:
+            positions.update(index['by_family'].get(family_id, ()))
         
-        for json_file in json_files:
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-
-                filename = os.path.basename(json_file)
-                cancer_type = filename.replace('_parsed.json', '')
-                
-
-                cancer_type = self._map_cancer_type(cancer_type)
-                
-                protocols = self._extract_protocols(data)
-                
-                if protocols:
-                    self.protocols_db[cancer_type] = protocols
-                    loaded_count += 1
-                    total_protocols += len(protocols)
-                    print(f"  ✅ {cancer_type:25} → {len(protocols):2} протоколов")
-                    
-            except Exception as e:
-                print(f"  ❌ Ошибка загрузки {os.path.basename(json_file)}: {e}")
-        
-        print(f"\n📊 ИТОГИ ЗАГРУЗКИ:")
-        print(f"   ✅ Загружено типов рака: {loaded_count}")
-        print(f"   📚 Всего протоколов: {total_protocols}")
-        print(f"   🎯 Доступные типы: {', '.join(self.protocols_db.keys())}")
-        print("="*60)
-    
-    def _map_cancer_type(self, filename: str) -> str:
-        """Маппит имена файлов на наши типы"""
-        mapping = {
-            'breast_cancer': 'breast',
-            'lung_cancer': 'lung',
-            'stomach_cancer': 'stomach',
-            'colon_cancer': 'colon',
-            'rectal_cancer': 'rectal',
-            'prostate_cancer': 'prostate',
-            'pancreatic_cancer': 'pancreatic',
-            'esophageal_cancer': 'esophageal',
-            'liver_cancer': 'liver',
-            'kidney_cancer': 'kidney',
-            'bladder_cancer': 'bladder',
-            'ovarian_cancer': 'ovarian',
-            'cervical_cancer': 'cervical',
-            'uterine_cancer': 'uterine',
-            'melanoma': 'melanoma',
-            'thyroid_cancer': 'thyroid',
-            'cancer_unknown_primary': 'cancer_unknown_primary',
-            'bone_sarcoma': 'bone_sarcoma',
-            'soft_tissue_sarcoma': 'soft_tissue_sarcoma',
-            'gist': 'gist',
-            'anal_cancer': 'anal',
-            'testicular_cancer': 'testicular',
-            'head_neck_cancer': 'head_neck',
-            'adrenal_cancer': 'adrenal',
-            'brain_metastasis': 'brain',
-            'cns_tumors': 'brain',
-            'kidney_parenchyma_cancer': 'kidney',
-            'ovarian_borderline': 'ovarian',
-            'ovarian_nonepithelial': 'ovarian',
-        }
-        return mapping.get(filename, filename)
-    
-    def _extract_protocols(self, data: dict) -> List[dict]:
-        """Извлекает протоколы из JSON структуры"""
-        protocols = []
-        
-        if 'treatment_protocols' in data:
-            for p in data['treatment_protocols']:
-                protocol = {
-                    'name': p.get('protocol_name', ''),
-                    'condition': p.get('condition', ''),
-                    'stage': p.get('stage', ''),
-                    'line': self._detect_line(p.get('condition', '') + ' ' + p.get('protocol_name', '')),
-                    'medications': p.get('medications', []),
-                    'treatment_steps': p.get('treatment_steps', []),
-                    'source': 'Минздрав РФ'
-                }
-                if protocol['medications']:  
-                    protocols.append(protocol)
-        
-        if 'clinical_recommendations' in data:
-            recs = data['clinical_recommendations']
-            if 'specific' in recs and isinstance(recs['specific'], list):
-                for rec in recs['specific']:
-                    if isinstance(rec, str):
-                        drugs = self._extract_drugs_from_text(rec)
-                        if drugs:
-                            protocol = {
-                                'name': 'Клиническая рекомендация',
-                                'condition': rec[:100],
-                                'line': self._detect_line(rec),
-                                'medications': drugs,
-                                'source': 'Минздрав РФ'
-                            }
-                            protocols.append(protocol)
-        
-        return protocols
-    
-    def _detect_line(self, text: str) -> str:
-        """Определяет линию терапии из текста"""
-        text_lower = text.lower()
-        
-        if any(x in text_lower for x in ['первая линия', 'first-line', '1st', 'первой линии']):
-            return 'first_line'
-        elif any(x in text_lower for x in ['вторая линия', 'second-line', '2nd', 'второй линии']):
-            return 'second_line'
-        elif any(x in text_lower for x in ['третья линия', 'third-line', '3rd', 'третьей линии']):
-            return 'third_line'
-        elif any(x in text_lower for x in ['адъювант', 'adjuvant']):
-            return 'adjuvant'
-        elif any(x in text_lower for x in ['неоадъювант', 'neoadjuvant']):
-            return 'neoadjuvant'
-        elif any(x in text_lower for x in ['метастатич', 'metastatic']):
-            return 'metastatic'
-        else:
-            return 'unknown'
+        return positions
     
-    def _extract_drugs_from_text(self, text: str) -> List[str]:
-        """Извлекает препараты из текста"""
-        known_drugs = [
-            'паклитаксел', 'карбоплатин', 'цисплатин', 'гемцитабин',
-            'трастузумаб', 'трастузумаб дерукстекан', 'пертузумаб', 'тукатиниб',
-            'осимертиниб', 'гефитиниб', 'эрлотиниб', 'алектиниб',
-            'пембролизумаб', 'ниволумаб', 'атезолизумаб', 'бевацизумаб',
-            'рамуцирумаб', 'иринотекан', 'доцетаксел', 'капецитабин',
-            'оксалиплатин', 'фторурацил', 'этопозид', 'доксорубицин',
-            'циклофосфамид', 'метотрексат', 'винорельбин', 'эрибулин'
-        ]
+    def _treatment_hits(self, cancer_type: str, treatment: str) -> np.ndarray:
+        """
+        Битовый вектор протоколов типа рака, в которых есть препарат, совпадающий
+        с назначением (по подстроке в обе стороны или по семейству): два
+        матричных произведения. Результат кэшируется (LRU) по (тип рака, назначение)
+        """
+        index = self.protocol_index[cancer_type]
+        drug = self.canonical.get(treatment)
         
-        found = []
-        text_lower = text.lower()
-        for drug in known_drugs:
-            if drug in text_lower:
-                found.append(drug)
+        drug_row = np.array([protocol_drug in drug.text or drug.text in protocol_drug
+                             for protocol_drug in index['vocab']], dtype=bool)
+        family_row = np.zeros(index['families'].shape[1], dtype=bool)
+        family_row[list(drug.family_ids)] = True
         
-        return found
+        hits = (index['drugs'] @ drug_row) | (index['families'] @ family_row)
+        hits.setflags(write=False)
+        return hits
     
     def _is_drug_match(self, prescribed: str, protocol_drug: str) -> Tuple[bool, str]:
         """
         Проверяет, соответствует ли назначенный препарат препарату из протокола
-        с учетом синонимов и семейств
+        с учетом синонимов и семейств (семейства сравниваются как битовые маски)
         """
-        prescribed_lower = prescribed.lower()
-        protocol_lower = protocol_drug.lower()
+        prescribed_drug = self.canonical.get(prescribed)
+        protocol = self.canonical.get(protocol_drug)
         
 
-        if protocol_lower in prescribed_lower or prescribed_lower in protocol_lower:
+        if protocol.text in prescribed_drug.text or prescribed_drug.text in protocol.text:
             return True, 'exact'
         
 
-        for family, members in self.drug_families.items():
-            protocol_in_family = any(member in protocol_lower for member in members)
-            prescribed_in_family = any(member in prescribed_lower for member in members)
-            
-            if prescribed_in_family and protocol_in_family:
-                return True, 'family'
+        if prescribed_drug.family_mask & protocol.family_mask:
+            return True, 'family'
         
         return False, 'none'
     
     def calculate_score_from_protocols(self,
                                       cancer_type: str,
                                       treatment_lines: Dict[str, Any],
-                                      biomarkers: Dict[str, bool]) -> Dict[str, Any]:
+                                      biomarkers: Dict[str, bool],
+                                      use_ai: bool = True) -> Dict[str, Any]:
         """
         Расчет score на основе протоколов из базы Минздрава
+        use_ai=False - без обращений к LLM (пакетный пересчет): линии без
+        подходящего протокола не оцениваются и не входят в score.
+        Считается по канонической форме линий (порядок линий и препаратов не
+        важен) и запоминается (ScoreMemo) для этой версии корпуса; результат
+        с оценками AI - только если все они взяты из кэша ответов
         """
+        canonical_lines, positions = self.memo.canonicalize(treatment_lines)
+        version = self.corpus.version
+        fingerprint = self.memo.fingerprint(cancer_type, canonical_lines, biomarkers, use_ai)
+        
+        result = self.memo.get(version, fingerprint)
+        if result is not None:
+            print(f"⚡ Score для {cancer_type} взят из кэша результатов")
+            return self.memo.restore_order(result, positions)
+        
+        self._ai_state.fresh = False
+        self._ai_state.expires_at = None
+        result = self._calculate_score_from_protocols(cancer_type, canonical_lines, biomarkers, use_ai)
+        
+        result['corpus_version'] = version
+        uses_ai = result.get('source') in ('mixed', 'ai_only')
+        if uses_ai and self._ai_state.fresh:
+            self.memo.skip()
+        else:
+            self.memo.put(version, fingerprint, result, uses_ai=uses_ai, expires_at=self._ai_state.expires_at)
+        return self.memo.restore_order(result, positions)
+    
+    def rescore(self, cancer_type: str, treatment_lines: Dict[str, Any], biomarkers: Dict[str, bool],
+                previous_lines: Dict[str, Any], previous_result: Dict[str, Any],
+                previous_biomarkers: Dict[str, bool]) -> Dict[str, Any]:
+        """
+        Инкрементальный пересчет после уточнения данных (/api/update-analysis).
+        Линия берется из previous_result как есть, если она была в previous_lines
+        в том же виде и изменившиеся биомаркеры ее не затрагивают: у линии по
+        протоколу не меняется штраф за критические ошибки (только через него
+        биомаркеры влияют на выбор протокола), у линии с оценкой AI биомаркеры
+        не изменились вовсе (они входят в запрос). Остальные линии оцениваются
+        заново, и AI вызывается только для них
+        """
+        version = self.corpus.version
+        previous = None
+        if previous_result and previous_result.get('corpus_version') == version:
+            previous = self._split_findings(previous_lines, previous_result.get('findings', []))
+        if previous is None:
+            print("🔄 Предыдущую оценку нельзя переиспользовать, полный пересчет")
+            return self.calculate_score_from_protocols(cancer_type, treatment_lines, biomarkers)
+        
+        available = {}
+        for key, findings in previous:
+            available.setdefault(key, []).append(findings)
+        
+        groups = [(idx, line_data.get('line', 1), line_data.get('response', ''), line_data.get('treatments', []))
+                  for idx, line_data in enumerate(treatment_lines.get('lines', []))]
+        planned = treatment_lines.get('planned')
+        if planned and planned.get('treatments'):
+            groups.append(('planned', 'planned', None, planned['treatments']))
+        
+        reuse = {}
+        for idx, line_num, response, treatments in groups:
+            candidates = available.get(self._line_key(line_num, response, treatments))
+            if not treatments or not candidates:
+                continue
+            findings = candidates[0]
+            line_result = {
+                'score': sum(f.get('score_contributed', 0) for f in findings),
+                'max_score': len(treatments) * self.max_score_per_treatment,
+                'findings': copy.deepcopy(findings)
+            }
+            if any(f.get('source') == 'none' for f in findings):
+                continue
+            if self._is_ai_result(line_result):
+                if (biomarkers or {}) != (previous_biomarkers or {}):
+                    continue
+            elif self._critical_errors(treatments, biomarkers) != self._critical_errors(treatments, previous_biomarkers):
+                continue
+            candidates.pop(0)
+            reuse[idx] = line_result
+        
+        print(f"🔄 Инкрементальный пересчет: переиспользовано линий {len(reuse)} из {len([g for g in groups if g[3]])}")
+        result = self._calculate_score_from_protocols(cancer_type, treatment_lines, biomarkers, True, reuse=reuse)
+        result['corpus_version'] = version
+        result['reused_lines'] = len(reuse)
+        return result
+    
+    @staticmethod
+    def _line_key(line_num: Any, response: Any, treatments: List[str]) -> tuple:
+        return (line_num, response if line_num != 'planned' else None, tuple(treatments))
+    
+    def _split_findings(self, treatment_lines: Dict[str, Any],
+                        findings: List[dict]) -> Optional[List[Tuple[tuple, List[dict]]]]:
+        """
+        Делит findings результата по линиям, для которых он считался (по одной
+        находке на препарат, в порядке линий). None, если результат не сходится
+        с линиями (например, посчитан старым способом)
+        """
+        groups = [(line_data.get('line', 1), line_data.get('response', ''), line_data.get('treatments', []))
+                  for line_data in (treatment_lines or {}).get('lines', []) if line_data.get('treatments')]
+        planned = (treatment_lines or {}).get('planned')
+        if planned and planned.get('treatments'):
+            groups.append(('planned', None, planned['treatments']))
+        
+        if sum(len(treatments) for _, _, treatments in groups) != len(findings):
+            return None
+        
+        result, pos = [], 0
+        for line_num, response, treatments in groups:
+            line_findings = findings[pos:pos + len(treatments)]
+            pos += len(treatments)
+            if [f.get('treatment') for f in line_findings] != list(treatments):
+                return None
+            result.append((self._line_key(line_num, response, treatments), line_findings))
+        return result
+    
+    @staticmethod
+    def _is_ai_result(line_result: dict) -> bool:
+        return any(f.get('source') == 'ai' for f in line_result.get('findings', []))
+    
+    def _calculate_score_from_protocols(self,
+                                        cancer_type: str,
+                                        treatment_lines: Dict[str, Any],
+                                        biomarkers: Dict[str, bool],
+                                        use_ai: bool,
+                                        reuse: Dict[Any, dict] = None) -> Dict[str, Any]:
+        """
+        reuse - готовые оценки линий {индекс линии или 'planned': результат линии}
+        (см. rescore): такие линии не подбираются к протоколам и не уходят в AI
+        """
+        reuse = reuse or {}
 
         protocols = self.protocols_db.get(cancer_type, [])
         
         if not protocols:
+            if not use_ai:
+                print(f"⏭️ Нет протоколов в базе для {cancer_type}, AI-оценка отключена")
+                return {
+                    'score': None,
+                    'findings': [],
+                    'source': 'no_protocols',
+                    'message': f"Нет протоколов Минздрава для {cancer_type}, AI-оценка отключена",
+                    'analyzed_lines': 0,
+                    'unscored_lines': len([l for l in treatment_lines.get('lines', []) if l.get('treatments')]),
+                    'protocols_available': 0
+                }
 
             print(f"🤖 Нет протоколов в базе для {cancer_type}, использую AI-оценку")
-            return self._calculate_with_ai(cancer_type, treatment_lines, biomarkers)
+            return self._calculate_with_ai(cancer_type, treatment_lines, biomarkers, reuse=reuse)
         
         print(f"\n🏥 АНАЛИЗ ПО БАЗЕ МИНЗДРАВА ({cancer_type})")
         print(f"   Найдено протоколов: {len(protocols)}")
@@ -317,10 +319,40 @@ class ComplianceScorer:
         total_score = 0
         max_possible = 0
         lines_analyzed = 0
+        unscored_lines = 0
         source_type = 'minzdrav_db'
         
+        planned = treatment_lines.get('planned')
+        planned_treatments = planned.get('treatments', []) if planned else []
+        
+
+        # Сначала подбираем протоколы для всех линий, чтобы линии без протокола
+        # отправить в AI одним пакетным запросом
+        matched_protocols = {}
+        ai_groups = []
+        for idx, line_data in enumerate(lines):
+            treatments = line_data.get('treatments', [])
+            if not treatments or idx in reuse:
+                continue
+            matched_protocols[idx] = self._find_matching_protocol(
+                cancer_type, line_data.get('line', 1), treatments, biomarkers
+            )
+            if not matched_protocols[idx]:
+                ai_groups.append((idx, treatments))
+        
+        if planned_treatments and 'planned' not in reuse:
+            matched_protocols['planned'] = self._find_matching_protocol(
+                cancer_type, 99, planned_treatments, biomarkers  
+            )
+            if not matched_protocols['planned']:
+                ai_groups.append(('planned', planned_treatments))
+        
+        if not use_ai:
+            ai_groups = []
+        ai_opinions = self._collect_ai_opinions(cancer_type, ai_groups, biomarkers) if ai_groups else {}
+        
 
-        for line_data in lines:
+        for idx, line_data in enumerate(lines):
             line_num = line_data.get('line', 1)
             treatments = line_data.get('treatments', [])
             response = line_data.get('response', '')
@@ -330,23 +362,29 @@ class ComplianceScorer:
             
             lines_analyzed += 1
             
-
-            matching_protocol = self._find_matching_protocol(
-                protocols, line_num, treatments, biomarkers
-            )
+            matching_protocol = matched_protocols.get(idx)
             
-            if matching_protocol:
+            if idx in reuse:
+                line_result = reuse[idx]
+                if self._is_ai_result(line_result):
+                    source_type = 'mixed'
+                print(f"   Линия {line_num}: оценка из предыдущего анализа")
+            elif matching_protocol:
 
                 line_result = self._evaluate_against_protocol(
                     treatments, matching_protocol, line_num
                 )
                 protocol_used = matching_protocol.get('name', 'Неизвестный протокол')
                 print(f"   Линия {line_num}: найден протокол '{protocol_used}'")
+            elif not use_ai:
+                print(f"   Линия {line_num}: нет подходящего протокола, AI-оценка отключена")
+                line_result = self._unscored_line(treatments)
+                unscored_lines += 1
             else:
 
                 print(f"   Линия {line_num}: нет подходящего протокола, использую AI")
                 line_result = self._evaluate_line_with_ai(
-                    cancer_type, treatments, biomarkers, line_num
+                    cancer_type, treatments, biomarkers, line_num, ai_opinions=ai_opinions[idx]
                 )
                 source_type = 'mixed' 
             
@@ -369,23 +407,25 @@ class ComplianceScorer:
             print(f"      → Оценка: {weighted_score:.1f}/{line_max} (вес: {line_weight})")
         
 
-        planned = treatment_lines.get('planned')
-        if planned and planned.get('treatments'):
-            planned_treatments = planned.get('treatments', [])
+        if planned_treatments:
             print(f"\n🔮 Планируемое лечение: {planned_treatments}")
             
-
-            matching_protocol = self._find_matching_protocol(
-                protocols, 99, planned_treatments, biomarkers  
-            )
+            matching_protocol = matched_protocols.get('planned')
             
-            if matching_protocol:
+            if 'planned' in reuse:
+                planned_result = reuse['planned']
+                if self._is_ai_result(planned_result):
+                    source_type = 'mixed'
+            elif matching_protocol:
                 planned_result = self._evaluate_against_protocol(
                     planned_treatments, matching_protocol, 99
                 )
+            elif not use_ai:
+                planned_result = self._unscored_line(planned_treatments)
+                unscored_lines += 1
             else:
                 planned_result = self._evaluate_line_with_ai(
-                    cancer_type, planned_treatments, biomarkers, 99
+                    cancer_type, planned_treatments, biomarkers, 99, ai_opinions=ai_opinions['planned']
                 )
                 source_type = 'mixed'
             
@@ -405,15 +445,20 @@ class ComplianceScorer:
 
         if max_possible > 0:
             final_score = int((total_score / max_possible) * 100)
+        elif unscored_lines:
+            final_score = None
         else:
             final_score = 0
         
-        message = self._get_score_message(final_score, cancer_type, len(protocols))
+        if final_score is None:
+            message = f"Ни одна линия не сопоставлена с протоколами Минздрава для {cancer_type}, AI-оценка отключена"
+        else:
+            message = self._get_score_message(final_score, cancer_type, len(protocols))
         
         print(f"\n📊 ИТОГОВЫЙ SCORE: {final_score}%")
         print(f"📌 Источник: {source_type}")
         
-        return {
+        result = {
             'score': final_score,
             'findings': findings,
             'source': source_type,
@@ -421,34 +466,134 @@ class ComplianceScorer:
             'analyzed_lines': lines_analyzed,
             'protocols_available': len(protocols)
         }
+        if not use_ai:
+            result['unscored_lines'] = unscored_lines
+        return result
+    
+    def _unscored_line(self, treatments: List[str]) -> dict:
+        """Линия без протокола при отключенном AI: в score не входит (0 из 0)"""
+        return {
+            'score': 0,
+            'max_score': 0,
+            'findings': [{
+                'treatment': treatment,
+                'status': 'not_evaluated',
+                'comment': 'Нет подходящего протокола Минздрава, AI-оценка отключена',
+                'score_contributed': 0,
+                'source': 'none'
+            } for treatment in treatments]
+        }
     
-    def _find_matching_protocol(self, protocols: List[dict], line_num: int, 
+    def _find_matching_protocol(self, cancer_type: str, line_num: int, 
                            treatments: List[str], biomarkers: dict) -> Optional[dict]:
-        """Ищет протокол с учетом штрафов за критические ошибки"""
+        """
+        Ищет протокол с учетом штрафов за критические ошибки. Типы рака с малым
+        числом протоколов ранжируются по кандидатам из инвертированного индекса,
+        остальные - матрицами; выбор тот же, что у перебора _find_matching_protocol_scan
+        """
+        protocols = self.protocols_db.get(cancer_type, [])
+        index = self.protocol_index.get(cancer_type)
+        if not protocols or index is None:
+            return None
+        if index['use_matrix']:
+            return self._find_matching_protocol_matrix(cancer_type, line_num, treatments, biomarkers)
+        return self._find_matching_protocol_index(cancer_type, line_num, treatments, biomarkers)
+    
+    def _find_matching_protocol_index(self, cancer_type: str, line_num: int,
+                                      treatments: List[str], biomarkers: dict) -> Optional[dict]:
+        """
+        Кандидаты берутся из инвертированного индекса: протоколы с совпавшими
+        препаратами, а также первый протокол с бонусом за линию и первый
+        протокол вообще - среди протоколов без совпадений только они могут
+        оказаться лучшими, поэтому выбор тот же, что при переборе всех
+        """
+        protocols = self.protocols_db[cancer_type]
+        index = self.protocol_index[cancer_type]
+        critical_errors = self._critical_errors(treatments, biomarkers)
+        
+        matches = {}
+        for t in treatments:
+            for i in self._protocols_matching_treatment(index, t):
+                matches[i] = matches.get(i, 0) + 1
+        
+        bonus_lines = self.LINE_BONUS.get(min(line_num, 3), ())
+        
+        candidates = set(matches)
+        candidates.add(0)
+        first_bonus = [index['first_by_line'][line] for line in bonus_lines if line in index['first_by_line']]
+        if first_bonus:
+            candidates.add(min(first_bonus))
         
         scored_protocols = []
         
+        for i in sorted(candidates):
+            protocol = protocols[i]
+            score = -critical_errors
+            
+            if matches.get(i, 0) > 0:
+                score += matches[i] * 10
+            
+            if protocol.get('line', 'unknown') in bonus_lines:
+                score += 30
+            
+            if score > 0 or critical_errors > 0:
+                scored_protocols.append((score, protocol))
+        
+        if scored_protocols:
+            scored_protocols.sort(reverse=True, key=lambda x: x[0])
+            return scored_protocols[0][1]
+        
+        return None
+    
+    def _find_matching_protocol_matrix(self, cancer_type: str, line_num: int,
+                                       treatments: List[str], biomarkers: dict) -> Optional[dict]:
+        """
+        Оценки всех протоколов типа рака считаются сразу: два матричных
+        произведения (совпадения препаратов и семейств) плюс маска бонуса за линию
+        """
+        protocols = self.protocols_db[cancer_type]
+        index = self.protocol_index[cancer_type]
+        if not treatments:
+            return self._find_matching_protocol_scan(protocols, line_num, treatments, biomarkers)
+        
+        critical_errors = self._critical_errors(treatments, biomarkers)
+        
+        matches = np.sum([self._cached_treatment_hits(cancer_type, t) for t in treatments], axis=0, dtype=np.int64)
+        scores = matches * 10 + index['line_bonus'][max(min(line_num, 3), 0)] - critical_errors
+        
+        # argmax берет первый протокол с максимальной оценкой, как стабильная сортировка;
+        # без критических ошибок протокол подходит, только если его оценка > 0
+        best = int(np.argmax(scores))
+        if critical_errors == 0 and scores[best] <= 0:
+            return None
+        return protocols[best]
+    
+    def _critical_errors(self, treatments: List[str], biomarkers: dict) -> int:
+        """Штраф за критические ошибки: зависит только от назначений, а не от протокола"""
+        critical_errors = 0
+        for t in treatments:
+            t_lower = t.lower()
+
+            if biomarkers.get('her2_negative') and any(x in t_lower for x in ['трастузумаб', 'пертузумаб', 'тукатиниб']):
+                critical_errors += 100 
+            if 'тамоксифен' in t_lower or 'летрозол' in t_lower:
+                critical_errors += 100
+        return critical_errors
+    
+    def _find_matching_protocol_scan(self, protocols: List[dict], line_num: int,
+                                     treatments: List[str], biomarkers: dict) -> Optional[dict]:
+        """Перебор всех протоколов: эталон для _find_matching_protocol (см. benchmark_scoring.py)"""
+        scored_protocols = []
+        critical_errors = self._critical_errors(treatments, biomarkers)
+        bonus_lines = self.LINE_BONUS.get(min(line_num, 3), ())
+        
         for protocol in protocols:
-            score = 0
             protocol_meds = protocol.get('medications', [])
-            protocol_line = protocol.get('line', 'unknown')
-            
             if not protocol_meds:
                 continue
             
-
-            critical_errors = 0
-            for t in treatments:
-                t_lower = t.lower()
-
-                if biomarkers.get('her2_negative') and any(x in t_lower for x in ['трастузумаб', 'пертузумаб', 'тукатиниб']):
-                    critical_errors += 100 
-                if 'тамоксифен' in t_lower or 'летрозол' in t_lower:
-                    critical_errors += 100
-            
-            score -= critical_errors
+            score = -critical_errors
             
-
             matches = 0
             for t in treatments:
                 for pm in protocol_meds:
@@ -460,11 +605,7 @@ class ComplianceScorer:
             if matches > 0:
                 score += matches * 10
             
-            if line_num == 1 and protocol_line in ['first_line', 'adjuvant', 'neoadjuvant']:
-                score += 30
-            elif line_num == 2 and protocol_line in ['second_line', 'metastatic']:
-                score += 30
-            elif line_num >= 3 and protocol_line in ['third_line', 'metastatic']:
+            if protocol.get('line', 'unknown') in bonus_lines:
                 score += 30
             
             if score > 0 or critical_errors > 0:
@@ -533,21 +674,19 @@ class ComplianceScorer:
         }
     
     def _evaluate_line_with_ai(self, cancer_type: str, treatments: List[str],
-                           biomarkers: dict, line_num: int) -> dict:
-        """Оценивает линию с помощью AI - СТРОГАЯ ВЕРСИЯ"""
-        from ai_service import ai_service
+                           biomarkers: dict, line_num: int, ai_opinions: List[dict] = None) -> dict:
+        """
+        Оценивает линию с помощью AI - СТРОГАЯ ВЕРСИЯ
+        ai_opinions - заранее полученные (пакетно) мнения AI по каждому препарату линии
+        """
+        if ai_opinions is None:
+            ai_opinions = self._collect_ai_opinions(cancer_type, [(line_num, treatments)], biomarkers)[line_num]
         
         findings = []
         score = 0
         max_score = len(treatments) * self.max_score_per_treatment
         
-        for treatment in treatments:
-            ai_opinion = ai_service.ask_about_treatment(
-                cancer_type=cancer_type,
-                treatment=treatment,
-                biomarkers=biomarkers
-            )
-            
+        for treatment, ai_opinion in zip(treatments, ai_opinions):
             confidence = ai_opinion.get('confidence', 0.5)
             
 
@@ -601,9 +740,61 @@ class ComplianceScorer:
             'source': 'ai'
         }
     
+    def _collect_ai_opinions(self, cancer_type: str, groups: List[Tuple[Any, List[str]]],
+                             biomarkers: dict) -> Dict[Any, List[dict]]:
+        """
+        Получает мнения AI по всем препаратам из групп (линий) одним пакетным запросом.
+        Если пакетный ответ не прошел валидацию - параллельные запросы по каждому препарату.
+        Возвращает {ключ группы: [мнение по каждому препарату в порядке treatments]}
+        """
+        from ai_service import ai_service
+        from deepseek_client import DeepSeekUnavailable, DeepSeekDeadlineExceeded
+        
+        items = [
+            {'group': key, 'treatment': treatment, 'combination': treatments}
+            for key, treatments in groups
+            for treatment in treatments
+        ]
+        
+        try:
+            opinions = ai_service.ask_about_treatments_batch(cancer_type, items, biomarkers)
+        except (DeepSeekUnavailable, DeepSeekDeadlineExceeded):
+            # DeepSeek недоступен или дедлайн исчерпан: запросы по каждому препарату не помогут
+            print(f"   ⚠️ AI-оценка недоступна, для {len(items)} препаратов - оценка по умолчанию")
+            opinions = [ai_service.default_treatment_opinion() for _ in items]
+        
+        if opinions is None:
+            print(f"   ⚠️ Пакетная AI-оценка не прошла валидацию, оцениваю {len(items)} препаратов параллельно")
+            ask = lambda item: ai_service.ask_about_treatment(
+                cancer_type=cancer_type,
+                treatment=item['treatment'],
+                biomarkers=biomarkers
+            )
+            # каждому вызову - своя копия контекста (дедлайн запроса, текущий этап)
+            with ThreadPoolExecutor(max_workers=min(self.max_parallel_ai_calls, len(items)) or 1) as pool:
+                futures = [pool.submit(contextvars.copy_context().run, ask, item) for item in items]
+                opinions = [future.result() for future in futures]
+        
+        # результат с оценками, полученными не из кэша ответов, не запоминается
+        if not all(opinion.get('from_cache') for opinion in opinions):
+            self._ai_state.fresh = True
+        
+        # запомненный результат не должен пережить ни одну из своих оценок в кэше ответов
+        expiries = [opinion['cache_expires_at'] for opinion in opinions if opinion.get('cache_expires_at')]
+        current = getattr(self._ai_state, 'expires_at', None)
+        if expiries:
+            self._ai_state.expires_at = min(expiries + ([current] if current is not None else []))
+        
+        grouped = {key: [] for key, _ in groups}
+        for item, opinion in zip(items, opinions):
+            grouped[item['group']].append(opinion)
+        
+        return grouped
+    
     def _calculate_with_ai(self, cancer_type: str, treatment_lines: Dict,
-                          biomarkers: dict) -> Dict:
-        """Полностью AI-оценка если нет в базе"""
+                          biomarkers: dict, reuse: Dict[Any, dict] = None) -> Dict:
+        """Полностью AI-оценка если нет в базе (линии из reuse в AI не уходят)"""
+        reuse = reuse or {}
         lines = treatment_lines.get('lines', [])
         findings = []
         total_score = 0
@@ -611,15 +802,26 @@ class ComplianceScorer:
         
         print(f"\n🤖 ПОЛНАЯ AI-ОЦЕНКА для {cancer_type}")
         
-        for line_data in lines:
+        planned = treatment_lines.get('planned')
+        planned_treatments = planned.get('treatments', []) if planned else []
+        
+
+        # Все линии и планируемое лечение оцениваются одним пакетным запросом
+        ai_groups = [(idx, line_data.get('treatments', [])) for idx, line_data in enumerate(lines)
+                     if line_data.get('treatments') and idx not in reuse]
+        if planned_treatments and 'planned' not in reuse:
+            ai_groups.append(('planned', planned_treatments))
+        ai_opinions = self._collect_ai_opinions(cancer_type, ai_groups, biomarkers) if ai_groups else {}
+        
+        for idx, line_data in enumerate(lines):
             line_num = line_data.get('line', 1)
             treatments = line_data.get('treatments', [])
             
             if not treatments:
                 continue
             
-            line_result = self._evaluate_line_with_ai(
-                cancer_type, treatments, biomarkers, line_num
+            line_result = reuse.get(idx) or self._evaluate_line_with_ai(
+                cancer_type, treatments, biomarkers, line_num, ai_opinions=ai_opinions[idx]
             )
             
             for f in line_result.get('findings', []):
@@ -631,11 +833,9 @@ class ComplianceScorer:
             max_possible += line_result['max_score'] * line_weight
         
 
-        planned = treatment_lines.get('planned')
-        if planned and planned.get('treatments'):
-            planned_treatments = planned.get('treatments', [])
-            planned_result = self._evaluate_line_with_ai(
-                cancer_type, planned_treatments, biomarkers, 99
+        if planned_treatments:
+            planned_result = reuse.get('planned') or self._evaluate_line_with_ai(
+                cancer_type, planned_treatments, biomarkers, 99, ai_opinions=ai_opinions['planned']
             )
             
             for f in planned_result.get('findings', []):
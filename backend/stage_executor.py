@@ -0,0 +1,109 @@
+
+import os
+import time
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+# Имя этапа, который выполняется в текущем потоке (None - вне StageExecutor)
+current_stage: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('current_stage', default=None)
+
+
+class StageExecutor:
+    """
+    Запускает этапы анализа с учетом зависимостей между ними.
+    Этап отправляется в пул потоков, как только готовы все его зависимости,
+    поэтому независимые вызовы DeepSeek выполняются параллельно.
+    Этапы видят contextvars того потока, где создан StageExecutor
+    (например, дедлайн запроса).
+    """
+
+    def __init__(self, pool: ThreadPoolExecutor):
+        self.pool = pool
+        self.context = contextvars.copy_context()
+        self.stages = {}
+        self.futures = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, func: Callable[..., Any], deps: Iterable[str] = ()) -> 'StageExecutor':
+        """
+        Регистрирует этап. Функция получает результаты зависимостей
+        как именованные аргументы (в порядке deps)
+        """
+        deps = tuple(deps)
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Этап '{name}' зависит от незарегистрированного этапа '{dep}'")
+
+        self.stages[name] = {'func': func, 'deps': deps, 'submitted': False}
+        self.futures[name] = Future()
+        return self
+
+    def start(self) -> 'StageExecutor':
+        """Запускает все этапы, у которых нет незавершенных зависимостей"""
+        for name in list(self.stages):
+            self._submit_if_ready(name)
+        return self
+
+    def result(self, name: str, timeout: Optional[float] = None) -> Any:
+        """Ждет завершения этапа и возвращает его результат (или пробрасывает ошибку)"""
+        return self.futures[name].result(timeout=timeout)
+
+    def done(self, name: str) -> bool:
+        return self.futures[name].done()
+
+    def get_timings(self) -> Dict[str, float]:
+        """Время выполнения каждого завершенного этапа в секундах"""
+        with self.lock:
+            return {name: round(duration, 2) for name, duration in self.timings.items()}
+
+    def _submit_if_ready(self, name: str):
+        stage = self.stages[name]
+
+        with self.lock:
+            if stage['submitted']:
+                return
+            if not all(self.futures[dep].done() for dep in stage['deps']):
+                return
+            stage['submitted'] = True
+
+        failed = [dep for dep in stage['deps'] if self.futures[dep].exception() is not None]
+        if failed:
+            self.futures[name].set_exception(self.futures[failed[0]].exception())
+            self._on_stage_done(name)
+            return
+
+        kwargs = {dep: self.futures[dep].result() for dep in stage['deps']}
+        # у каждого этапа своя копия: один Context нельзя войти из двух потоков сразу
+        self.pool.submit(self.context.copy().run, self._run_stage, name, stage['func'], kwargs)
+
+    def _run_stage(self, name: str, func: Callable[..., Any], kwargs: Dict[str, Any]):
+        current_stage.set(name)
+        started = time.time()
+        try:
+            value = func(**kwargs)
+        except BaseException as e:
+            with self.lock:
+                self.timings[name] = time.time() - started
+            self.futures[name].set_exception(e)
+        else:
+            with self.lock:
+                self.timings[name] = time.time() - started
+            self.futures[name].set_result(value)
+        self._on_stage_done(name)
+
+    def _on_stage_done(self, name: str):
+        for other, stage in self.stages.items():
+            if name in stage['deps']:
+                self._submit_if_ready(other)
+
+
+# Общий пул для всех запросов: размер ограничивает число одновременных
+# обращений к DeepSeek со стороны этапов анализа
+stage_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv('PIPELINE_MAX_WORKERS', '16')),
+    thread_name_prefix='analysis-stage'
+)
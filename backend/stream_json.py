@@ -0,0 +1,132 @@
+
+import json
+from typing import Any, Iterable, List, Sequence, Tuple
+
+
+Path = Tuple[Any, ...]
+
+
+class IncrementalJSONParser:
+    """
+    Потоковый разбор JSON, который модель генерирует по частям. feed()
+    принимает очередной фрагмент текста и возвращает [(путь, значение)]
+    для значений, которые завершились в этом фрагменте и подходят под один
+    из шаблонов путей. Путь - кортеж ключей объектов и индексов массивов,
+    '*' в шаблоне - любой ключ или индекс, например
+    ('doctor_version', 'findings', '*') - каждая находка целиком.
+    Текст до первой '{' или '[' (```json и т.п.) пропускается
+    """
+
+    def __init__(self, patterns: Iterable[Sequence[Any]]):
+        self.patterns = [tuple(p) for p in patterns]
+        self.buf = ''
+        self.pos = 0
+        self.started = False
+        self.done = False
+
+        # кадр контейнера: [скобка, текущий ключ или индекс, ожидается ли ключ]
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.string_is_key = False
+        self.in_scalar = False
+        self.token_start = 0
+        # начатые значения по отслеживаемым путям: (глубина, путь, начало)
+        self.watched = []
+
+    def feed(self, text: str) -> List[Tuple[Path, Any]]:
+        self.buf += text
+        events = []
+        buf = self.buf
+
+        while self.pos < len(buf) and not self.done:
+            ch = buf[self.pos]
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.string_is_key:
+                        self.stack[-1][1] = self._load(self.token_start, self.pos + 1)
+                    else:
+                        self._value_end(self.pos + 1, events)
+                self.pos += 1
+                continue
+
+            if self.in_scalar:
+                if ch in ',}] \t\r\n':
+                    self.in_scalar = False
+                    self._value_end(self.pos, events)
+                    # разделитель разбирается на следующей итерации
+                    continue
+                self.pos += 1
+                continue
+
+            if not self.started:
+                if ch not in '{[':
+                    self.pos += 1
+                    continue
+                self.started = True
+
+            if ch == '"':
+                self.in_string = True
+                self.string_is_key = bool(self.stack) and self.stack[-1][0] == '{' and self.stack[-1][2]
+                if self.string_is_key:
+                    self.token_start = self.pos
+                else:
+                    self._value_start(self.pos)
+            elif ch in '{[':
+                self._value_start(self.pos)
+                self.stack.append([ch, None, ch == '{'] if ch == '{' else [ch, -1, False])
+            elif ch in '}]':
+                if self.stack:
+                    self.stack.pop()
+                self._value_end(self.pos + 1, events)
+                if not self.stack:
+                    self.done = True
+            elif ch == ':':
+                if self.stack:
+                    self.stack[-1][2] = False
+            elif ch == ',':
+                if self.stack and self.stack[-1][0] == '{':
+                    self.stack[-1][2] = True
+            elif ch not in ' \t\r\n':
+                self.in_scalar = True
+                self._value_start(self.pos)
+
+            self.pos += 1
+
+        return events
+
+    def _path(self) -> Path:
+        return tuple(frame[1] for frame in self.stack)
+
+    def _matches(self, path: Path) -> bool:
+        return any(
+            len(pattern) == len(path) and all(p == '*' or p == k for p, k in zip(pattern, path))
+            for pattern in self.patterns
+        )
+
+    def _value_start(self, pos: int):
+        if self.stack and self.stack[-1][0] == '[':
+            self.stack[-1][1] += 1
+        path = self._path()
+        if path and self._matches(path):
+            self.watched.append((len(self.stack), path, pos))
+
+    def _value_end(self, end: int, events: List[Tuple[Path, Any]]):
+        if self.watched and self.watched[-1][0] == len(self.stack):
+            _, path, start = self.watched.pop()
+            try:
+                events.append((path, json.loads(self.buf[start:end])))
+            except ValueError:
+                pass
+
+    def _load(self, start: int, end: int) -> Any:
+        try:
+            return json.loads(self.buf[start:end])
+        except ValueError:
+            return self.buf[start + 1:end - 1]
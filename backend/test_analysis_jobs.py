@@ -0,0 +1,28 @@
+from analysis_jobs import JobManager
+
+
+def test_delta_events_carry_only_new_item():
+    manager = JobManager(max_workers=1)
+
+    def pipeline(progress):
+        progress(5, delta=(('ai_findings', 0), {'category': 'A'}))
+        progress(5, delta=(('ai_findings', 1), {'category': 'B'}))
+        progress(5, delta=(('patient_version', 'summary'), 'Кратко'))
+        progress(6, cancer_type='breast')
+        return {'ok': True}
+
+    job = manager.submit('test', pipeline)
+    manager.pool.shutdown(wait=True)
+
+    partial = [event['data'] for event in job.events if event['type'] == 'partial']
+    assert partial == [
+        {'step': 5, 'path': ['ai_findings', 0], 'value': {'category': 'A'}},
+        {'step': 5, 'path': ['ai_findings', 1], 'value': {'category': 'B'}},
+        {'step': 5, 'path': ['patient_version', 'summary'], 'value': 'Кратко'},
+        {'cancer_type': 'breast', 'step': 6}
+    ]
+    assert job.to_dict()['partial'] == {
+        'ai_findings': [{'category': 'A'}, {'category': 'B'}],
+        'patient_version': {'summary': 'Кратко'},
+        'cancer_type': 'breast'
+    }
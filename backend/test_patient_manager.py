@@ -0,0 +1,250 @@
+import os
+import json
+import tempfile
+
+import pytest
+
+# модульный экземпляр patient_manager не должен трогать рабочую базу и patients_db.json
+_sandbox = tempfile.mkdtemp(prefix='patients-test-')
+os.environ['PATIENTS_DB_FILE'] = os.path.join(_sandbox, 'patients_db.sqlite3')
+os.environ['PATIENTS_JSON_FILE'] = os.path.join(_sandbox, 'patients_db.json')
+os.environ['RESULTS_STORE_DIR'] = os.path.join(_sandbox, 'results_store')
+
+from patient_manager import PatientManager, VersionConflict
+from result_store import ResultStore
+
+
+LEGACY_PATIENTS = {
+    'patient-0001': {
+        'initials': 'И.И.',
+        'age': 54,
+        'gender': 'female',
+        'diagnosis': 'Рак молочной железы',
+        'created_at': '2025-01-10T09:00:00',
+        'last_visit': '2025-02-01T10:00:00',
+        'timeline': [{'date': '2025-01-10', 'event': 'Первичный прием'}],
+        'history': [
+            {
+                'id': 'entry-1',
+                'timestamp': '2025-01-10T09:30:00',
+                'history': 'РМЖ, 1 линия: паклитаксел',
+                'diagnosis': 'Рак молочной железы',
+                'compliance_score': 82,
+                'status': '✅',
+                'full_result': {'doctor_version': {'compliance_score': 82}}
+            },
+            {
+                'id': 'entry-2',
+                'timestamp': '2025-02-01T10:15:00',
+                'history': 'РМЖ, 2 линия: капецитабин',
+                'diagnosis': 'Рак молочной железы',
+                'compliance_score': 60,
+                'status': '⚠️',
+                'full_result': {}
+            }
+        ]
+    },
+    'patient-0002': {
+        'initials': 'П.П.',
+        'age': 67,
+        'gender': 'male',
+        'diagnosis': 'Рак предстательной железы',
+        'created_at': '2025-01-12T12:00:00',
+        'history': []
+    }
+}
+
+
+def make_manager(directory, json_file=''):
+    """Менеджер с отдельной базой и хранилищем результатов в directory"""
+    return PatientManager(
+        db_file=os.path.join(directory, 'patients.sqlite3'),
+        json_file=json_file,
+        results=ResultStore(os.path.join(directory, 'results'))
+    )
+
+
+def write_legacy(directory, patients=LEGACY_PATIENTS):
+    json_file = os.path.join(directory, 'patients_db.json')
+    with open(json_file, 'w', encoding='utf-8') as f:
+        json.dump(patients, f, ensure_ascii=False)
+    return json_file
+
+
+def test_migration_round_trip(tmp_path):
+    json_file = write_legacy(tmp_path)
+    manager = make_manager(tmp_path, json_file)
+
+    assert manager.count_patients() == 2
+    assert not os.path.exists(json_file)
+    assert os.path.exists(json_file + '.migrated')
+
+    patient = manager.get_patient('patient-0001')
+    legacy = LEGACY_PATIENTS['patient-0001']
+    for field in ('initials', 'age', 'gender', 'diagnosis', 'created_at', 'last_visit', 'timeline'):
+        assert patient[field] == legacy[field]
+
+    assert [entry['id'] for entry in patient['history']] == ['entry-1', 'entry-2']
+    first = manager.get_history_entry('patient-0001', 'entry-1')
+    assert first['history'] == 'РМЖ, 1 линия: паклитаксел'
+    assert first['compliance_score'] == 82
+    assert first['status'] == '✅'
+    assert first['full_result'] == legacy['history'][0]['full_result']
+    assert manager.get_history_entry('patient-0001', 'entry-2')['full_result'] == {}
+
+    assert manager.get_patient('patient-0002')['history'] == []
+    assert [p['id'] for p in manager.search_patients('П.П.')] == ['patient-0002']
+
+
+def test_migration_second_run_is_noop(tmp_path):
+    json_file = write_legacy(tmp_path)
+    manager = make_manager(tmp_path, json_file)
+    before = manager.get_patient('patient-0001')
+
+    # файл уже переименован: повторный запуск ничего не переносит
+    assert manager.migrate_from_json(json_file) == 0
+    assert make_manager(tmp_path, json_file).count_patients() == 2
+
+    # даже если старый файл вернули на место, записи не дублируются
+    write_legacy(tmp_path)
+    manager.migrate_from_json(json_file)
+    assert manager.count_patients() == 2
+    assert manager.count_history('patient-0001') == 2
+    assert manager.get_patient('patient-0001') == before
+
+
+def test_migration_failure_keeps_json(tmp_path):
+    broken = dict(LEGACY_PATIENTS)
+    # значение, которое SQLite не умеет сохранить, - ошибка на середине переноса
+    broken['patient-0003'] = {'initials': 'С.С.', 'age': {'years': 40}, 'created_at': '2025-01-15T08:00:00'}
+    json_file = write_legacy(tmp_path, broken)
+
+    manager = make_manager(tmp_path, json_file)
+
+    assert manager.count_patients() == 0
+    assert os.path.exists(json_file)
+    assert not os.path.exists(json_file + '.migrated')
+    with open(json_file, encoding='utf-8') as f:
+        assert json.load(f) == broken
+
+
+def test_update_with_current_version_bumps_it(tmp_path):
+    manager = make_manager(tmp_path)
+    patient_id = manager.create_patient('А.А.', 40, 'female')
+    version = manager.get_patient(patient_id)['version']
+
+    assert manager.update_patient(patient_id, expected_version=version, diagnosis='Рак яичников') == version + 1
+    patient = manager.get_patient(patient_id)
+    assert patient['version'] == version + 1
+    assert patient['diagnosis'] == 'Рак яичников'
+
+
+def test_update_with_stale_version_conflicts(tmp_path):
+    manager = make_manager(tmp_path)
+    patient_id = manager.create_patient('А.А.', 40, 'female')
+    stale = manager.get_patient(patient_id)['version']
+
+    # другой запрос успел изменить карточку
+    manager.update_patient(patient_id, expected_version=stale, age=41)
+
+    with pytest.raises(VersionConflict) as conflict:
+        manager.update_patient(patient_id, expected_version=stale, age=99)
+    assert conflict.value.patient_id == patient_id
+    assert conflict.value.expected_version == stale
+    assert conflict.value.actual_version == stale + 1
+
+    patient = manager.get_patient(patient_id)
+    assert patient['age'] == 41
+    assert patient['version'] == stale + 1
+
+
+def test_history_changes_bump_version(tmp_path):
+    manager = make_manager(tmp_path)
+    patient_id = manager.create_patient('А.А.')
+    version = manager.get_patient(patient_id)['version']
+
+    manager.add_history_entry(patient_id, 'история', {'doctor_version': {'compliance_score': 70}})
+    entry_id = manager.get_patient_history(patient_id)[0]['id']
+    assert manager.get_patient(patient_id)['version'] > version
+
+    version = manager.get_patient(patient_id)['version']
+    manager.delete_history_entry(patient_id, entry_id)
+    assert manager.get_patient(patient_id)['version'] > version
+
+    # карточку, прочитанную до изменения истории, перезаписать уже нельзя
+    with pytest.raises(VersionConflict):
+        manager.update_patient(patient_id, expected_version=version, initials='Б.Б.')
+
+
+def test_update_missing_patient(tmp_path):
+    manager = make_manager(tmp_path)
+    assert manager.update_patient('patient-missing', expected_version=1, age=30) is None
+
+
+def make_listed_manager(tmp_path, count=7):
+    """Менеджер с count пациентами; у пар пациентов одинаковое created_at"""
+    patients = {
+        f'patient-{i:04d}': {
+            'initials': f'Иванов {i}' if i % 2 else f'Петров {i}',
+            'diagnosis': 'Рак легкого',
+            'created_at': f'2025-03-{1 + i // 2:02d}T10:00:00'
+        }
+        for i in range(count)
+    }
+    return make_manager(tmp_path, write_legacy(tmp_path, patients)), patients
+
+
+def walk(fetch, limit, key='patients'):
+    """Все страницы подряд: [[id, ...], ...]"""
+    pages, cursor = [], None
+    while True:
+        page = fetch(limit=limit, after=cursor)
+        pages.append([p['id'] for p in page[key]])
+        cursor = page['next_cursor']
+        if cursor is None:
+            return pages
+
+
+def test_list_pages_cover_all_patients_in_order(tmp_path):
+    manager, patients = make_listed_manager(tmp_path)
+    expected = sorted(patients, key=lambda pid: (patients[pid]['created_at'], pid), reverse=True)
+
+    pages = walk(manager.list_patients, limit=3)
+
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [pid for page in pages for pid in page] == expected
+    assert [p['id'] for p in manager.list_patients()['patients']] == expected
+    assert manager.list_patients()['next_cursor'] is None
+
+
+def test_cursor_is_stable_when_patients_are_added(tmp_path):
+    manager, _ = make_listed_manager(tmp_path)
+    first = manager.list_patients(limit=3)
+
+    # новый пациент попадает в начало списка и не сдвигает следующую страницу
+    manager.create_patient('Новый')
+    second = manager.list_patients(limit=3, after=first['next_cursor'])
+
+    seen = [p['id'] for p in first['patients']]
+    assert not set(seen) & {p['id'] for p in second['patients']}
+    assert [p['id'] for p in second['patients']] == ['patient-0003', 'patient-0002', 'patient-0001']
+
+
+def test_search_pages(tmp_path):
+    manager, _ = make_listed_manager(tmp_path, count=9)
+
+    # длинный запрос - триграммы с проверкой подстроки, короткий - n-грамма напрямую
+    for query in ('иванов', 'ив'):
+        expected = [
+            p['id'] for p in manager.list_patients()['patients']
+            if query in p['initials'].lower()
+        ]
+        pages = walk(lambda limit, after: manager.find_patients(query, limit=limit, after=after), limit=2, key='results')
+        assert [pid for page in pages for pid in page] == expected
+        assert all(len(page) <= 2 for page in pages)
+
+
+def test_invalid_cursor(tmp_path):
+    manager = make_manager(tmp_path)
+    with pytest.raises(ValueError):
+        manager.list_patients(limit=2, after='not-a-cursor')
@@ -0,0 +1,78 @@
+import json
+
+from stream_json import IncrementalJSONParser
+
+
+PATHS = [('doctor_version', 'findings', '*'), ('patient_version', '*')]
+
+ANALYSIS = {
+    'doctor_version': {
+        'summary': 'Лечение соответствует {рекомендациям} "Минздрава"',
+        'findings': [
+            {'category': 'Химиотерапия', 'status': 'correct', 'comment': 'Схема [AC-T], доза 60 мг/м²'},
+            {'category': 'Таргетная', 'status': 'warning', 'comment': 'Нет \\ данных о "HER2"', 'score': -5.5},
+            {'category': 'Гормональная', 'status': 'info', 'comment': None, 'flags': [True, False]}
+        ]
+    },
+    'patient_version': {
+        'summary': 'Лечение подобрано правильно',
+        'status': '✅',
+        'key_points': ['Продолжайте терапию', 'Контроль через 3 месяца'],
+        'score': 82
+    }
+}
+
+
+def feed_by(text, size, paths=PATHS):
+    parser = IncrementalJSONParser(paths)
+    events = []
+    for i in range(0, len(text), size):
+        events.extend(parser.feed(text[i:i + size]))
+    return events
+
+
+def expected_events(analysis=ANALYSIS):
+    events = [(('doctor_version', 'findings', i), f) for i, f in enumerate(analysis['doctor_version']['findings'])]
+    events += [(('patient_version', key), value) for key, value in analysis['patient_version'].items()]
+    return events
+
+
+def test_any_chunking_gives_same_events():
+    text = json.dumps(ANALYSIS, ensure_ascii=False, indent=2)
+    for size in (1, 2, 3, 7, 20, len(text)):
+        assert feed_by(text, size) == expected_events(), size
+
+
+def test_value_is_reported_once_it_is_complete():
+    parser = IncrementalJSONParser(PATHS)
+    head = '{"doctor_version": {"findings": [{"category": "A", "comment": "x}'
+    assert parser.feed(head) == []
+    assert parser.feed('"}') == [(('doctor_version', 'findings', 0), {'category': 'A', 'comment': 'x}'})]
+    assert parser.feed(', {"category": "B"') == []
+    assert parser.feed('}]}}') == [(('doctor_version', 'findings', 1), {'category': 'B'})]
+
+
+def test_scalar_is_reported_on_delimiter():
+    parser = IncrementalJSONParser([('patient_version', '*')])
+    assert parser.feed('{"patient_version": {"score": 8') == []
+    assert parser.feed('2') == []
+    assert parser.feed(', "ok": true}}') == [(('patient_version', 'score'), 82), (('patient_version', 'ok'), True)]
+
+
+def test_markdown_fence_and_trailing_text_are_skipped():
+    text = '```json\n' + json.dumps(ANALYSIS, ensure_ascii=False) + '\n```\nГотово {"patient_version": {"x": 1}}'
+    assert feed_by(text, 5) == expected_events()
+
+
+def test_unwatched_paths_are_ignored():
+    text = json.dumps(ANALYSIS, ensure_ascii=False)
+    assert feed_by(text, 4, paths=[('doctor_version', 'summary')]) == [
+        (('doctor_version', 'summary'), ANALYSIS['doctor_version']['summary'])
+    ]
+    assert feed_by(text, 4, paths=[]) == []
+
+
+def test_escaped_quotes_and_brackets_inside_strings():
+    value = {'comment': 'кавычка \\" и скобки } ] { [ внутри строки'}
+    text = json.dumps({'patient_version': value}, ensure_ascii=False)
+    assert feed_by(text, 1) == [(('patient_version', 'comment'), value['comment'])]
@@ -1,17 +1,20 @@
 
 import json
 import re
-import requests
 from typing import Dict, List, Any, Optional
+from deepseek_client import DeepSeekClient, DeepSeekError, deepseek_client
+from drug_recognizer import drug_recognizer
+from deadline import note_degraded
 
 class TreatmentLineExtractor:
     """
     Извлекает линии терапии из истории болезни с помощью AI
     """
     
-    def __init__(self, deepseek_api_key: str):
-        self.deepseek_api_key = deepseek_api_key
-        self.deepseek_url = "https://api.deepseek.com/v1/chat/completions"
+    def __init__(self, deepseek_api_key: str = None, client: DeepSeekClient = None):
+        if client is None:
+            client = DeepSeekClient(api_key=deepseek_api_key) if deepseek_api_key else deepseek_client
+        self.client = client
     
     def extract_lines(self, history: str) -> Dict[str, Any]:
         """
@@ -64,33 +67,16 @@ class TreatmentLineExtractor:
 Если информации о линиях нет, верни {{"lines": []}}
 """
 
-            headers = {
-                "Authorization": f"Bearer {self.deepseek_api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            payload = {
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "system", "content": "Ты - медицинский эксперт. Извлекаешь линии терапии из текста. Отвечаешь только JSON."},
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.1,
-                "max_tokens": 2000,
-                "response_format": {"type": "json_object"}
-            }
-            
-            response = requests.post(
-                self.deepseek_url,
-                headers=headers,
-                json=payload,
-                timeout=120
+            content = self.client.chat(
+                system="Ты - медицинский эксперт. Извлекаешь линии терапии из текста. Отвечаешь только JSON.",
+                user=prompt,
+                max_tokens=2000,
+                json_mode=True,
+                timeout=120,
+                use_cache=True
             )
             
-            if response.status_code == 200:
-                result = response.json()
-                content = result['choices'][0]['message']['content']
-                
+            if content:
 
                 content = content.strip()
                 if content.startswith('```json'):
@@ -115,9 +101,13 @@ class TreatmentLineExtractor:
                     print(f"❌ Ошибка парсинга JSON: {e}")
                     return default_result
             else:
-                print(f"❌ Ошибка API: {response.status_code}")
+                print("❌ Пустой ответ API")
                 return default_result
                 
+        except DeepSeekError as e:
+            print(f"❌ Ошибка API: {e}")
+            note_degraded('treatment_lines', e)
+            return default_result
         except Exception as e:
             print(f"❌ Ошибка при извлечении линий: {e}")
             return default_result
@@ -142,17 +132,6 @@ class TreatmentLineExtractor:
         ]
         
 
-        regimen_map = {
-            'tc': ['паклитаксел', 'карбоплатин'],
-            'тс': ['паклитаксел', 'карбоплатин'],
-            'xelox': ['оксалиплатин', 'капецитабин'],
-            'capox': ['оксалиплатин', 'капецитабин'],
-            'folfox': ['оксалиплатин', 'фторурацил', 'лейковорин'],
-            'folfiri': ['иринотекан', 'фторурацил', 'лейковорин'],
-            'ac': ['доксорубицин', 'циклофосфамид'],
-        }
-        
-
         for pattern, line_type in line_patterns:
             matches = re.findall(pattern, text)
             for match in matches:
@@ -163,32 +142,14 @@ class TreatmentLineExtractor:
                     line_num = line_type
                 
 
-                treatments = []
-                
-
-                for abbr, drugs in regimen_map.items():
-                    if abbr in treatment_text:
-                        treatments.extend(drugs)
-                
-
-                if not treatments:
-                    known_drugs = [
-                        'паклитаксел', 'карбоплатин', 'цисплатин', 'гемцитабин',
-                        'трастузумаб', 'рамуцирумаб', 'иринотекан', 'доцетаксел',
-                        'капецитабин', 'оксалиплатин', 'фторурацил', 'этопозид',
-                        'доксорубицин', 'циклофосфамид', 'метотрексат', 'винорельбин',
-                        'эрибулин', 'пембролизумаб', 'ниволумаб', 'атезолизумаб',
-                        'бевацизумаб', 'осимертиниб', 'алектиниб', 'кризотиниб'
-                    ]
-                    for drug in known_drugs:
-                        if drug in treatment_text:
-                            treatments.append(drug)
+                # схемы раскрываются в препараты, отдельно названные препараты добавляются к ним
+                treatments = drug_recognizer.drugs(treatment_text)
                 
                 if treatments:
                     lines.append({
                         'line': len(lines) + 1,
                         'name': f"{line_type} линия",
-                        'treatments': list(set(treatments)),
+                        'treatments': treatments,
                         'response': 'неизвестно'
                     })
         
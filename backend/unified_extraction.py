@@ -0,0 +1,291 @@
+
+import os
+import json
+import re
+import threading
+from typing import Dict, Any, Optional
+from deepseek_client import DeepSeekClient, DeepSeekError, deepseek_client
+from ai_service import VALID_CANCER_TYPES
+from deadline import note_degraded
+
+
+UNIFIED_EXTRACTION = os.getenv('UNIFIED_EXTRACTION', '0') == '1'
+
+_STRINGS = {'type': 'array', 'items': {'type': 'string'}}
+
+# Схема ответа: по разделу на каждый этап анализа, который раньше был отдельным
+# запросом. Раздел, не прошедший проверку, запрашивается прежним промптом
+UNIFIED_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'cancer_type': {'type': 'string', 'enum': VALID_CANCER_TYPES},
+        'treatment_lines': {
+            'type': 'object',
+            'required': ['lines'],
+            'properties': {
+                'lines': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'required': ['line', 'treatments'],
+                        'properties': {
+                            'line': {'type': 'integer'},
+                            'name': {'type': 'string'},
+                            'treatments': _STRINGS,
+                            'period': {'type': 'string'},
+                            'response': {'type': 'string'},
+                            'notes': {'type': 'string'}
+                        }
+                    }
+                },
+                'planned': {
+                    'type': ['object', 'null'],
+                    'required': ['treatments'],
+                    'properties': {
+                        'treatments': _STRINGS,
+                        'description': {'type': 'string'},
+                        'source': {'type': 'string'}
+                    }
+                }
+            }
+        },
+        'prescribed': _STRINGS,
+        'analysis': {
+            'type': 'object',
+            'required': ['doctor_version', 'patient_version'],
+            'properties': {
+                'doctor_version': {
+                    'type': 'object',
+                    'required': ['summary'],
+                    'properties': {
+                        'summary': {'type': 'string'},
+                        'diagnosis': {'type': 'object'},
+                        'findings': {'type': 'array', 'items': {'type': 'object'}}
+                    }
+                },
+                'patient_version': {
+                    'type': 'object',
+                    'required': ['summary'],
+                    'properties': {
+                        'summary': {'type': 'string'},
+                        'status': {'type': 'string'},
+                        'key_points': _STRINGS,
+                        'questions_for_doctor': _STRINGS
+                    }
+                }
+            }
+        },
+        'missing_info': {
+            'type': 'object',
+            'required': ['has_missing_info', 'fields'],
+            'properties': {
+                'has_missing_info': {'type': 'boolean'},
+                'message': {'type': 'string'},
+                'fields': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'required': ['id', 'question'],
+                        'properties': {
+                            'id': {'type': 'string'},
+                            'question': {'type': 'string'},
+                            'options': _STRINGS,
+                            'impacts_score': {'type': 'boolean'}
+                        }
+                    }
+                }
+            }
+        }
+    }
+}
+
+SECTIONS = tuple(UNIFIED_SCHEMA['properties'])
+
+_JSON_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'boolean': bool,
+    'null': type(None)
+}
+
+
+def matches_schema(value: Any, schema: Dict[str, Any]) -> bool:
+    """
+    Проверка по подмножеству JSON Schema, которое используется в UNIFIED_SCHEMA:
+    type (в том числе список типов), enum, required, properties, items
+    """
+    types = schema.get('type')
+    if types is not None:
+        types = types if isinstance(types, list) else [types]
+        ok = False
+        for name in types:
+            if name == 'integer':
+                ok = isinstance(value, int) and not isinstance(value, bool)
+            elif name == 'number':
+                ok = isinstance(value, (int, float)) and not isinstance(value, bool)
+            else:
+                ok = isinstance(value, _JSON_TYPES[name])
+            if ok:
+                break
+        if not ok:
+            return False
+
+    if 'enum' in schema and value not in schema['enum']:
+        return False
+
+    if isinstance(value, dict):
+        if any(key not in value for key in schema.get('required', [])):
+            return False
+        for key, sub in schema.get('properties', {}).items():
+            # необязательные поля могут прийти как null
+            if key in value and not (value[key] is None and key not in schema.get('required', [])):
+                if not matches_schema(value[key], sub):
+                    return False
+
+    if isinstance(value, list) and 'items' in schema:
+        return all(matches_schema(item, schema['items']) for item in value)
+
+    return True
+
+
+class UnifiedExtractor:
+    """
+    Единый запрос извлечения: тип рака, линии терапии, назначенные препараты,
+    текст анализа и недостающая информация возвращаются одним JSON по
+    UNIFIED_SCHEMA, так что история болезни отправляется в DeepSeek один раз.
+    extract() возвращает только разделы, прошедшие проверку схемой; остальные
+    вызывающий код получает прежними специализированными промптами
+    """
+
+    def __init__(self, client: DeepSeekClient = None, enabled: bool = None):
+        self.client = client or deepseek_client
+        self.enabled = UNIFIED_EXTRACTION if enabled is None else enabled
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.fallbacks = {section: 0 for section in SECTIONS}
+
+    def build_prompt(self, history: str) -> str:
+        schema = json.dumps(UNIFIED_SCHEMA, ensure_ascii=False, separators=(',', ':'))
+        return f"""Проанализируй историю болезни и заполни ВСЕ разделы ответа.
+
+История болезни:
+{history[:4000]}
+
+РАЗДЕЛЫ ОТВЕТА:
+1. cancer_type - ОСНОВНОЙ тип рака, одно значение из enum схемы
+   ('cancer_unknown_primary' для CUP, 'general' - если не удалось определить).
+2. treatment_lines - ВСЕ линии противоопухолевой терапии (1 линия, 2 линия, поддерживающая,
+   неоадъювантная, адъювантная) со ВСЕМИ препаратами комбинации, периодом и ответом
+   на лечение (прогрессирование/стабилизация/ремиссия); планируемое или рекомендованное
+   лечение - отдельно в planned (null, если его нет).
+3. prescribed - ВСЕ противоопухолевые препараты, которые УЖЕ БЫЛИ назначены (все линии).
+4. analysis - описание ситуации: doctor_version (summary, diagnosis с полями extracted/stage/notes,
+   findings с полями category/prescribed/status="info"/comment/sources) и patient_version
+   (summary, status="📋", key_points, questions_for_doctor) простым языком для пациента.
+   НЕ рассчитывай compliance_score - это сделает система.
+5. missing_info - какой информации не хватает. impacts_score=true только для вопросов,
+   меняющих выбор лечения (планируемые препараты, новые мутации/биомаркеры, повторная
+   биопсия); контекстные вопросы (ECOG, гистология, сопутствующие заболевания) -
+   impacts_score=false. Если информации достаточно - has_missing_info=false и fields=[].
+
+Аббревиатуры схем расшифровывай в препараты:
+TC, ТС = паклитаксел + карбоплатин; XELOX = оксалиплатин + капецитабин;
+FOLFOX = оксалиплатин + фторурацил + лейковорин; FOLFIRI = иринотекан + фторурацил + лейковорин;
+AC = доксорубицин + циклофосфамид; EDP-M = этопозид + доксорубицин + цисплатин + митотан.
+
+Отвечай ТОЛЬКО на русском языке, не используй ФИО пациентов.
+Верни ТОЛЬКО JSON, соответствующий JSON-схеме:
+{schema}
+"""
+
+    def extract(self, history: str) -> Dict[str, Any]:
+        """
+        Один запрос к DeepSeek. Возвращает {раздел: значение} для прошедших
+        проверку разделов и '_from_cache'; при ошибке запроса - пустой словарь
+        (все разделы уйдут в специализированные промпты)
+        """
+        print("\n🧩 ЕДИНЫЙ ЗАПРОС ИЗВЛЕЧЕНИЯ")
+        with self.lock:
+            self.requests += 1
+
+        data = None
+        completion = None
+        try:
+            completion = self.client.complete(
+                system="Ты - опытный онколог. Извлекаешь данные из истории болезни. Отвечаешь только JSON по заданной схеме.",
+                user=self.build_prompt(history),
+                max_tokens=4000,
+                json_mode=True,
+                timeout=120,
+                use_cache=True
+            )
+            data = self._parse(completion.content)
+        except DeepSeekError as e:
+            print(f"❌ Ошибка единого запроса: {e}")
+            note_degraded('unified', e)
+
+        if not isinstance(data, dict):
+            if completion is not None:
+                self.client.invalidate(completion)
+            with self.lock:
+                self.failures += 1
+                for section in SECTIONS:
+                    self.fallbacks[section] += 1
+            return {}
+
+        result = {'_from_cache': completion.from_cache}
+        invalid = []
+        for section in SECTIONS:
+            value = data.get(section)
+            if section in data and matches_schema(value, UNIFIED_SCHEMA['properties'][section]):
+                result[section] = value
+            else:
+                invalid.append(section)
+
+        with self.lock:
+            for section in invalid:
+                self.fallbacks[section] += 1
+
+        if invalid:
+            print(f"⚠️ Разделы без ответа или не прошедшие схему: {invalid}")
+        print(f"✅ Единый запрос: получено разделов {len(SECTIONS) - len(invalid)} из {len(SECTIONS)}"
+              f"{' (из кэша)' if completion.from_cache else ''}")
+        return result
+
+    @staticmethod
+    def _parse(content: str) -> Optional[Any]:
+        content = (content or '').strip()
+        if content.startswith('```json'):
+            content = content[7:]
+        elif content.startswith('```'):
+            content = content[3:]
+        if content.endswith('```'):
+            content = content[:-3]
+        content = content.strip()
+
+        try:
+            return json.loads(content)
+        except json.JSONDecodeError:
+            json_match = re.search(r'(\{.*\})', content, re.DOTALL)
+            if json_match:
+                try:
+                    return json.loads(json_match.group(1))
+                except json.JSONDecodeError:
+                    pass
+        print("❌ Ответ единого запроса не является JSON")
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'requests': self.requests,
+                'failures': self.failures,
+                'fallbacks': dict(self.fallbacks)
+            }
+
+
+unified_extractor = UnifiedExtractor()
@@ -129,10 +129,26 @@ export default function App() {
     setHistoryInput("");
   };
 
-  const handleSelectHistoryEntry = (entry: any) => {
-    if (entry.full_result) {
-      setCurrentResult(entry.full_result);
-      localStorage.setItem('aiResult', JSON.stringify(entry.full_result));
+  const handleSelectHistoryEntry = async (entry: any) => {
+    // Полный результат не приходит со списком истории, загружаем его по требованию
+    let fullResult = entry.full_result;
+
+    if (!fullResult) {
+      const targetPatientId = userType === "doctor" ? selectedPatient : patientId;
+      try {
+        const response = await fetch(`http://localhost:5000/api/patient/${targetPatientId}/history/${entry.id}`);
+        if (response.ok) {
+          const data = await response.json();
+          fullResult = data.entry?.full_result;
+        }
+      } catch (error) {
+        console.error("Ошибка загрузки записи:", error);
+      }
+    }
+
+    if (fullResult && Object.keys(fullResult).length > 0) {
+      setCurrentResult(fullResult);
+      localStorage.setItem('aiResult', JSON.stringify(fullResult));
       setView("results");
     }
   };